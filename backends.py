@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 19 09:30:14 2022
+
+Pluggable data backends for the visualizers.
+
+The visualizers only need a handful of reads from the vehicle-indexed and
+time-indexed collections. CollectionBackend names exactly those operations;
+MongoBackend serves them from i24_database_api/MongoDB, LocalBackend from
+in-memory documents (optionally loaded from JSON files) and snapshot.Snapshot
+from memory-mapped NumPy arrays. OverheadCompare, OverheadCompareV2,
+OverheadVisualizer and Plotter run unchanged against any of them.
+
+Every public read is timed. Backend.stats accumulates count/total/max latency
+per operation over all collections of the backend; for reads that return an
+iterator the time spent consuming it is included.
+"""
+
+import os
+import time
+import bisect
+from collections import defaultdict
+from bson.objectid import ObjectId
+
+
+class LatencyStats():
+    """
+    Per-operation latency counters
+    """
+    def __init__(self):
+        self.count = defaultdict(int)
+        self.total = defaultdict(float)
+        self.max = defaultdict(float)
+
+    def add(self, op, elapsed):
+        self.count[op] += 1
+        self.total[op] += elapsed
+        if elapsed > self.max[op]:
+            self.max[op] = elapsed
+
+    def reset(self):
+        self.count.clear()
+        self.total.clear()
+        self.max.clear()
+
+    def summary(self):
+        """
+        {op: {"count", "total_ms", "mean_ms", "max_ms"}}
+        """
+        return {op: {"count": n,
+                     "total_ms": self.total[op]*1000,
+                     "mean_ms": self.total[op]*1000/n,
+                     "max_ms": self.max[op]*1000} for op, n in self.count.items()}
+
+    def print_summary(self):
+        for op, s in sorted(self.summary().items()):
+            print("{:<16} n={:<8} total={:>10.1f}ms mean={:>8.3f}ms max={:>8.3f}ms".format(
+                op, s["count"], s["total_ms"], s["mean_ms"], s["max_ms"]))
+
+
+
+class CollectionBackend():
+    """
+    The reads the visualizers issue against one collection
+    Subclasses implement the underscore methods, the public methods add latency accounting.
+    Documents are dictionaries shaped like the MongoDB documents:
+        time-indexed: {"timestamp", "id", "position", "dimensions"}
+        vehicle-indexed: {"_id", "first_timestamp", "last_timestamp", "timestamp", "x_position", "y_position",
+                          "length", "width", "coarse_vehicle_class", "fragment_ids", "merged_ids", ...}
+    """
+    def __init__(self, name, stats = None):
+        self.name = name
+        self.stats = stats if stats is not None else LatencyStats()
+
+    def _timed(self, op, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.stats.add(op, time.perf_counter() - start)
+
+    def _timed_iter(self, op, func, *args):
+        # cursors are lazy: charge the time spent consuming them to the same operation
+        start = time.perf_counter()
+        it = iter(func(*args))
+        elapsed = time.perf_counter() - start
+        while True:
+            start = time.perf_counter()
+            try:
+                doc = next(it)
+            except StopIteration:
+                self.stats.add(op, elapsed + time.perf_counter() - start)
+                return
+            elapsed += time.perf_counter() - start
+            yield doc
+
+    # public protocol
+    def get_min(self, field):
+        """
+        Smallest value of field over the collection
+        """
+        return self._timed("get_min", self._get_min, field)
+
+    def get_max(self, field):
+        """
+        Largest value of field over the collection
+        """
+        return self._timed("get_max", self._get_max, field)
+
+    def count(self):
+        """
+        Number of documents in the collection
+        """
+        return self._timed("count", self._count)
+
+    def get_range(self, field, start, end, limit = 0):
+        """
+        Documents with start <= field < end, sorted ascending by field. limit=0 means no limit
+        """
+        return self._timed_iter("get_range", self._get_range, field, start, end, limit)
+
+    def find_one(self, field, value):
+        """
+        One document with field == value, or None
+        """
+        return self._timed("find_one", self._find_one, field, value)
+
+    def find_ids(self, ids, projection = None):
+        """
+        Vehicle-indexed documents whose _id is in ids
+        """
+        return self._timed_iter("find_ids", self._find_ids, ids, projection)
+
+    def find_active(self, t_min, t_max, projection = None):
+        """
+        Vehicle-indexed documents with first_timestamp <= t_max and last_timestamp >= t_min
+        """
+        return self._timed_iter("find_active", self._find_active, t_min, t_max, projection)
+
+    def find_starting(self, t_start, t_end, projection = None):
+        """
+        Vehicle-indexed documents with t_start <= first_timestamp < t_end, sorted by descending last_timestamp
+        """
+        return self._timed_iter("find_starting", self._find_starting, t_start, t_end, projection)
+
+    def get_columns(self, fields):
+        """
+        Values of a few scalar fields of every document, sorted by the first field (see keyframes.py)
+        return: {field: list}
+        """
+        return self._timed("get_columns", self._get_columns, list(fields))
+
+    def create_index(self, field):
+        return self._timed("create_index", self._create_index, field)
+
+    def change_token(self):
+        """
+        Cheap value that changes whenever documents are added or removed, see catalog.py
+        """
+        return self._timed("change_token", self._change_token)
+
+    # implementations
+    def _get_min(self, field):
+        raise NotImplementedError
+
+    def _get_max(self, field):
+        raise NotImplementedError
+
+    def _count(self):
+        raise NotImplementedError
+
+    def _get_range(self, field, start, end, limit):
+        raise NotImplementedError
+
+    def _find_one(self, field, value):
+        raise NotImplementedError
+
+    def _find_ids(self, ids, projection):
+        raise NotImplementedError
+
+    def _find_active(self, t_min, t_max, projection):
+        raise NotImplementedError
+
+    def _find_starting(self, t_start, t_end, projection):
+        raise NotImplementedError
+
+    def _get_columns(self, fields):
+        raise NotImplementedError
+
+    def _create_index(self, field):
+        pass
+
+    def _change_token(self):
+        return [self._count()]
+
+
+
+class Backend():
+    """
+    A source of collections, organised by database name as in MongoDB
+    ("trajectories", "reconciled", "transformed")
+    """
+    def __init__(self):
+        self.stats = LatencyStats()
+
+    def collection(self, database, name):
+        raise NotImplementedError
+
+    def list_collection_names(self, database):
+        raise NotImplementedError
+
+    def catalog_key(self):
+        """
+        Identity of the data source under which catalog.py persists collection metadata,
+        None if the data does not outlive the process
+        """
+        return None
+
+    def insert_many(self, database, name, docs):
+        """
+        Append documents to a collection (the local transform writes its frames through this)
+        """
+        raise NotImplementedError
+
+    def drop_collection(self, database, name):
+        raise NotImplementedError
+
+    def rename_collection(self, database, name, new_name):
+        """
+        Rename a collection, replacing new_name if it exists
+        """
+        raise NotImplementedError
+
+
+
+class MongoCollection(CollectionBackend):
+    """
+    CollectionBackend over an i24_database_api DBClient
+    """
+    def __init__(self, dbc, stats = None):
+        super().__init__(dbc.collection.name, stats)
+        self.dbc = dbc
+
+    def _get_min(self, field):
+        return self.dbc.get_min(field)
+
+    def _get_max(self, field):
+        return self.dbc.get_max(field)
+
+    def _count(self):
+        return self.dbc.collection.estimated_document_count()
+
+    def _get_range(self, field, start, end, limit):
+        return self.dbc.collection.find({field: {"$gte": start, "$lt": end}}).sort(field, 1).limit(limit)
+
+    def _find_one(self, field, value):
+        return self.dbc.find_one(field, value)
+
+    def _find_ids(self, ids, projection):
+        return self.dbc.collection.find({"_id": {"$in": list(ids)}}, projection)
+
+    def _find_active(self, t_min, t_max, projection):
+        pipeline = [{"$match": {"$and" : [{"first_timestamp": {"$lte": t_max}},{"last_timestamp": {"$gte": t_min}}]}}]
+        if projection:
+            pipeline.append({'$project': projection})
+        return self.dbc.collection.aggregate(pipeline)
+
+    def _find_starting(self, t_start, t_end, projection):
+        return self.dbc.collection.find({"first_timestamp" : {"$gte" : t_start, "$lt" : t_end}},
+                                        projection).sort("last_timestamp", -1)
+
+    def _get_columns(self, fields):
+        projection = {field: 1 for field in fields}
+        if "_id" not in fields:
+            projection["_id"] = 0
+        docs = list(self.dbc.collection.find({}, projection).sort(fields[0], 1))
+        return {field: [doc.get(field) for doc in docs] for field in fields}
+
+    def _create_index(self, field):
+        self.dbc.create_index(field)
+
+    def _change_token(self):
+        # ObjectIds grow with insertion time: the newest _id changes on every insert
+        last = self.dbc.collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        return [self.dbc.collection.estimated_document_count(), str(last["_id"]) if last else None]
+
+
+
+class MongoBackend(Backend):
+    """
+    Backend over MongoDB through i24_database_api
+    config: dictionary for database access (host, port, username, password)
+    """
+    def __init__(self, config):
+        super().__init__()
+        from i24_database_api import DBClient
+        self.DBClient = DBClient
+        self.config = config
+
+    def collection(self, database, name):
+        return MongoCollection(self.DBClient(**self.config, database_name=database, collection_name=name), self.stats)
+
+    def catalog_key(self):
+        return "mongodb://{}:{}".format(self.config.get("host"), self.config.get("port"))
+
+    def list_collection_names(self, database):
+        start = time.perf_counter()
+        names = self.DBClient(**self.config, database_name=database).list_collection_names()
+        self.stats.add("list_collections", time.perf_counter() - start)
+        return names
+
+    def insert_many(self, database, name, docs):
+        start = time.perf_counter()
+        self.DBClient(**self.config, database_name=database, collection_name=name).collection.insert_many(docs)
+        self.stats.add("insert_many", time.perf_counter() - start)
+
+    def drop_collection(self, database, name):
+        self.DBClient(**self.config, database_name=database, collection_name=name).collection.drop()
+
+    def rename_collection(self, database, name, new_name):
+        self.DBClient(**self.config, database_name=database, collection_name=name).collection.rename(new_name, dropTarget=True)
+
+
+
+def _project(doc, projection):
+    if not projection:
+        return doc
+    return {k: v for k, v in doc.items() if k == "_id" or projection.get(k)}
+
+
+class LocalCollection(CollectionBackend):
+    """
+    CollectionBackend over a list of documents held in memory
+    Sorted views per field are built lazily and reused until the next insert.
+    """
+    def __init__(self, name, docs = None, stats = None):
+        super().__init__(name, stats)
+        self.docs = []
+        self.by_id = {}
+        self._sorted = {} # field -> (keys, docs) sorted by field
+        if docs:
+            self.insert_many(docs)
+
+    def insert_many(self, docs):
+        for doc in docs:
+            if "_id" not in doc: # as MongoDB does on insert
+                doc["_id"] = ObjectId()
+            self.docs.append(doc)
+            self.by_id[doc["_id"]] = doc
+        self._sorted.clear()
+
+    def _sorted_by(self, field):
+        if field not in self._sorted:
+            docs = sorted((d for d in self.docs if field in d), key=lambda d: d[field])
+            self._sorted[field] = ([d[field] for d in docs], docs)
+        return self._sorted[field]
+
+    def _get_min(self, field):
+        keys, _ = self._sorted_by(field)
+        return keys[0] if keys else None
+
+    def _get_max(self, field):
+        keys, _ = self._sorted_by(field)
+        return keys[-1] if keys else None
+
+    def _count(self):
+        return len(self.docs)
+
+    def _get_range(self, field, start, end, limit):
+        keys, docs = self._sorted_by(field)
+        lo = bisect.bisect_left(keys, start)
+        hi = bisect.bisect_left(keys, end)
+        if limit:
+            hi = min(hi, lo + limit)
+        return docs[lo:hi]
+
+    def _find_one(self, field, value):
+        keys, docs = self._sorted_by(field)
+        k = bisect.bisect_left(keys, value)
+        if k < len(keys) and keys[k] == value:
+            return docs[k]
+        return None
+
+    def _find_ids(self, ids, projection):
+        return [_project(self.by_id[i], projection) for i in ids if i in self.by_id]
+
+    def _find_active(self, t_min, t_max, projection):
+        return [_project(d, projection) for d in self.docs
+                if d["first_timestamp"] <= t_max and d["last_timestamp"] >= t_min]
+
+    def _find_starting(self, t_start, t_end, projection):
+        keys, docs = self._sorted_by("first_timestamp")
+        selected = docs[bisect.bisect_left(keys, t_start):bisect.bisect_left(keys, t_end)]
+        return [_project(d, projection) for d in sorted(selected, key=lambda d: d["last_timestamp"], reverse=True)]
+
+    def _get_columns(self, fields):
+        _, docs = self._sorted_by(fields[0])
+        return {field: [doc.get(field) for doc in docs] for field in fields}
+
+    def _change_token(self):
+        return [len(self.docs), str(self.docs[-1]["_id"]) if self.docs else None]
+
+
+
+class LocalBackend(Backend):
+    """
+    In-memory stand-in for the database, for benchmarks and tests without MongoDB
+    path: optional directory of <database>/<collection>.json files (MongoDB extended JSON) to load
+    """
+    def __init__(self, path = None):
+        super().__init__()
+        self.databases = defaultdict(dict)
+        self.path = path
+        if path:
+            self.load(path)
+
+    def collection(self, database, name):
+        if name not in self.databases[database]:
+            self.databases[database][name] = LocalCollection(name, stats=self.stats)
+        return self.databases[database][name]
+
+    def list_collection_names(self, database):
+        return list(self.databases[database].keys())
+
+    def catalog_key(self):
+        return "local://" + os.path.abspath(self.path) if self.path else None
+
+    def insert_many(self, database, name, docs):
+        self.collection(database, name).insert_many(docs)
+
+    def drop_collection(self, database, name):
+        self.databases[database].pop(name, None)
+
+    def rename_collection(self, database, name, new_name):
+        col = self.databases[database].pop(name)
+        col.name = new_name
+        self.databases[database][new_name] = col
+
+    def load(self, path):
+        from bson import json_util
+        for database in os.listdir(path):
+            db_path = os.path.join(path, database)
+            if not os.path.isdir(db_path):
+                continue
+            for file_name in os.listdir(db_path):
+                if file_name.endswith(".json"):
+                    with open(os.path.join(db_path, file_name)) as f:
+                        self.insert_many(database, file_name[:-5], json_util.loads(f.read()))
+
+    def save(self, path):
+        from bson import json_util
+        for database, collections in self.databases.items():
+            os.makedirs(os.path.join(path, database), exist_ok=True)
+            for name, col in collections.items():
+                with open(os.path.join(path, database, name + ".json"), "w") as f:
+                    f.write(json_util.dumps(col.docs))
+
+
+
+def get_backend(config = None, backend = None, snapshot = None):
+    """
+    Resolve the backend arguments of the visualizers: an explicit backend wins,
+    then a snapshot directory, then MongoDB with config
+    """
+    if backend is not None:
+        return backend
+    if snapshot:
+        from snapshot import Snapshot
+        return Snapshot(snapshot)
+    return MongoBackend(config)
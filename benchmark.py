@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 21 10:31:52 2022
+
+Frame-throughput benchmark for the renderers.
+Every case drives one renderer headlessly (Agg) for a fixed number of frames over
+a fixed synthetic scene (see synthetic.py) and reports per-frame stage times
+(fetch, cache, geometry, draw, encode), frames per second, peak RSS and the
+cache counters of the renderer (see cache.py).
+Each case runs in a fresh process so that peak RSS belongs to that case only.
+
+python benchmark.py --out results.json
+python benchmark.py --renderers compare-collection plotter --vehicles 500 --compare results.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+RENDERERS = ["compare", "compare-collection", "visualizer", "visualizer-collection", "plotter", "v2"]
+DATA_PATHS = ["snapshot", "local"]
+VEHICLE_COUNTS = [100, 500, 2000] # vehicles per frame
+DURATION = 12 # (sec) of simulated traffic per dataset
+FRAMERATE = 25
+X_MIN, X_MAX = 0, 2000
+SEED = 0
+
+
+def dataset_names(vehicles):
+    name = "bench{}".format(vehicles)
+    return ["groundtruth_" + name, name + "--RAW", name + "--RAW__reconciled"]
+
+
+def prepare_dataset(data_dir, vehicles):
+    """
+    Simulate the scene for a vehicle count once and cache it as a snapshot and as LocalBackend JSON
+    return: directory of the dataset
+    """
+    path = os.path.join(data_dir, "vpf{}".format(vehicles))
+    if os.path.exists(os.path.join(path, "done")):
+        return path
+    from synthetic import TrafficSimulator
+    sim = TrafficSimulator(vehicles_per_frame=vehicles, duration=DURATION, framerate=FRAMERATE,
+                           x_min=X_MIN, x_max=X_MAX, seed=SEED)
+    scene = sim.run()
+    names = dataset_names(vehicles)
+    scene.write_snapshot(os.path.join(path, "snapshot"), names)
+    scene.to_backend(names).save(os.path.join(path, "local"))
+    open(os.path.join(path, "done"), "w").close()
+    return path
+
+
+def load_backend(path, data_path):
+    if data_path == "snapshot":
+        from snapshot import Snapshot
+        return Snapshot(os.path.join(path, "snapshot"))
+    from backends import LocalBackend
+    return LocalBackend(os.path.join(path, "local"))
+
+
+def encode(fig):
+    """
+    Grab the rendered canvas and JPEG encode it, as the stream and video export do
+    """
+    import cv2
+    rgba = np.asarray(fig.canvas.buffer_rgba())
+    flag, buf = cv2.imencode(".jpg", cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR))
+    return buf
+
+
+def build(renderer, backend, vehicles):
+    """
+    Set up a renderer without showing it
+    return: (object with .timer, .fig, .init_frame, .update_frame)
+    """
+    gt, raw, rec = dataset_names(vehicles)
+    if renderer.startswith("compare"):
+        from overhead_compare import OverheadCompare
+        p = OverheadCompare(None, collections=[gt, raw, rec], framerate=FRAMERATE,
+                            x_min=X_MIN, x_max=X_MAX, offset=0, duration=None, backend=backend)
+        mode = "collection" if renderer.endswith("collection") else "patches"
+        p.animate(render_mode=mode, show=False)
+    elif renderer.startswith("visualizer"):
+        from overhead_visualizer import OverheadVisualizer
+        p = OverheadVisualizer(None, "RECONCILED", "reconciled", rec, "transformed", rec,
+                               x_start=X_MAX, x_end=X_MIN, framerate=FRAMERATE, backend=backend)
+        mode = "collection" if renderer.endswith("collection") else "patches"
+        p.visualize(render_mode=mode, show=False)
+    elif renderer == "plotter":
+        from spacetime_overhead import Plotter
+        p = Plotter(None, vehicle_database="reconciled", vehicle_collection=rec,
+                    timestamp_database="transformed", timestamp_collection=rec,
+                    framerate=FRAMERATE, x_min=X_MIN, x_max=X_MAX, duration=None, backend=backend)
+        p.animate(show=False)
+    else:
+        raise ValueError("unknown renderer {}".format(renderer))
+    return p
+
+
+def run_case(case):
+    """
+    Run one benchmark case in this process
+    case: {"renderer", "data_path", "vehicles", "frames", "warmup", "data_dir"}
+    return: result dictionary
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from profiling import peak_rss_mb
+
+    path = prepare_dataset(case["data_dir"], case["vehicles"])
+    backend = load_backend(path, case["data_path"])
+    frames = case["frames"]
+    warmup = case["warmup"]
+
+    if case["renderer"] == "v2":
+        from overhead_compare_v2 import OverheadCompareV2
+        p = OverheadCompareV2(None, collections=dataset_names(case["vehicles"]), framerate=FRAMERATE,
+                              x_min=X_MIN, x_max=X_MAX, offset=0, duration=None, backend=backend)
+        p.animate(False, False, False, "", show=False, max_frames=warmup)
+        p.timer.reset()
+        start = time.perf_counter()
+        p.animate(False, False, False, "", show=False, max_frames=frames)
+        elapsed = time.perf_counter() - start
+        rendered = p.timer.frames
+    else:
+        p = build(case["renderer"], backend, case["vehicles"])
+        p.init_frame()
+        p.fig.canvas.draw()
+        p.timer.reset()
+        rendered = 0
+        start = time.perf_counter()
+        for i in range(warmup + frames):
+            if i == warmup:
+                p.timer.reset()
+                start = time.perf_counter()
+            try:
+                p.update_frame(i)
+            except StopIteration:
+                break
+            with p.timer.stage("draw"):
+                p.fig.canvas.draw()
+            with p.timer.stage("encode"):
+                encode(p.fig)
+            p.timer.next_frame()
+            if i >= warmup:
+                rendered += 1
+        elapsed = time.perf_counter() - start
+        plt.close("all")
+        if hasattr(p, "close_sources"):
+            p.close_sources()
+
+    result = dict(case)
+    del result["data_dir"]
+    result.update({"rendered": rendered,
+                   "fps": rendered / elapsed if elapsed > 0 else 0.0,
+                   "stages": p.timer.summary(),
+                   "peak_rss_mb": peak_rss_mb(),
+                   "backend_latency": backend.stats.summary(),
+                   "caches": p.cache_stats()})
+    return result
+
+
+def case_key(result):
+    return "{renderer}/{data_path}/{vehicles}".format(**result)
+
+
+def compare_results(old, new, threshold = 0.1):
+    """
+    Print the fps change of every case found in both runs
+    threshold: relative fps drop reported as a regression
+    return: list of regressed case keys
+    """
+    old = {case_key(r): r for r in old["results"]}
+    regressions = []
+    for r in new["results"]:
+        key = case_key(r)
+        if key not in old or "error" in old[key]:
+            continue
+        if "error" in r:
+            regressions.append(key)
+            print("{:45s} failed: {}  REGRESSION".format(key, r["error"]))
+            continue
+        if not old[key]["fps"]:
+            continue
+        change = r["fps"] / old[key]["fps"] - 1
+        flag = ""
+        if change < -threshold:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print("{:45s} {:8.1f} -> {:8.1f} fps ({:+.0%}){}".format(key, old[key]["fps"], r["fps"], change, flag))
+    return regressions
+
+
+def print_result(r):
+    stages = " ".join("{}={:.1f}".format(name, s["mean_ms"]) for name, s in sorted(r["stages"].items()))
+    print("{:45s} {:8.1f} fps  {:7.1f} MB  [ms/frame] {}".format(case_key(r), r["fps"], r["peak_rss_mb"], stages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless frame-throughput benchmark of the renderers")
+    parser.add_argument("--renderers", nargs="+", default=RENDERERS, choices=RENDERERS)
+    parser.add_argument("--data-paths", nargs="+", default=DATA_PATHS, choices=DATA_PATHS)
+    parser.add_argument("--vehicles", nargs="+", type=int, default=VEHICLE_COUNTS, help="vehicles per frame of the synthetic datasets")
+    parser.add_argument("--frames", type=int, default=100, help="measured frames per case")
+    parser.add_argument("--warmup", type=int, default=5, help="frames rendered before measuring")
+    parser.add_argument("--data-dir", default="benchmark_data", help="cache directory of the generated datasets")
+    parser.add_argument("--out", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative fps drop reported as a regression")
+    parser.add_argument("--case", default=None, help=argparse.SUPPRESS) # internal: run one case, print JSON
+    parser.add_argument("--prepare", type=int, default=None, help=argparse.SUPPRESS) # internal: generate one dataset
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+    if args.prepare:
+        prepare_dataset(args.data_dir, args.prepare)
+        return
+
+    results = []
+    for vehicles in args.vehicles:
+        # once, before the timed processes. In its own process: on Linux the peak RSS
+        # of a parent is inherited by the processes it starts
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--prepare", str(vehicles),
+                        "--data-dir", args.data_dir], check=True)
+        for data_path in args.data_paths:
+            for renderer in args.renderers:
+                case = {"renderer": renderer, "data_path": data_path, "vehicles": vehicles,
+                        "frames": args.frames, "warmup": args.warmup, "data_dir": args.data_dir}
+                proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", json.dumps(case)],
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+                if proc.returncode != 0:
+                    # keep failed cases in the results, a case that stops working is a regression too
+                    errors = proc.stderr.strip().splitlines()
+                    r = {"renderer": renderer, "data_path": data_path, "vehicles": vehicles,
+                         "frames": args.frames, "warmup": args.warmup,
+                         "error": errors[-1] if errors else "exit code {}".format(proc.returncode)}
+                    print("{:45s} failed: {}".format(case_key(r), r["error"]))
+                else:
+                    r = json.loads(proc.stdout.strip().splitlines()[-1])
+                    print_result(r)
+                results.append(r)
+
+    out = {"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+           "python": sys.version.split()[0],
+           "platform": sys.platform,
+           "results": results}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(out, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare_results(old, out, args.threshold):
+            sys.exit(1)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 28 09:12:51 2022
+
+Caches shared by the visualizers, with counters to tune their capacity against memory.
+A miss is never a magic value: LRUCache.get() raises CacheMiss (a KeyError) unless
+a default is given, or calls the loader of the cache to fill the entry.
+Capacities are sized from the number of vehicles active in the current time
+window (see size_for), not hard-coded.
+
+stats = CacheStats()           # hits, misses, loads, evictions, bytes
+cache = LRUCache(size_for(active), loader=lambda key: ..., name="labels")
+cache.get(key)
+print(cache.stats.summary())
+"""
+
+import sys
+from collections import OrderedDict
+
+
+class CacheMiss(KeyError):
+    """
+    Raised by LRUCache.get() for a key that is not cached and cannot be loaded
+    """
+
+
+def size_for(active, headroom = 2.0, minimum = 16):
+    """
+    Capacity for a cache of per-vehicle entries
+    active: number of vehicles active in the current time window
+    headroom: room for the vehicles entering before the ones leaving are evicted
+    """
+    return max(minimum, int(active * headroom))
+
+
+class CacheStats():
+    """
+    Counters of one cache
+    hits, misses: lookups found / not found
+    loads: misses filled by the loader
+    evictions: entries dropped to respect the capacity (or expired)
+    bytes: estimated memory currently held by the entries
+    """
+    def __init__(self, name = ""):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.bytes = 0
+        self.size = 0
+        self.capacity = 0
+
+    def reset(self):
+        self.hits = self.misses = self.loads = self.evictions = 0
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return {"name": self.name, "hits": self.hits, "misses": self.misses, "loads": self.loads,
+                "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": self.size, "capacity": self.capacity, "bytes": self.bytes}
+
+
+class LRUCache():
+    """
+    A least-recently-used cache
+    capacity: max number of entries, see size_for() and resize()
+    loader: function key -> value called on a miss, its result is cached.
+            It may raise CacheMiss (or KeyError) if the key does not exist
+    sizeof: function (key, value) -> bytes, for the bytes counter. sys.getsizeof of both by default
+    """
+    def __init__(self, capacity, loader = None, sizeof = None, name = ""):
+        self.cache = OrderedDict()
+        self.capacity = capacity
+        self.loader = loader
+        self.sizeof = sizeof or (lambda key, value: sys.getsizeof(key) + sys.getsizeof(value))
+        self.nbytes = {} # key -> estimated bytes
+        self.stats = CacheStats(name)
+        self.stats.capacity = capacity
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def get(self, key, *default):
+        """
+        Value of key, marked as most recently used
+        On a miss: the loader result if there is a loader, else default if given, else raise CacheMiss
+        """
+        if key in self.cache:
+            self.stats.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.stats.misses += 1
+        if self.loader is not None:
+            try:
+                value = self.loader(key)
+            except KeyError:
+                if default:
+                    return default[0]
+                raise CacheMiss(key)
+            self.stats.loads += 1
+            self.put(key, value)
+            return value
+        if default:
+            return default[0]
+        raise CacheMiss(key)
+
+    def put(self, key, value, update = False):
+        """
+        Add key, an existing value is only replaced if update
+        """
+        if key not in self.cache or update:
+            self.stats.bytes -= self.nbytes.get(key, 0)
+            self.cache[key] = value
+            self.nbytes[key] = self.sizeof(key, value)
+            self.stats.bytes += self.nbytes[key]
+        self.cache.move_to_end(key)
+        self._evict()
+
+    def pop(self, key, *default):
+        if key not in self.cache:
+            if default:
+                return default[0]
+            raise CacheMiss(key)
+        self.stats.bytes -= self.nbytes.pop(key)
+        value = self.cache.pop(key)
+        self.stats.size = len(self.cache)
+        return value
+
+    def resize(self, capacity):
+        """
+        Change the capacity, e.g. when the number of active vehicles changes
+        """
+        self.capacity = capacity
+        self.stats.capacity = capacity
+        self._evict()
+
+    def _evict(self):
+        while len(self.cache) > self.capacity:
+            key, _ = self.cache.popitem(last = False)
+            self.stats.bytes -= self.nbytes.pop(key)
+            self.stats.evictions += 1
+        self.stats.size = len(self.cache)
+
+    def summary(self):
+        return self.stats.summary()
+
+    def keys(self):
+        return self.cache.keys()
+
+    def values(self):
+        return self.cache.values()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Nov  2 10:14:36 2022
+
+Persistent catalog of collection metadata, so that starting a visualizer on a known
+collection costs no database round trip.
+For every collection the catalog records the value ranges that were asked for
+(timestamp, first_timestamp/last_timestamp, starting_x/ending_x, ...), the document
+count, the indexes created and a change token (see CollectionBackend.change_token).
+Entries are kept in one JSON file per user, grouped by backend.catalog_key(); backends
+whose data does not outlive the process keep their entries in memory only.
+
+Known entries are used as they are. check() then compares the token of every entry used
+in this session with the database in a background thread, and drops the entries whose
+collection changed: they are computed again the next time they are asked for.
+
+catalog = Catalog(backend)
+t_min, t_max = catalog.range("transformed", name, "timestamp")
+catalog.ensure_index("transformed", name, "timestamp")
+catalog.check()
+"""
+
+import json
+import os
+import threading
+from cache import CacheStats
+
+CATALOG_PATH = os.path.join(os.path.expanduser("~"), ".cache", "i24_catalog.json")
+_save_lock = threading.Lock() # catalogs of one process write the same file
+
+
+class Catalog():
+    """
+    Collection metadata of one backend
+    backend: data backend (see backends.py)
+    path: JSON file shared by all backends, CATALOG_PATH by default
+    """
+    def __init__(self, backend, path = None):
+        self.backend = backend
+        self.key = backend.catalog_key()
+        self.path = path or CATALOG_PATH
+        self.lock = threading.Lock()
+        self.stats = CacheStats("catalog") # fields served from an entry are hits, computed ones are loads
+        self.collections = {} # (database, name) -> collection backend, reused by the visualizers
+        self.names = {} # database -> collection names listed in this session
+        self.used = set() # entries read in this session, validated by check()
+        self.fresh = set() # entries computed in this session, their token is current
+        self.stale = set() # entries dropped by check() or invalidate()
+        self.entries = self._load().get(self.key, {}) if self.key else {}
+        self._thread = None
+
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def save(self):
+        """
+        Write the entries of this backend, merged with the entries saved meanwhile by other catalogs
+        """
+        if not self.key:
+            return
+        with _save_lock, self.lock:
+            data = self._load()
+            saved = data.get(self.key, {})
+            for key in self.stale:
+                saved.pop(key, None)
+            saved.update(self.entries)
+            data[self.key] = saved
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp, self.path)
+
+
+    def collection(self, database, name):
+        if (database, name) not in self.collections:
+            self.collections[(database, name)] = self.backend.collection(database, name)
+        return self.collections[(database, name)]
+
+
+    def _entry(self, database, name):
+        # the token is read before the fields it guards
+        key = database + "/" + name
+        self.used.add(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            col = self.collection(database, name)
+            entry = {"token": col.change_token(), "count": col.count(), "ranges": {}, "indexes": []}
+            with self.lock:
+                self.entries[key] = entry
+            self.fresh.add(key)
+            self.stale.discard(key)
+        return entry
+
+
+    def exists(self, database, name):
+        """
+        True if the collection holds documents. Lists the database only for unknown collections
+        """
+        entry = self.entries.get(database + "/" + name)
+        if entry is not None and entry["count"]:
+            self.stats.hits += 1
+            return True
+        self.stats.misses += 1
+        if database not in self.names:
+            self.names[database] = set(self.backend.list_collection_names(database))
+        return name in self.names[database]
+
+
+    def count(self, database, name):
+        return self._entry(database, name)["count"]
+
+
+    def range(self, database, name, field):
+        """
+        (min, max) of field over the collection
+        """
+        entry = self._entry(database, name)
+        if field not in entry["ranges"]:
+            self.stats.misses += 1
+            self.stats.loads += 1
+            col = self.collection(database, name)
+            value = [col.get_min(field), col.get_max(field)]
+            with self.lock:
+                entry["ranges"][field] = value
+        else:
+            self.stats.hits += 1
+        return tuple(entry["ranges"][field])
+
+
+    def sample_interval(self, database, name, field = "timestamp"):
+        """
+        (sec) mean time between the documents of a time-indexed collection, None if unknown
+        """
+        count = self.count(database, name)
+        t_min, t_max = self.range(database, name, field)
+        if not count or count < 2 or t_min is None or t_max is None:
+            return None
+        return (t_max - t_min) / (count - 1)
+
+
+    def ensure_index(self, database, name, field):
+        """
+        Create the index on field unless the catalog has already done it
+        """
+        entry = self._entry(database, name)
+        if field in entry["indexes"]:
+            self.stats.hits += 1
+            return
+        self.stats.misses += 1
+        self.collection(database, name).create_index(field)
+        with self.lock:
+            entry["indexes"].append(field)
+
+
+    def invalidate(self, database, name):
+        """
+        Forget a collection, e.g. after writing to it
+        """
+        with self.lock:
+            self.entries.pop(database + "/" + name, None)
+        self.fresh.discard(database + "/" + name)
+        self.stale.add(database + "/" + name)
+        self.names.pop(database, None)
+
+
+    def _check(self):
+        for key in sorted(self.used - self.fresh):
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            database, name = key.split("/", 1)
+            try:
+                token = self.collection(database, name).change_token()
+            except Exception as e:
+                print("catalog: cannot check {}: {}".format(key, e))
+                continue
+            if json.loads(json.dumps(token)) != entry["token"]:
+                with self.lock:
+                    self.entries.pop(key, None)
+                self.stale.add(key)
+                self.stats.evictions += 1
+        self.save()
+
+
+    def check(self, wait = False):
+        """
+        Validate the change tokens of the entries used so far and save the catalog
+        wait: validate in this thread instead of a background thread
+        """
+        if wait:
+            self._check()
+            return
+        self._thread = threading.Thread(target=self._check, daemon=True)
+        self._thread.start()
+
+
+    def join(self, timeout = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+    def summary(self):
+        self.stats.size = len(self.entries)
+        return self.stats.summary()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 17 09:12:05 2022
+
+Batched, read-ahead access to time-indexed collections (database "transformed").
+Instead of one find_one("timestamp", t) round trip per collection per frame,
+a background thread pulls sorted chunks of documents and keeps a bounded
+buffer ahead of playback. Each frame is then an in-memory lookup.
+"""
+
+import heapq
+import sys
+import threading
+import queue
+from cache import CacheStats
+
+
+class FrameSource():
+    """
+    Read-ahead frame fetcher for one time-indexed collection
+    dbr: DBClient (or any object with get_range(index_name, start, end)) of the time-indexed collection
+    t_min/t_max: (sec) time range to stream, [t_min, t_max)
+    chunk_size: (sec) amount of data pulled by each query
+    read_ahead: number of chunks buffered ahead of playback
+
+    Documents are consumed in ascending timestamp order, either by iterating
+    the source (next()) or by get(timestamp) for a non-decreasing sequence of timestamps.
+    """
+
+    _END = object() # sentinel put on the buffer once the time range is exhausted
+
+    def __init__(self, dbr, t_min, t_max, chunk_size = 10, read_ahead = 3):
+        self.dbr = dbr
+        self.t_min = t_min
+        self.t_max = t_max
+        self.chunk_size = chunk_size
+        self.read_ahead = max(1, read_ahead)
+
+        self.buffer = queue.Queue(maxsize = self.read_ahead)
+        self.chunk = [] # documents of the current chunk, sorted by timestamp
+        self.pos = 0 # position of the next unread document in self.chunk
+        self.exhausted = False
+        self.error = None
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fetch, daemon=True)
+        self._thread.start()
+
+
+    def _fetch(self):
+        """
+        Background thread: query [start, start+chunk_size) until t_max, blocking when the buffer is full
+        """
+        start = self.t_min
+        try:
+            while start < self.t_max and not self._stop.is_set():
+                end = min(start + self.chunk_size, self.t_max)
+                docs = list(self.dbr.get_range("timestamp", start, end))
+                if docs:
+                    self._put(docs)
+                start = end
+        except Exception as e:
+            self.error = e
+        self._put(self._END)
+
+
+    def _put(self, item):
+        # wake up periodically so that close() can stop a blocked producer
+        while not self._stop.is_set():
+            try:
+                self.buffer.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+    def _advance_chunk(self):
+        """
+        Swap in the next buffered chunk. Return False if there is no more data
+        """
+        if self.exhausted:
+            return False
+        item = self.buffer.get()
+        if item is self._END:
+            self.exhausted = True
+            self.chunk, self.pos = [], 0
+            if self.error is not None:
+                raise self.error
+            return False
+        self.chunk, self.pos = item, 0
+        return True
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        while self.pos >= len(self.chunk):
+            if not self._advance_chunk():
+                raise StopIteration
+        doc = self.chunk[self.pos]
+        self.pos += 1
+        return doc
+
+    # keep the pymongo cursor interface used by the visualizers
+    next = __next__
+
+
+    def peek(self):
+        """
+        Return the next document without consuming it, or None at the end
+        """
+        while self.pos >= len(self.chunk):
+            if not self._advance_chunk():
+                return None
+        return self.chunk[self.pos]
+
+
+    def get(self, timestamp):
+        """
+        Return the document at exactly timestamp, or None if the collection has no such frame
+        Documents before timestamp are skipped, so timestamps must be requested in non-decreasing order
+        """
+        doc = self.peek()
+        while doc is not None and doc["timestamp"] < timestamp:
+            self.pos += 1
+            doc = self.peek()
+        if doc is not None and doc["timestamp"] == timestamp:
+            self.pos += 1
+            return doc
+        return None
+
+
+    def close(self):
+        """
+        Stop the background thread and release the buffer
+        """
+        self._stop.set()
+        self.exhausted = True
+        try:
+            while True:
+                self.buffer.get_nowait()
+        except queue.Empty:
+            pass
+        self._thread.join(timeout=1)
+
+
+
+class SampledFrameSource(FrameSource):
+    """
+    Read-ahead fetcher of the documents around evenly spaced times only, for fast playback
+    times: t_min, t_min+step, ... up to t_max
+    halfwidth: (sec) documents with |timestamp - t| <= halfwidth are fetched for each time,
+               about one stored sample interval so that every time is bracketed
+    The documents of all times are consumed in ascending timestamp order, without duplicates,
+    like those of FrameSource. One query per time, in the background thread.
+    """
+
+    def __init__(self, dbr, t_min, t_max, step, halfwidth, read_ahead = 3):
+        self.step = step
+        self.halfwidth = halfwidth
+        self.last = float("-inf") # timestamp of the last document handed to the buffer
+        super().__init__(dbr, t_min, t_max, chunk_size=step, read_ahead=max(1, read_ahead) * 8)
+
+
+    def _fetch(self):
+        k = 0
+        try:
+            while not self._stop.is_set():
+                t = self.t_min + k * self.step
+                if t >= self.t_max:
+                    break
+                docs = [doc for doc in self.dbr.get_range("timestamp", t - self.halfwidth, t + self.halfwidth)
+                        if doc["timestamp"] > self.last]
+                if docs:
+                    self.last = docs[-1]["timestamp"]
+                    self._put(docs)
+                k += 1
+        except Exception as e:
+            self.error = e
+        self._put(self._END)
+
+
+
+class MergedTimeline():
+    """
+    K-way merge of several time-indexed streams into one timeline
+    sources: list of sorted document iterators (e.g. FrameSource), each yielding docs with a "timestamp" field
+    tolerance: (sec) documents whose timestamps are within tolerance of the first document of a frame are aligned into that frame
+    
+    Each iteration yields a combined frame record
+        {"timestamp": t, "docs": [doc or None per source]}
+    where t is the timestamp of the first source present in the frame (GT when sources[0] is GT).
+    Every document of every source ends up in exactly one frame: a source never contributes
+    two documents to the same frame, a second one starts the next frame instead.
+    self.missing[i] counts the frames in which source i had no document.
+    """
+    
+    def __init__(self, sources, tolerance = 0.02):
+        self.sources = list(sources)
+        self.tolerance = tolerance
+        self.heap = [] # (timestamp, source index, doc) of the head of each source
+        for i in range(len(self.sources)):
+            self._push(i)
+        self.frames = 0
+        self.missing = [0] * len(self.sources)
+        
+        
+    def _push(self, i):
+        try:
+            doc = next(self.sources[i])
+        except StopIteration:
+            return
+        # the source index breaks ties so that docs are never compared
+        heapq.heappush(self.heap, (doc["timestamp"], i, doc))
+        
+        
+    def __iter__(self):
+        return self
+    
+    
+    def __next__(self):
+        if not self.heap:
+            raise StopIteration
+        docs = [None] * len(self.sources)
+        deferred = [] # heads of sources that already have a doc in this frame
+        anchor = self.heap[0][0]
+        while self.heap and self.heap[0][0] - anchor <= self.tolerance:
+            item = heapq.heappop(self.heap)
+            i = item[1]
+            if docs[i] is not None:
+                deferred.append(item)
+                continue
+            docs[i] = item[2]
+            self._push(i)
+        for item in deferred:
+            heapq.heappush(self.heap, item)
+            
+        timestamp = next(doc["timestamp"] for doc in docs if doc is not None)
+        for i, doc in enumerate(docs):
+            if doc is None:
+                self.missing[i] += 1
+        self.frames += 1
+        return {"timestamp": timestamp, "docs": docs}
+    
+    next = __next__
+
+
+
+class MetadataPrefetcher():
+    """
+    Sliding-window read-ahead of vehicle metadata for one vehicle-indexed collection
+    veh: collection backend (find_active/find_starting, see backends.py)
+    t_min/t_max: (sec) time range of playback
+    window: (sec) time span of trajectories fetched per query
+    read_ahead: number of windows fetched ahead of playback
+    projection: fields to fetch, first_timestamp and last_timestamp are always added
+    active: ids of the trajectories active in [t_min, t_min+window] if known (see keyframes.py),
+            the first query then fetches them by _id
+
+    The first query fetches every trajectory active in [t_min, t_min+window], every later
+    one the trajectories starting in the next window, so each vehicle is fetched once.
+    Call advance(t) with the playback time before get(), it blocks only if playback
+    overtakes the background thread. Vehicles that ended more than a window ago are dropped.
+    get_many() falls back to a find_ids query for vehicles missing from the windows.
+    """
+
+    _END = object()
+
+    def __init__(self, veh, t_min, t_max, window = 10, read_ahead = 2, projection = None, active = None):
+        self.veh = veh
+        self.active = active
+        self.t_min = t_min
+        self.t_max = t_max
+        self.window = window
+        self.projection = dict(projection or {})
+        self.projection.update({"first_timestamp": 1, "last_timestamp": 1})
+
+        self.buffer = queue.Queue(maxsize = max(1, read_ahead))
+        self.docs = {} # _id -> metadata document
+        self.loaded_until = t_min # every trajectory starting before this time is in self.docs
+        self.exhausted = False
+        self.error = None
+        self.queries = 0
+        self.stats = CacheStats("metadata " + getattr(veh, "name", ""))
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fetch, daemon=True)
+        self._thread.start()
+
+
+    def _fetch(self):
+        """
+        Background thread: one query per window, blocking when the buffer is full
+        """
+        start = self.t_min
+        try:
+            while start <= self.t_max and not self._stop.is_set():
+                end = start + self.window
+                if start == self.t_min and self.active is not None:
+                    docs = list(self.veh.find_ids(self.active, self.projection)) if self.active else []
+                elif start == self.t_min:
+                    docs = list(self.veh.find_active(start, end, self.projection))
+                else:
+                    docs = list(self.veh.find_starting(start, end, self.projection))
+                self.queries += 1
+                self._put((end, docs))
+                start = end
+        except Exception as e:
+            self.error = e
+        self._put(self._END)
+
+
+    def _put(self, item):
+        # wake up periodically so that close() can stop a blocked producer
+        while not self._stop.is_set():
+            try:
+                self.buffer.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+    def advance(self, t):
+        """
+        Make sure every vehicle active at playback time t is loaded
+        """
+        loaded = False
+        while not self.exhausted and self.loaded_until <= t:
+            item = self.buffer.get()
+            if item is self._END:
+                self.exhausted = True
+                if self.error is not None:
+                    raise self.error
+                break
+            end, docs = item
+            for doc in docs:
+                self._add(doc)
+            self.loaded_until = end
+            loaded = True
+        if loaded:
+            expired = [veh_id for veh_id, doc in self.docs.items() if doc["last_timestamp"] < t - self.window]
+            for veh_id in expired:
+                self.stats.bytes -= sys.getsizeof(self.docs.pop(veh_id))
+            self.stats.evictions += len(expired)
+            self.stats.size = len(self.docs)
+
+
+    def _add(self, doc):
+        old = self.docs.get(doc["_id"])
+        if old is not None:
+            self.stats.bytes -= sys.getsizeof(old)
+        self.docs[doc["_id"]] = doc
+        self.stats.bytes += sys.getsizeof(doc)
+
+
+    def get(self, veh_id, default = None):
+        doc = self.docs.get(veh_id)
+        if doc is None:
+            self.stats.misses += 1
+            return default
+        self.stats.hits += 1
+        return doc
+
+
+    def get_many(self, ids):
+        """
+        Metadata documents of ids. Vehicles not in the loaded windows (e.g. inconsistent
+        timestamps) are queried directly and kept. Ids unknown to the collection are left out
+        return: [document]
+        """
+        found = []
+        missing = []
+        for veh_id in ids:
+            doc = self.get(veh_id)
+            if doc is None:
+                missing.append(veh_id)
+            else:
+                found.append(doc)
+        if missing:
+            for doc in self.veh.find_ids(missing, self.projection):
+                self._add(doc)
+                self.stats.loads += 1
+                found.append(doc)
+            self.stats.size = len(self.docs)
+        return found
+
+
+    def close(self):
+        """
+        Stop the background thread and release the buffer
+        """
+        self._stop.set()
+        self.exhausted = True
+        try:
+            while True:
+                self.buffer.get_nowait()
+        except queue.Empty:
+            pass
+        self._thread.join(timeout=1)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Nov  4 10:07:52 2022
+
+Keyframe index for seeking.
+Every `every` seconds from the first trajectory of a vehicle-indexed collection, the index
+keeps a snapshot of the vehicles active at that time. The snapshot is a window of the vehicle
+table (ids, first_timestamp, last_timestamp sorted by first_timestamp): the vehicles active at
+keyframe k are among the rows from start[k] up to the last one started by then, where start[k]
+is the first row whose trajectory is not over (prefix maximum of last_timestamp).
+
+The index is built from one light column scan (see CollectionBackend.get_columns). A seek is
+then one bounded fetch: the time-indexed documents from t on, and the metadata of the vehicles
+of the snapshot by _id, instead of replaying the collection from t_min.
+
+index = KeyframeIndex(veh, every = 1.0)
+ids = index.active(t)              # vehicles active at t, no query
+"""
+
+import time
+import numpy as np
+from registry import id_list
+
+SCRUB_STEP = 10 # (sec) jump of the scrub keys of the visualizers
+
+
+class KeyframeIndex():
+    """
+    veh: vehicle-indexed collection backend
+    every: (sec) time between keyframes
+    """
+    def __init__(self, veh, every = 1.0):
+        start = time.perf_counter()
+        self.every = every
+        columns = veh.get_columns(["first_timestamp", "last_timestamp", "_id"])
+        self.ids = id_list(columns["_id"])
+        self.first = np.asarray(columns["first_timestamp"], dtype=float)
+        self.last = np.asarray(columns["last_timestamp"], dtype=float)
+        if len(self.ids):
+            self.times = np.arange(self.first[0], self.last.max() + every, every)
+        else:
+            self.times = np.empty(0)
+        # rows before start[k] all ended before keyframe k
+        reach = np.maximum.accumulate(self.last) if len(self.last) else self.last
+        self.start = np.searchsorted(reach, self.times, side="left")
+        self.elapsed = time.perf_counter() - start
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    def keyframe(self, t):
+        """
+        Index of the last keyframe at or before t (0 before the first one)
+        """
+        return max(0, int(np.searchsorted(self.times, t, side="right")) - 1)
+
+
+    def active(self, t_min, t_max = None):
+        """
+        Ids of the vehicles active at some time of [t_min, t_max] (at t_min if t_max is None),
+        from the snapshot of the keyframe of t_min
+        """
+        if t_max is None:
+            t_max = t_min
+        if not len(self.ids):
+            return []
+        k = self.keyframe(t_min)
+        lo = int(self.start[k]) if len(self.times) and self.times[k] <= t_min else 0
+        hi = int(np.searchsorted(self.first, t_max, side="right"))
+        rows = lo + np.flatnonzero(self.last[lo:hi] >= t_min)
+        return [self.ids[r] for r in rows]
+
+
+    def summary(self):
+        return {"keyframes": len(self.times), "every": self.every,
+                "vehicles": len(self.ids), "build_ms": self.elapsed * 1000}
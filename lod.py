@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 31 10:02:37 2022
+
+Level of detail for polylines drawn at a known axis scale.
+A 10 sec time-space window spans a few hundred pixels while trajectories hold
+25 points per second. decimate() keeps, for every pixel column, the first, last,
+lowest and highest point of the line (min/max per pixel, as in the M4 aggregation),
+which draws the same pixels as the full line with at most 4 vertices per column.
+"""
+
+import numpy as np
+
+
+def pixels_per_unit(ax):
+    """
+    Pixels per data unit along the x axis of a matplotlib axis
+    """
+    lo, hi = ax.get_xlim()
+    return ax.bbox.width / abs(hi - lo) if hi != lo else 0.0
+
+
+def decimate(t, x, scale, origin = 0.0):
+    """
+    Points of the polyline (t, x) needed at scale pixels per unit of t
+    t: (N,) increasing abscissa, NaN breaks the line and is always kept
+    x: (N,) ordinate
+    scale: pixels per unit of t, 0 keeps every point
+    origin: t of a pixel boundary, so that successive calls agree on the columns
+    return: (M,) sorted indices of the points to draw
+    """
+    n = len(t)
+    if n <= 4 or scale <= 0:
+        return np.arange(n)
+    t = np.asarray(t, dtype=float)
+    x = np.asarray(x, dtype=float)
+    gap = np.isnan(t) | np.isnan(x)
+    column = np.floor((t - origin) * scale)
+    column[gap] = np.nan # never equal to a neighbour, every gap is its own group
+    new = np.ones(n, dtype=bool)
+    new[1:] = column[1:] != column[:-1]
+    group = np.cumsum(new) - 1
+    firsts = np.flatnonzero(new)
+    lasts = np.append(firsts[1:], n) - 1
+
+    # within each (contiguous) group, points sorted by x: min first, max last
+    order = np.lexsort((np.where(gap, 0, x), group))
+    lows = order[firsts]
+    highs = order[lasts]
+    return np.unique(np.concatenate([firsts, lasts, lows, highs]))
+
+
+class LODStats():
+    """
+    Vertex counts before and after decimation
+    """
+    def __init__(self):
+        self.vertices = 0
+        self.drawn = 0
+
+    def add(self, vertices, drawn):
+        self.vertices += vertices
+        self.drawn += drawn
+
+    def reset(self):
+        self.vertices = self.drawn = 0
+
+    def summary(self):
+        return {"vertices": self.vertices, "drawn": self.drawn,
+                "reduction": self.vertices / self.drawn if self.drawn else 1.0}
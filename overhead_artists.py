@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 17 14:03:51 2022
+
+Persistent matplotlib artists for the overhead views.
+One PolyCollection per layer (GT, raw, reconciled) per axis holds all the vehicle
+boxes of a frame. Every frame only its vertex, color and linewidth arrays are
+replaced, instead of removing and re-adding one Rectangle patch per vehicle.
+"""
+
+import numpy as np
+from matplotlib.collections import PolyCollection
+
+
+def box_vertices(x, y, length, width):
+    """
+    Vertices of axis-aligned boxes
+    x, y: (N,) lower-left corners
+    length, width: (N,) extent along x and y
+    return: (N,4,2) array for PolyCollection.set_verts
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x1 = x + np.asarray(length, dtype=float)
+    y1 = y + np.asarray(width, dtype=float)
+    verts = np.empty((len(x), 4, 2))
+    verts[:, 0, 0] = x
+    verts[:, 0, 1] = y
+    verts[:, 1, 0] = x1
+    verts[:, 1, 1] = y
+    verts[:, 2, 0] = x1
+    verts[:, 2, 1] = y1
+    verts[:, 3, 0] = x
+    verts[:, 3, 1] = y1
+    return verts
+
+
+def centered_corners(x, y, length, width, westbound_y = 60):
+    """
+    Lower-left corners from the positions stored in time-indexed documents
+    y is the lateral center of the vehicle, x is the back bumper for eastbound
+    and the front bumper for westbound (y >= westbound_y) vehicles
+    """
+    x = np.array(x, dtype=float)
+    y = np.asarray(y, dtype=float) - 0.5 * np.asarray(width, dtype=float)
+    west = y >= westbound_y
+    x[west] -= np.asarray(length, dtype=float)[west]
+    return x, y
+
+
+def style_arrays(n, color, fill = True, alpha = 1.0, linewidth = 0):
+    """
+    Broadcast one box style to (N,4) face/edge RGBA arrays and (N,) linewidths
+    color: a single RGB(A) color or an (N,3)/(N,4) array of colors
+    fill: if False, faces are transparent and only the edges are drawn
+    """
+    rgba = np.ones((n, 4))
+    rgba[:, :3] = np.broadcast_to(np.asarray(color, dtype=float)[..., :3], (n, 3))
+    rgba[:, 3] = alpha
+    if fill:
+        return rgba, rgba, np.full(n, linewidth, dtype=float)
+    return np.zeros((n, 4)), rgba, np.full(n, linewidth, dtype=float)
+
+
+class BoxLayer():
+    """
+    One persistent PolyCollection artist holding all boxes of a layer on an axis
+    ax: matplotlib axis to draw on
+    zorder: drawing order among layers (GT below the vehicles)
+    animated: set True when the animation uses blit=True
+    """
+
+    def __init__(self, ax, zorder = 2, animated = False, label = None):
+        self.collection = PolyCollection(np.empty((0, 4, 2)), closed=True,
+                                         zorder=zorder, animated=animated)
+        if label:
+            self.collection.set_label(label)
+        ax.add_collection(self.collection, autolim=False)
+
+
+    def update(self, verts, facecolors, edgecolors = None, linewidths = None):
+        """
+        Replace all boxes of the layer in place
+        verts: (N,4,2) from box_vertices()
+        facecolors, edgecolors: (N,4) RGBA arrays, edgecolors default to facecolors
+        linewidths: (N,) array or scalar
+        """
+        self.collection.set_verts(verts)
+        self.collection.set_facecolor(facecolors)
+        self.collection.set_edgecolor(facecolors if edgecolors is None else edgecolors)
+        if linewidths is not None:
+            self.collection.set_linewidth(linewidths)
+
+
+    def clear(self):
+        self.collection.set_verts(np.empty((0, 4, 2)))
+
+
+    @property
+    def artist(self):
+        return self.collection
@@ -7,7 +7,6 @@ Created on Wed Jun 22 10:22:38 2022
 
 """
 
-from i24_database_api import DBClient
 # from i24_configparse import parse_cfg
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
@@ -17,52 +16,33 @@ from datetime import datetime
 from i24_logger.log_writer import catch_critical
 import queue
 import mplcursors
-from collections import OrderedDict
 import json
 from copy import copy
 import time
 import requests
 import os
-from bson.objectid import ObjectId
+from frame_source import FrameSource, MergedTimeline, MetadataPrefetcher
+from backends import get_backend
+from profiling import StageTimer
+from parallel_export import export_video
+from overhead_artists import BoxLayer, box_vertices, centered_corners, style_arrays
+from registry import VehicleRegistry
+from cache import LRUCache, size_for
+from transform import transform_collection
+from catalog import Catalog
+from playback import PlaybackClock, PlaybackEngine, PlaybackTimeline, RealtimeScheduler, clamp_speed
+from keyframes import KeyframeIndex, SCRUB_STEP
 
  
-class LRUCache:
-    """
-    A least-recently-used cache with integer capacity
-    To roll out of the cache for vehicle color and dimensions
-    get(): return the key-value in cache if exists, otherwise return -1
-    put(): (no update) 
-    """
-    def __init__(self, capacity):
-        self.cache = OrderedDict()
-        self.capacity = capacity
- 
-    def get(self, key):
-        if key not in self.cache:
-            return -1
-        else:
-            self.cache.move_to_end(key)
-            return self.cache[key]
- 
-    def put(self, key, value, update = False):
-        if key not in self.cache: # do not update with new value
-            self.cache[key] = value
-        elif update:
-            self.cache[key] = value
-        self.cache.move_to_end(key)
-        if len(self.cache) > self.capacity:
-            self.cache.popitem(last = False)
-            
-            
-            
-            
 class OverheadCompare():
     """
     compare the overhead views of two collecctions
     """
     
     def __init__(self, config, collections = None,
-                 framerate = 25, x_min = 0, x_max = 1500, offset = None ,duration = 60):
+                 framerate = 25, x_min = 0, x_max = 1500, offset = None ,duration = 60,
+                 chunk_size = 10, read_ahead = 3, tolerance = None, speed = 1.0, resample = False,
+                 realtime = False, snapshot = None, backend = None):
         """
         Initializes a Plotter object
         
@@ -76,32 +56,44 @@ class OverheadCompare():
         framerate: (FPS) rate to query timestamps and to advance the animation
         x_min/x_max: (feet) roadway range for overhead view
         duration: (sec) duration for animation
+        chunk_size: (sec) amount of time-indexed data, and of vehicle metadata, fetched per query
+        read_ahead: number of chunks buffered ahead of playback per collection
+        tolerance: (sec) max timestamp difference for aligning documents of different collections into one frame, default half a frame
+        speed: playback speed, data seconds per second of display (0.25 to 16), see playback.py. Requires resample
+        resample: interpolate positions at the display times. Off by default, every frame is then the next stored document
+        realtime: keep a shown animation on the wall clock, frames already late are dropped (see playback.RealtimeScheduler). Requires resample
+        snapshot: path to a directory written by snapshot.export_snapshot(). If given, replay from it without database access
+        backend: data backend (see backends.py), overrides config and snapshot. MongoDB with config by default
         """
+        if realtime and not resample:
+            raise ValueError("realtime=True requires resample=True")
         list_dbr = [] # time indexed
         list_veh = [] # vehicle indexed
         list_db = ["trajectories", "trajectories", "reconciled"] # gt, raw, rec
-        trans = DBClient(**config, database_name = "transformed")
-        transformed_collections = trans.list_collection_names()
+        self.backend = get_backend(config, backend, snapshot)
+        self.catalog = Catalog(self.backend) # no round trip for known collections
         
         # first collection is GT
         for i,collection in enumerate(collections):
-            dbr = DBClient(**config, database_name = "transformed", collection_name=collection)
-            veh = DBClient(**config, database_name = list_db[i], collection_name=collection)
-            dbr.create_index("timestamp")
+            if not self.catalog.exists("transformed", collection):
+                # print("Transform ", collection)
+                transform_collection(self.backend, list_db[i], collection, framerate=framerate or 25)
+                self.catalog.invalidate("transformed", collection)
+            dbr = self.catalog.collection("transformed", collection)
+            veh = self.catalog.collection(list_db[i], collection)
+            self.catalog.ensure_index("transformed", collection, "timestamp")
             list_dbr.append(dbr)
             list_veh.append(veh)
             
-            if collection not in transformed_collections:
-                # print("Transform ", collection)
-                veh.transform()
-            
         
         if len(list_dbr) == 0:
             raise Exception("at least one collection must be specified.")
         
         # get plotting ranges
-        t_min = max([dbr.get_min("timestamp") for dbr in list_dbr])
-        t_max = min([dbr.get_max("timestamp") for dbr in list_dbr])
+        ranges = [self.catalog.range("transformed", collection, "timestamp") for collection in collections]
+        self.catalog.check()
+        t_min = max([r[0] for r in ranges])
+        t_max = min([r[1] for r in ranges])
         if offset:
             t_min += offset  
         if duration: 
@@ -126,17 +118,48 @@ class OverheadCompare():
         
         self.list_dbr =  list_dbr
         self.list_veh = list_veh
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        self.tolerance = tolerance if tolerance is not None else 0.5/self.framerate
+        self.speed = clamp_speed(speed) if resample else 1.0
+        self.resample = resample
+        self.realtime = realtime
+        self.clock = None
+        self.scheduler = None
+        self.frame_sources = []
+        self.meta_sources = []
+        self.keyframes = None # raw and reconciled, built on the first seek
+        self.time = t_min # (sec) time of the last frame
+        self.paused = False
+        self.timer = StageTimer() # per-frame stage timing, see benchmark.py
+        
+        # data source arguments, to reconnect in the export workers
+        self.config = config
+        self.collections = collections
+        self.snapshot = snapshot
+        self.backend_arg = backend
     
 
         
     @catch_critical(errors = (Exception))
-    def animate(self, save = False, upload = False, extra=""):
+    def animate(self, save = False, upload = False, extra="", render_mode = "patches", blit = False, show = True):
         """
         Advance time window by delta second, update left and right pointer, and cache
+        render_mode: "patches" re-creates one Rectangle per vehicle per frame (hover labels on pause),
+                     "collection" keeps one persistent PolyCollection per layer per axis and updates it in place
+        blit: only redraw the vehicle layers every frame, lanes are drawn once. Requires render_mode="collection"
+        show: if False, set up the figure and animation and return it without showing or saving (headless driving)
         """     
+        if render_mode not in ("patches", "collection"):
+            raise ValueError("render_mode must be either 'patches' or 'collection'")
+        if blit and render_mode != "collection":
+            raise ValueError("blit=True requires render_mode='collection'")
+            
         # set figures: two rows. Top: dbr1 (ax_o), bottom: dbr2 (ax_o2). 4 lanes in each direction
         num = len(self.list_dbr)-1
         fig, axs = plt.subplots(num,1,figsize=(16,3*num))
+        axs = np.atleast_1d(axs)
+        self.fig = fig
         self.labels = None
         
         def on_xlims_change(event_ax):
@@ -148,7 +171,7 @@ class OverheadCompare():
             
         # OVERHEAD VIEW SETUP
         for i,ax in enumerate(axs):
-            ax.set_title(self.list_veh[i+1].collection._Collection__name)
+            ax.set_title(self.list_veh[i+1].name)
             ax.set_aspect('equal', 'box')
             ax.set(ylim=[self.lanes[0], self.lanes[-1]])
             ax.set(xlim=[self.x_start, self.x_end])
@@ -156,30 +179,30 @@ class OverheadCompare():
             ax.set_xlabel("Distance in feet")
             # ax.callbacks.connect('xlim_changed', on_xlims_change)
       
-        self.time_cursor = self.list_dbr[0].get_range("timestamp", self.t_min, self.t_max)
+        # one read-ahead source per collection, merged into a single timeline that drives the animation
+        self.frame_sources, self.timeline = self.open_timeline()
+        # a saved video keeps every frame
+        self.scheduler = RealtimeScheduler(self.clock) if self.realtime and not save else None
+        # vehicle metadata of raw and reconciled, fetched one time window at a time ahead of playback
+        self.meta_sources = self.open_metadata(self.t_min)
+        self.time = self.t_min
+        self.blit = blit
         # plt.gcf().autofmt_xdate()
         
         
         @catch_critical(errors = (Exception))
         def init():
             # initialize caches
-            self.by_label = LRUCache(10)
-            self.veh_cache =  [LRUCache(400) for _ in self.list_dbr]
+            self.by_label = LRUCache(10, name="legend")
+            # one registry per collection: vehicle id -> slot in arrays of dimensions, stitched flag and color
+            self.registries = [VehicleRegistry(name=veh.name) for veh in self.list_veh]
             # NIXIPIN
-            gt_query = self.list_veh[0].collection.aggregate([
-                {"$match": {"$and" : [{"first_timestamp": {"$lte": self.t_max}},{"last_timestamp": {"$gte": self.t_min}}]}},
-                {'$project':{ 'width':1, 'length':1}}])
-            for doc in gt_query:
-                val = {"dim": [doc["length"], doc["width"]],
-                       "kwargs": {
-                            "color": [0.8]*3, # light grey
-                           # "color": np.random.rand(3,)*0.5,
-                           "fill": True
-                           # "label": "GT"}
-                           }
-                       }
-
-                self.veh_cache[0].put(doc["_id"], val, update=False)
+            gt_docs = list(self.list_veh[0].find_active(self.t_min, self.t_max, {'width':1, 'length':1, 'last_timestamp':1}))
+            self.registries[0].reserve(size_for(len(gt_docs), headroom=1))
+            slots, _ = self.registries[0].intern([doc["_id"] for doc in gt_docs])
+            self.registries[0].set(slots, length=[doc["length"] for doc in gt_docs], 
+                                   width=[doc["width"] for doc in gt_docs],
+                                   last_seen=[doc["last_timestamp"] for doc in gt_docs])
                 
             # plot lanes on overhead view
             for ax in axs:  
@@ -189,71 +212,150 @@ class OverheadCompare():
                     else:
                         ax.axhline(y=i*12, linewidth=0.1, color='k')
             
+            if render_mode == "collection":
+                # persistent artists: GT below the vehicles of each collection
+                self.gt_layers = [BoxLayer(ax, zorder=2, animated=blit) for ax in axs]
+                self.veh_layers = [BoxLayer(ax, zorder=3, animated=blit) for ax in axs]
+                self.time_text = axs[0].text(0.01, 0.9, "", transform=axs[0].transAxes, 
+                                             fontsize=14, animated=blit)
+                stitched = patches.Patch(edgecolor=[0,1,0], fill=False, linewidth=2, label="merged/stitched")
+                for ax in axs:
+                    ax.legend(handles=[stitched], loc='lower right', bbox_to_anchor=(1, 1))
+                return self.layer_artists()
 
             return axs,
               
 
+        def register(i, d, slot):
+            """
+            Stitched flag (and for reconciled, dimensions) of a vehicle-indexed document of collection i+1
+            """
+            reg = self.registries[i+1]
+            if "fragment_ids" in d and len(d["fragment_ids"]) > 1: 
+                reg.stitched[slot] = True
+            if i == 1: # do not use width and length of raw, cause they are arrays
+                reg.set(slot, length=d["length"], width=d["width"])
+        
+        
         @catch_critical(errors = (Exception))
-        def update_cache(curr_time):
+        def update_cache(docs, curr_time):
             """
-            Update the cache for each collection (except for GT)
+            Update the registry of each collection (except for GT) from the prefetched metadata
+            docs: time-indexed documents of the current frame, one per collection (except for GT)
+            curr_time: timestamp of the frame
+            return: slots of the vehicles of each document, None for missing documents
             """
-            # update cache by new queries
-            for i, dbr in enumerate(self.list_dbr[1:]):
-                doc = dbr.find_one("timestamp", curr_time)
+            # vehicles that left the scene give their slots back
+            self.registries[0].expire(curr_time - self.chunk_size)
+            frame_slots = []
+            for i, doc in enumerate(docs):
                 if not doc:
-                    doc = {"id": [], "position":[], "dimensions":[]}
-                if i == 1: # do not query for width and length, cause they are arrays
-                    query = self.list_veh[i+1].collection.find({"_id": {"$in": doc["id"]} }, 
-                                               {"width":1, "length":1, "feasibility": 1, "fragment_ids": 1, "merged_ids": 1})
-                else:
-                    query = self.list_veh[i+1].collection.find({"_id": {"$in": doc["id"]} }, 
-                                               {"feasibility": 1, "fragment_ids": 1, "merged_ids": 1})
-                for d in query:
-                    if "fragment_ids" in d and len(d["fragment_ids"]) > 1: # stitched
-                        kwargs = {
-                            "color": [0,1,0], # green
-                            "fill": False,
-                            "linewidth": 2,
-                            "label": "merged/stitched",
-                            # "label": d["_id"]
-                            }
-                    else:
-                        kwargs = {
-                            "color": np.random.rand(3,)*0.5,
-                            "fill": True,
-                            "linewidth": 0,
-                            "alpha": 0.7,
-                            # "label": "stitched",
-                            # "label": d["_id"]
-                            }
-                    if i == 1:
-                        val = {"dim": [d["length"], d["width"]],
-                               "kwargs": kwargs,
-                              } 
-                    else:
-                        val = {"kwargs": kwargs} 
-                    self.veh_cache[i+1].put(d["_id"], val, update=False)
+                    frame_slots.append(None)
+                    continue
+                reg = self.registries[i+1]
+                reg.expire(curr_time - self.chunk_size)
+                meta = self.meta_sources[i]
+                meta.advance(curr_time)
+                reg.reserve(size_for(len(meta.docs)))
+                slots, new = reg.intern(doc["id"], curr_time)
+                if new.any():
+                    for d in meta.get_many([reg.ids[slot] for slot in slots[new]]):
+                        register(i, d, reg.slots[d["_id"]])
+                frame_slots.append(slots)
+            return frame_slots
                     
                     
+        def frame_dimensions(i, doc, slots):
+            """
+            (N,2) length and width of the vehicles of a frame document of collection i (0 is GT)
+            """
+            if i == 0:
+                return self.registries[0].dimensions(self.registries[0].lookup(doc["id"]), doc.get("dimensions"))
+            if i == 2:
+                return self.registries[2].dimensions(slots, doc.get("dimensions"))
+            return np.asarray([dim[:2] for dim in doc["dimensions"]], dtype=float)
+        
+        
+        def update_layers(doc0, docs, frame_slots):
+            """
+            Vectorized drawing: rebuild the vertex and color arrays of each layer from the frame documents
+            """
+            # GT is drawn identically on every axis
+            n = len(doc0["id"])
+            if n:
+                pos = np.asarray(doc0["position"], dtype=float)
+                dims = frame_dimensions(0, doc0, None)
+                x, y = centered_corners(pos[:,0], pos[:,1], dims[:,0], dims[:,1])
+                verts = box_vertices(x, y, dims[:,0], dims[:,1])
+            else:
+                verts = np.empty((0,4,2))
+            face, edge, lw = style_arrays(n, [0.8]*3) # light grey
+            for layer in self.gt_layers:
+                layer.update(verts, face, edge, lw)
+                
+            for i, doc in enumerate(docs):
+                if not doc or len(doc["id"]) == 0:
+                    self.veh_layers[i].clear()
+                    continue
+                n = len(doc["id"])
+                slots = frame_slots[i]
+                reg = self.registries[i+1]
+                pos = np.asarray(doc["position"], dtype=float)
+                dims = frame_dimensions(i+1, doc, slots)
+                x, y = centered_corners(pos[:,0], pos[:,1], dims[:,0], dims[:,1])
+                verts = box_vertices(x, y, dims[:,0], dims[:,1])
+                
+                # filled dark random color, or a green outline for stitched vehicles
+                stitched = reg.stitched[slots]
+                edge = np.empty((n,4))
+                edge[:,:3] = reg.color[slots] * 0.5
+                edge[:,3] = 0.7
+                edge[stitched] = [0,1,0,1] # green
+                face = edge.copy()
+                face[stitched] = 0
+                lw = np.where(stitched, 2.0, 0.0)
+                self.veh_layers[i].update(verts, face, edge, lw)
+                
+                
         @catch_critical(errors = (Exception))    
         def update_plot(frame):
             '''
             Advance time cursor and update the artist
             '''
+            if self.scheduler is not None and not self.paused:
+                self.scheduler.sync() # skip the frames already late, not those stepped to while paused
             # Stop criteria
             try:
-                doc0 = self.time_cursor.next()
+                with self.timer.stage("fetch"):
+                    record = self.timeline.next()
             except StopIteration:
                 print("Reach the end of time. Exit.")
-                return
+                print("Frames without data per collection: ", self.timeline.missing)
+                self.anim.event_source.stop() # until a seek
+                return []
+            if self.scheduler is not None and not self.paused:
+                # fire again when the next frame is due
+                self.anim.event_source.interval = max(1, int(self.scheduler.wait() * 1000))
             
             # Update title
-            curr_time = doc0["timestamp"]
+            curr_time = record["timestamp"]
+            self.time = curr_time
             time_text = datetime.utcfromtimestamp(int(curr_time)).strftime('%m/%d/%Y, %H:%M:%S')
-            plt.suptitle(time_text, fontsize = 20)
             
-            update_cache(curr_time)
+            # frames where GT has no document still draw the other collections
+            doc0 = record["docs"][0] or {"id": [], "position":[], "dimensions":[]}
+            docs = record["docs"][1:]
+            with self.timer.stage("cache"):
+                frame_slots = update_cache(docs, curr_time)
+            
+            if render_mode == "collection":
+                with self.timer.stage("geometry"):
+                    self.time_text.set_text(time_text)
+                    update_layers(doc0, docs, frame_slots)
+                return self.layer_artists()
+            
+            start = time.perf_counter()
+            plt.suptitle(time_text, fontsize = 20)
             
             # remove all car_boxes and verticle lines
             for ax in axs:
@@ -264,48 +366,46 @@ class OverheadCompare():
                 self.annot_queue.get(block=False).remove()
              
             # plot GT
+            dims = frame_dimensions(0, doc0, None)
             for index in range(len(doc0["position"])):
                 car_x_pos = doc0["position"][index][0]
                 car_y_pos = doc0["position"][index][1]
-
-                # print("** ",cache_vehicle.get(doc0["id"][index]))
-                # print("*** ", len(self.veh_cache[0].cache))
-                # print(len(cache_colors.cache))
-                # print(doc0["id"][index])
-                # print(doc0["id"][index] in self.veh_cache[0].cache.keys())
-                gt_d = self.veh_cache[0].get(doc0["id"][index])
-                car_length, car_width = gt_d["dim"]
+                car_length, car_width = dims[index]
                 car_y_pos -= 0.5 * car_width
                 if car_y_pos >= 60: # west bound
                     car_x_pos -= car_length
                     
                 box = patches.Rectangle(xy = (car_x_pos, car_y_pos),
                                         width = car_length, height=car_width,
-                                        **gt_d["kwargs"]) # light grey
+                                        color = [0.8]*3, fill = True) # light grey
                 for i in range(num):
                     axs[i].add_patch(copy(box)) 
                     
                     
             # plot vehicles
-            for i, dbr in enumerate(self.list_dbr[1:]):
-                doc = dbr.find_one("timestamp", curr_time)
+            for i, doc in enumerate(docs):
                 if doc is None:
                     continue
+                reg = self.registries[i+1]
+                slots = frame_slots[i]
+                dims = frame_dimensions(i+1, doc, slots)
+                stitched = reg.stitched[slots]
+                colors = reg.color[slots] * 0.5
                 for index in range(len(doc["position"])):
                     car_x_pos = doc["position"][index][0]
                     car_y_pos = doc["position"][index][1]
-                    d = self.veh_cache[i+1].get(doc["id"][index])
-                    try: # i==1
-                        car_length, car_width = d["dim"]
-                    except: #i = 0
-                        car_length, car_width = doc['dimensions'][index][:2]
+                    car_length, car_width = dims[index]
                     car_y_pos -= 0.5 * car_width
                     if car_y_pos >= 60: # west bound
                         car_x_pos -= car_length
-                
+                    
+                    if stitched[index]:
+                        kwargs = {"color": [0,1,0], "fill": False, "linewidth": 2, "label": "merged/stitched"} # green
+                    else:
+                        kwargs = {"color": colors[index], "fill": True, "linewidth": 0, "alpha": 0.7}
                     box = patches.Rectangle(xy = (car_x_pos, car_y_pos),
                                             width = car_length, height=car_width,
-                                            **d["kwargs"])
+                                            **kwargs)
                 
                     axs[i].add_patch(box)   
                     # add annotation
@@ -320,57 +420,238 @@ class OverheadCompare():
                 for i,label in enumerate(labels):
                     self.by_label.put(label, handles[i], update=True)
                 for i in range(num):
-                    axs[i].legend(self.by_label.cache.values(), self.by_label.cache.keys(), loc='lower right', bbox_to_anchor=(1, 1))
+                    axs[i].legend(self.by_label.values(), self.by_label.keys(), loc='lower right', bbox_to_anchor=(1, 1))
             except:
                 pass
             
+            self.timer.add("geometry", time.perf_counter() - start)
             return axs
         
         frame = None
         self.anim = animation.FuncAnimation(fig, func=update_plot,
                                             init_func= init,
-                                            frames=int(self.t_max-self.t_min)*self.framerate,
+                                            # shown: until the data ends, whatever the speed changes
+                                            frames=None if show and not save else self.frame_count(),
                                             repeat=False,
                                             interval=1/self.framerate * 1000, # in ms
                                             fargs=(frame ),
-                                            blit=False,
+                                            blit=blit,
                                             cache_frame_data = False,
                                             save_count = 1)
         self.paused = False
         fig.canvas.mpl_connect('key_press_event', self.toggle_pause)
-
+        self.init_frame = init
+        self.update_frame = update_plot
+        if not show:
+            return self.anim
         
         if save:
-            now = datetime.utcfromtimestamp(int(time.time())).strftime('%Y-%m-%d_%H-%M-%S')
-            file_name = now+"_" + self.list_veh[2].collection._Collection__name +extra+".mp4"
+            file_name = self.video_name(extra)
             print(file_name)
             self.anim.save(file_name, writer='ffmpeg', fps=self.framerate)
             # self.anim.save('{}.gif'.format(file_name), writer='imagemagick', fps=self.framerate)
             print("saved.")
             
             if upload:
-                url = 'http://viz-dev.isis.vanderbilt.edu:5991/upload?type=video'
-                files = {'upload_file': open(file_name,'rb')}
-                ret = requests.post(url, files=files)
-                if ret.status_code == 200:
-                    print('Uploaded!')
+                self.upload(file_name)
         
         
         else:
             fig.tight_layout()
             plt.show()
+            
+        self.close_sources()
+        for stats in self.cache_stats():
+            print("cache {name}: {hits} hits, {misses} misses, {evictions} evictions, {size}/{capacity} entries, {bytes} bytes".format(**stats))
+        if self.scheduler is not None:
+            print("realtime: {frames} frames, {dropped} dropped, lag {mean_lag_ms:.1f} ms mean, {max_lag_ms:.1f} ms max".format(**self.scheduler.summary()))
         print("complete")
         
 
 
     
+    def frame_count(self, speed = None):
+        """
+        Number of frames of the animation at speed, the playback speed by default
+        """
+        return int((self.t_max-self.t_min) / (speed or self.speed) * self.framerate)
+    
+    
+    def open_timeline(self):
+        """
+        One frame source per collection and the timeline that merges them
+        resample: engines interpolating at the times of one clock (see playback.py), else stored documents
+        return: (sources, timeline)
+        """
+        if not self.resample:
+            sources = [FrameSource(dbr, self.t_min, self.t_max, 
+                                   chunk_size=self.chunk_size, read_ahead=self.read_ahead) for dbr in self.list_dbr]
+            return sources, MergedTimeline(sources, tolerance=self.tolerance)
+        self.clock = PlaybackClock(self.t_min, self.t_max, self.framerate, self.speed)
+        # the catalog knows the sample interval of each collection, no query needed
+        sources = [PlaybackEngine(dbr, self.clock, interval=self.catalog.sample_interval("transformed", collection),
+                                  chunk_size=self.chunk_size, read_ahead=self.read_ahead)
+                   for dbr, collection in zip(self.list_dbr, self.collections)]
+        return sources, PlaybackTimeline(sources, self.clock)
+    
+    
+    def open_metadata(self, t, active = None):
+        """
+        Metadata prefetchers of raw and reconciled from time t
+        active: ids of the vehicles active in the first window per collection, queried if None
+        """
+        projection = {"width":1, "length":1, "feasibility": 1, "fragment_ids": 1, "merged_ids": 1}
+        active = active or [None] * (len(self.list_veh) - 1)
+        return [MetadataPrefetcher(veh, t, self.t_max, window=self.chunk_size, read_ahead=self.read_ahead,
+                                   projection=projection, active=ids) for veh, ids in zip(self.list_veh[1:], active)]
+    
+    
+    def keyframe_index(self):
+        """
+        Keyframe index of raw and reconciled (see keyframes.py), built on the first call
+        """
+        if self.keyframes is None:
+            self.keyframes = [KeyframeIndex(veh) for veh in self.list_veh[1:]]
+            print("keyframes: ", [index.summary() for index in self.keyframes])
+        return self.keyframes
+    
+    
+    def seek(self, t):
+        """
+        Make t (sec, clamped to [t_min, t_max]) the time of the next frame, redrawn at once when paused
+        The documents are fetched from t on, and when t is far from the current frame the metadata of
+        the vehicles active at t is fetched by _id from the keyframe snapshots. Nothing is replayed from t_min
+        """
+        t = min(max(t, self.t_min), self.t_max)
+        if self.clock is not None:
+            self.clock.seek(t) # the engines reopen their sources on a jump
+        else:
+            for src in self.frame_sources:
+                src.close()
+            # from the stored documents nearest to t
+            self.frame_sources = [FrameSource(dbr, t - self.tolerance, self.t_max, chunk_size=self.chunk_size, 
+                                              read_ahead=self.read_ahead) for dbr in self.list_dbr]
+            self.timeline = MergedTimeline(self.frame_sources, tolerance=self.tolerance)
+        # near the current frame, the loaded metadata and get_many() cover the vehicles
+        if abs(t - self.time) > self.chunk_size:
+            indexes = self.keyframe_index()
+            for meta in self.meta_sources:
+                meta.close()
+            self.meta_sources = self.open_metadata(t, [index.active(t, t + self.chunk_size) for index in indexes])
+        self.time = t
+        if self.paused:
+            self.redraw(self.update_frame(None))
+        elif self.anim is not None:
+            self.anim.event_source.start() # stopped at the end of the data
+    
+    
+    def step(self, n = 1):
+        """
+        Move n frames forward (backward if n < 0) from the current frame
+        """
+        step = self.clock.step if self.clock is not None else 1 / self.framerate
+        self.seek(self.time + n * step)
+    
+    
+    def redraw(self, artists):
+        """
+        Draw a frame computed outside of the animation loop (while paused)
+        """
+        canvas = self.fig.canvas
+        if not self.blit:
+            canvas.draw_idle()
+            return
+        # animated artists are left out of a full draw
+        canvas.draw()
+        for artist in artists or []:
+            artist.axes.draw_artist(artist)
+        canvas.blit(self.fig.bbox)
+    
+    
+    def set_speed(self, speed):
+        """
+        Change the playback speed of a running animation, see playback.MIN_SPEED and MAX_SPEED
+        """
+        if self.clock is None:
+            return self.speed
+        self.speed = self.clock.set_speed(speed)
+        print("speed {}x".format(self.speed))
+        return self.speed
+    
+    
+    def close_sources(self):
+        """
+        Stop the read-ahead threads of the last animation
+        """
+        for src in self.frame_sources + self.meta_sources:
+            src.close()
+    
+    
+    def cache_stats(self):
+        """
+        Counters of the collection catalog, the vehicle registries, the metadata prefetchers and the legend cache of the last animation
+        """
+        out = [self.catalog.summary()] + [reg.summary() for reg in getattr(self, "registries", [])]
+        out += [meta.stats.summary() for meta in self.meta_sources]
+        if hasattr(self, "by_label"):
+            out.append(self.by_label.summary())
+        return out
+    
+    
+    def export(self, extra = "", upload = False, workers = None, chunk_duration = None, render_mode = "collection"):
+        """
+        Save the video like animate(save=True), rendering time chunks in parallel worker processes
+        workers: number of processes, all cores by default
+        chunk_duration: (sec) length of each segment, default is 2 segments per worker
+        render_mode: see animate()
+        """
+        file_name = self.video_name(extra)
+        print(file_name)
+        export_video(self, file_name, workers=workers, chunk_duration=chunk_duration, render_mode=render_mode)
+        print("saved.")
+        if upload:
+            self.upload(file_name)
+        return file_name
+    
+    
+    def video_name(self, extra = ""):
+        now = datetime.utcfromtimestamp(int(time.time())).strftime('%Y-%m-%d_%H-%M-%S')
+        return now+"_" + self.list_veh[2].name +extra+".mp4"
+    
+    
+    def upload(self, file_name):
+        url = 'http://viz-dev.isis.vanderbilt.edu:5991/upload?type=video'
+        files = {'upload_file': open(file_name,'rb')}
+        ret = requests.post(url, files=files)
+        if ret.status_code == 200:
+            print('Uploaded!')
+    
+    
+    def layer_artists(self):
+        """
+        Artists redrawn every frame in render_mode="collection"
+        """
+        return [layer.artist for layer in self.gt_layers + self.veh_layers] + [self.time_text]
+    
+    
     def toggle_pause(self, event):
         """
-        press spacebar to pause/resume animation
+        press spacebar to pause/resume animation, +/- to double/halve the playback speed,
+        right/left to step one frame while paused, up/down to scrub SCRUB_STEP sec, home/end to jump
         """
         printed = set()
+        if event.key in ("+", "=", "-"):
+            self.set_speed(self.speed * (0.5 if event.key == "-" else 2))
+        if self.paused and event.key in ("right", "left"):
+            self.step(1 if event.key == "right" else -1)
+        if event.key in ("up", "down"):
+            self.seek(self.time + (SCRUB_STEP if event.key == "up" else -SCRUB_STEP))
+        if event.key in ("home", "end"):
+            self.seek(self.t_min if event.key == "home" else self.t_max - 1 / self.framerate)
         if event.key == " ":
             if self.paused:
+                if self.scheduler is not None:
+                    self.scheduler.rebase() # the pause is not lag
                 self.anim.resume()
                 # print("Animation Resumed")
                 self.cursor.remove()
@@ -394,7 +675,7 @@ class OverheadCompare():
     
 
 def main(rec, gt = "groundtruth_scene_2_57", framerate = 25, x_min=-100, x_max=2200, offset=0, duration=90, 
-         save=False, upload=False, extra=""):
+         save=False, upload=False, extra="", workers=None):
     
     with open(os.path.join(os.environ["USER_CONFIG_DIRECTORY"], "db_param.json")) as f:
         db_param = json.load(f)
@@ -404,7 +685,10 @@ def main(rec, gt = "groundtruth_scene_2_57", framerate = 25, x_min=-100, x_max=2
     p = OverheadCompare(db_param, 
                 collections = [gt, raw, rec],
                 framerate = framerate, x_min = x_min, x_max=x_max, offset = offset, duration=duration)
-    p.animate(save=save, upload=upload, extra=extra)
+    if save and workers:
+        p.export(extra=extra, upload=upload, workers=workers)
+    else:
+        p.animate(save=save, upload=upload, extra=extra)
     
     
 if __name__=="__main__":
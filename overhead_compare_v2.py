@@ -5,59 +5,86 @@ Created on Sun Sep 18 12:27:36 2022
 
 @author: zitest
 
+OpenCV version of overhead_compare.py: GT, raw and reconciled vehicles are rasterized
+with NumPy/OpenCV into a preallocated uint8 frame and optionally published to a
+web server with Flask.
+
 TODOs: 
-    1. Attempt to speed up overhead_compare.py by utilizing openCV's plotting API
-    2. Attempt to publish visualization to a web server by utilizing Flask(?) Bokeh(?)
+    1. Attempt to publish visualization to a web server by utilizing Flask(?) Bokeh(?)
 
 """
 
-from i24_database_api import DBClient
+from backends import get_backend
+from profiling import StageTimer
+from frame_source import FrameSource, MergedTimeline, MetadataPrefetcher
+from overhead_artists import box_vertices, centered_corners
+from streaming import FrameHub, VehicleFrameHub
+from registry import VehicleRegistry, id_list
+from cache import size_for
+from transform import transform_collection
+from catalog import Catalog
+from playback import PlaybackClock, PlaybackEngine, PlaybackTimeline, RealtimeScheduler, clamp_speed
+from keyframes import KeyframeIndex, SCRUB_STEP
 from datetime import datetime
 from flask import Response
 from flask import Flask
 from flask import render_template
+from flask import jsonify
+from flask import request
 import numpy as np
 import threading
 import time
 import json
 import cv2
 
-outputFrame = None
-lock = threading.Lock()
-
 class OverheadCompareV2():
     """
     compare the overhead views of two collecctions
     """
     
     def __init__(self, config, collections = None,
-                 framerate = 25, x_min = 0, x_max = 1500, offset = None ,duration = 60):
-        
+                 framerate = 25, x_min = 0, x_max = 1500, offset = None ,duration = 60,
+                 chunk_size = 10, read_ahead = 3, tolerance = None, speed = 1.0, resample = False,
+                 realtime = False, snapshot = None, backend = None):
+        """
+        chunk_size: (sec) amount of time-indexed data, and of vehicle metadata, fetched per query
+        read_ahead: number of chunks buffered ahead of playback per collection
+        tolerance: (sec) max timestamp difference for aligning documents of different collections into one frame, default half a frame
+        speed: playback speed, data seconds per second of display (0.25 to 16), see playback.py. Requires resample
+        resample: interpolate positions at the display times. Off by default, every frame is then the next stored document
+        realtime: keep live playback (window or stream) on the wall clock, frames already late are neither fetched nor drawn (see playback.RealtimeScheduler). Requires resample
+        snapshot: path to a directory written by snapshot.export_snapshot(), replay from it without database access
+        backend: data backend (see backends.py), overrides config and snapshot
+        """
+        if realtime and not resample:
+            raise ValueError("realtime=True requires resample=True")
         list_dbr = [] # time indexed
         list_veh = [] # vehicle indexed
         list_db = ["trajectories", "trajectories", "reconciled"] # gt, raw, rec
-        trans = DBClient(**config, database_name = "transformed")
-        transformed_collections = trans.list_collection_names()
+        self.backend = get_backend(config, backend, snapshot)
+        self.catalog = Catalog(self.backend) # no round trip for known collections
         
         # first collection is GT
         for i,collection in enumerate(collections):
-            dbr = DBClient(**config, database_name = "transformed", collection_name=collection)
-            veh = DBClient(**config, database_name = list_db[i], collection_name=collection)
-            dbr.create_index("timestamp")
+            if not self.catalog.exists("transformed", collection):
+                # print("Transform ", collection)
+                transform_collection(self.backend, list_db[i], collection, framerate=framerate or 25)
+                self.catalog.invalidate("transformed", collection)
+            dbr = self.catalog.collection("transformed", collection)
+            veh = self.catalog.collection(list_db[i], collection)
+            self.catalog.ensure_index("transformed", collection, "timestamp")
             list_dbr.append(dbr)
             list_veh.append(veh)
             
-            if collection not in transformed_collections:
-                # print("Transform ", collection)
-                veh.transform()
-            
         
         if len(list_dbr) == 0:
             raise Exception("at least one collection must be specified.")
         
         # get plotting ranges
-        t_min = max([dbr.get_min("timestamp") for dbr in list_dbr])
-        t_max = min([dbr.get_max("timestamp") for dbr in list_dbr])
+        ranges = [self.catalog.range("transformed", collection, "timestamp") for collection in collections]
+        self.catalog.check()
+        t_min = max([r[0] for r in ranges])
+        t_max = min([r[1] for r in ranges])
         if offset:
             t_min += offset  
         if duration: 
@@ -77,119 +104,470 @@ class OverheadCompareV2():
         self.lane_idx = [i for i in range(12)]
         self.lane_ax = [[1,5],[1,4],[1,3],[1,2],[1,1],[1,0],[0,0],[0,1],[0,2],[0,3],[0,4],[0,5]]
         
-        # self.annot_queue = queue.Queue()
-        # self.cursor = None
-        
-        # self.list_dbr =  list_dbr
-        # self.list_veh = list_veh
+        self.list_dbr =  list_dbr
+        self.list_veh = list_veh
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        self.tolerance = tolerance if tolerance is not None else 0.5/self.framerate
+        self.speed = clamp_speed(speed) if resample else 1.0
+        self.resample = resample
+        self.realtime = realtime
+        self.collections = collections
+        self.clock = None
+        self.scheduler = None
+        self.frame_sources = []
+        self.meta_sources = []
+        self.keyframes = None # raw and reconciled, built on the first seek
+        self.time = t_min # (sec) time of the last frame
+        self.paused = False
+        self.seeked = False # a seek since the last frame
         
         self.window_w = 1200
         self.window_h = 600
+        self.timer = StageTimer() # per-frame stage timing, see benchmark.py
+        
+        # vehicle styles in BGR. Vehicles get one of a few dark colors so that all boxes
+        # of a color are filled in one call
+        self.gt_color = (204, 204, 204) # light grey
+        self.stitched_color = (0, 255, 0) # green outline
+        self.palette = [tuple(int(c) for c in color) for color in np.random.default_rng(0).random((16, 3)) * 128]
+        self.registries = [VehicleRegistry(name=veh.name) for veh in list_veh] # dimensions, stitched flag and palette index by vehicle id
+        
+        self.setup_canvas()
+        
+        
+    def setup_canvas(self):
+        """
+        Precompute the world-to-pixel affine of each panel and pre-render the lane background
+        One panel per compared collection (all but GT), stacked vertically
+        """
+        num = max(1, len(self.list_dbr)-1)
+        left, right, top, bottom = 60, 10, 24, 40 # (px) margins, top holds the panel title
+        panel_h = (self.window_h - bottom) / num
+        y_lo, y_hi = self.lanes[0], self.lanes[-1]
+        
+        self.panels = [] # [(affine, (row0, row1, col0, col1))]
+        for k in range(num):
+            col0, col1 = left, self.window_w - right
+            row0, row1 = k * panel_h + top, (k+1) * panel_h - 4
+            sx = (col1 - col0) / (self.x_end - self.x_start)
+            sy = (row1 - row0) / (y_hi - y_lo)
+            # [col, row] = affine @ [x, y, 1], y axis points up as in overhead_compare.py
+            affine = np.array([[sx, 0, col0 - self.x_start * sx],
+                               [0, -sy, row1 + y_lo * sy]])
+            self.panels.append((affine, (int(row0), int(row1), int(col0), int(col1))))
+        
+        self.background = np.full(shape=(self.window_h, self.window_w, 3), fill_value=255, dtype=np.uint8)
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        for k, (affine, (row0, row1, col0, col1)) in enumerate(self.panels):
+            name = self.list_veh[k+1].name if k+1 < len(self.list_veh) else self.list_veh[0].name
+            cv2.putText(self.background, name, (col0, row0 - 6), font, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
+            for i in range(-1, 12):
+                row = int(round(affine[1,1] * i*12 + affine[1,2]))
+                if i in (-1, 5, 11):
+                    cv2.line(self.background, (col0, row), (col1, row), (0, 0, 0), 1)
+                else:
+                    cv2.line(self.background, (col0, row), (col1, row), (180, 180, 180), 1)
+            for i in self.lane_idx:
+                row = int(round(affine[1,1] * (i*12+6) + affine[1,2]))
+                cv2.putText(self.background, self.lane_name[i], (4, row + 4), font, 0.35, (0, 0, 0), 1, cv2.LINE_AA)
+        # distance ticks under the last panel
+        step = max(100, int(round((self.x_end - self.x_start) / 8, -2)))
+        affine, (row0, row1, col0, col1) = self.panels[-1]
+        for x in range(int(np.ceil(self.x_start / step) * step), int(self.x_end) + 1, step):
+            col = int(round(affine[0,0] * x + affine[0,2]))
+            cv2.line(self.background, (col, row1), (col, row1 + 4), (0, 0, 0), 1)
+            cv2.putText(self.background, str(x), (col - 12, row1 + 16), font, 0.35, (0, 0, 0), 1, cv2.LINE_AA)
+        
+        self.frame = self.background.copy()
+        
         
     def refresh_frame(self):
         """
-        Set up frame to plot
+        Reset the frame buffer to the lane background, in place
         """
-        # frame to plot
-        self.frame = np.full(shape=(self.window_h, self.window_w, 3), 
-                             fill_value=255,
-                             dtype=np.float64)
-        # add line 
+        np.copyto(self.frame, self.background)
+        
+        
+    def update_cache(self, docs, t):
+        """
+        Register the vehicles seen for the first time with the prefetched metadata
+        docs: time-indexed documents of the current frame, one per collection, docs[0] is GT
+        t: timestamp of the frame
+        return: registry slots of the vehicles of each document, None for missing documents
+        """
+        frame_slots = [self.registries[0].lookup(docs[0]["id"]) if docs[0] else None]
+        for i, doc in enumerate(docs[1:]):
+            reg = self.registries[i+1]
+            reg.expire(t - self.chunk_size)
+            if not doc:
+                frame_slots.append(None)
+                continue
+            slots, new = reg.intern(doc["id"], t)
+            frame_slots.append(slots)
+            if not new.any():
+                continue
+            meta = self.meta_sources[i]
+            meta.advance(t)
+            reg.reserve(size_for(len(meta.docs)))
+            for d in meta.get_many([reg.ids[slot] for slot in slots[new]]):
+                slot = reg.slots[d["_id"]]
+                if "fragment_ids" in d and len(d["fragment_ids"]) > 1: # stitched
+                    reg.stitched[slot] = True
+                if i == 1: # reconciled: scalar width and length
+                    length, width = d.get("length", np.nan), d.get("width", np.nan)
+                    if isinstance(length, list):
+                        length, width = length[0], width[0]
+                    reg.set(slot, length=length, width=width)
+                # raw: width and length are arrays, use the time-indexed dimensions
+        return frame_slots
+                
+                
+    def world_boxes(self, doc, reg, slots):
+        """
+        Road coordinates of the vehicle boxes of one time-indexed document
+        reg, slots: registry of the collection and slots of the vehicles, 
+                    dimensions missing in the registry are taken from the document
+        return: (N,4,2) vertices and (N,) styles (palette index, -1 stitched) of the vehicles 
+                overlapping [x_min, x_max], and the mask of these vehicles in the document
+        """
+        n = len(slots)
+        if n == 0:
+            return np.empty((0,4,2)), np.empty(0, dtype=int), np.empty(0, dtype=bool)
+        pos = np.asarray(doc["position"], dtype=float)[:, :2]
+        dims = reg.dimensions(slots, doc.get("dimensions"))
+        styles = np.where(reg.stitched[slots], -1, reg.palette[slots] % len(self.palette))
+        
+        x, y = centered_corners(pos[:,0], pos[:,1], dims[:,0], dims[:,1])
+        visible = (x + dims[:,0] >= self.x_start) & (x <= self.x_end)
+        return box_vertices(x[visible], y[visible], dims[visible,0], dims[visible,1]), styles[visible], visible
         
-
-    def animate(self, save, upload, stream, extra): 
         
-        # initiate frame 
-        self.refresh_frame()
+    def to_pixels(self, k, verts):
+        """
+        Map (N,4,2) road vertices to int32 pixel polygons of panel k
+        """
+        affine, (row0, row1, col0, col1) = self.panels[k]
+        pix = verts @ affine[:, :2].T + affine[:, 2]
+        # boxes are axis-aligned, clipping the vertices to the panel clips the boxes
+        np.clip(pix[..., 0], col0, col1, out=pix[..., 0])
+        np.clip(pix[..., 1], row0, row1, out=pix[..., 1])
+        return np.rint(pix).astype(np.int32)
+        
+        
+    def draw_boxes(self, polys, styles = None, color = None):
+        """
+        Batch-draw polygons into the frame, one OpenCV call per style
+        styles: (N,) palette index per polygon, -1 draws a green outline (stitched)
+        color: single fill color for all polygons, overrides styles
+        """
+        if len(polys) == 0:
+            return
+        if color is not None:
+            cv2.fillPoly(self.frame, polys, color)
+            return
+        for style in np.unique(styles):
+            select = polys[styles == style]
+            if style < 0:
+                cv2.polylines(self.frame, select, True, self.stitched_color, 2)
+            else:
+                cv2.fillPoly(self.frame, select, self.palette[style])
+                
+                
+    def geometry(self, record):
+        """
+        Update the caches and compute the road-coordinate boxes of one frame of the merged timeline
+        record: {"timestamp", "docs"} from MergedTimeline or PlaybackTimeline, docs[0] is GT
+        return: [(verts, styles, visible) or None] per collection, see world_boxes()
+        """
+        with self.timer.stage("cache"):
+            frame_slots = self.update_cache(record["docs"], record["timestamp"])
+        
+        with self.timer.stage("geometry"):
+            return [self.world_boxes(doc, reg, slots) if doc else None 
+                    for doc, reg, slots in zip(record["docs"], self.registries, frame_slots)]
+        
+        
+    def rasterize(self, layers, timestamp):
+        """
+        Draw the boxes of geometry() into self.frame
+        """
+        with self.timer.stage("geometry"):
+            # GT is drawn identically on every panel
+            gt = layers[0][0] if layers[0] else None
+            polys = []
+            for k in range(len(self.panels)):
+                layer = layers[k+1] if k+1 < len(layers) else None
+                polys.append((self.to_pixels(k, gt) if gt is not None else None,
+                              (self.to_pixels(k, layer[0]), layer[1]) if layer else None))
+        
+        with self.timer.stage("draw"):
+            self.refresh_frame()
+            for gt, boxes in polys:
+                if gt is not None:
+                    self.draw_boxes(gt, color=self.gt_color)
+                if boxes is not None:
+                    self.draw_boxes(*boxes)
+            time_text = datetime.utcfromtimestamp(int(timestamp)).strftime('%m/%d/%Y, %H:%M:%S')
+            cv2.putText(self.frame, time_text, 
+                        org=(10, self.window_h - 10), fontFace=cv2.FONT_HERSHEY_DUPLEX,
+                        fontScale=0.6, color=(0, 0, 0), thickness=1, lineType=cv2.LINE_AA)
+            
+            
+    def render(self, record):
+        """
+        Rasterize one frame of the merged timeline into self.frame
+        return: the layers of geometry()
+        """
+        layers = self.geometry(record)
+        self.rasterize(layers, record["timestamp"])
+        return layers
+        
+        
+    def publish_vehicles(self, record, layers):
+        """
+        Send the boxes of one frame to the canvas clients
+        """
+        packed = []
+        for l, (doc, layer) in enumerate(zip(record["docs"], layers)):
+            if not layer:
+                packed.append(None)
+                continue
+            verts, styles, visible = layer
+            ids = id_list(doc["id"])
+            ids = [ids[j] for j in np.flatnonzero(visible)]
+            boxes = np.column_stack([verts[:,0,0], verts[:,0,1], 
+                                     verts[:,2,0] - verts[:,0,0], verts[:,2,1] - verts[:,0,1]])
+            packed.append((boxes, self.vehicle_hub.indices(l, ids, styles)))
+        self.vehicle_hub.publish(record["timestamp"], packed)
+        
+        
+    def animate(self, save, upload, stream, extra, show = True, max_frames = None): 
+        """
+        Render the merged timeline of all collections frame by frame
+        show: if False, render without opening a window (headless benchmarking)
+        max_frames: stop after this many frames, None runs until the end of the data or escape is pressed
+        """
+        # GT dimensions of the whole time range at once
+        gt_docs = list(self.list_veh[0].find_active(self.t_min, self.t_max, {'width':1, 'length':1}))
+        self.registries[0].reserve(size_for(len(gt_docs), headroom=1))
+        slots, _ = self.registries[0].intern([doc["_id"] for doc in gt_docs])
+        self.registries[0].set(slots, length=[doc["length"] for doc in gt_docs], width=[doc["width"] for doc in gt_docs])
         
-        x1 = 0
-        y1 = int(self.window_h / 2)
-        direction = 'r'
-        w = 75
-        h = 25
-        c = (255, 0, 0)
+        # one read-ahead source per collection, merged into a single timeline
+        self.frame_sources, self.timeline = self.open_timeline()
+        # vehicle metadata of raw and reconciled, fetched one time window at a time ahead of playback
+        self.meta_sources = self.open_metadata(self.t_min)
+        self.time = self.t_min
+        # a saved video keeps every frame
+        self.scheduler = RealtimeScheduler(self.clock) if self.realtime and not save else None
         
         if save:
             now = datetime.utcfromtimestamp(int(time.time())).strftime('%Y-%m-%d_%H-%M-%S')
-            file_name = now+"_" + "random-trajectory" +extra+".mp4"
+            file_name = now+"_" + self.list_veh[-1].name +extra+".mp4"
             path_name = "/home/zitest/Desktop/i24-overhead-visualizer/videos/" + file_name
             # write to file
             fourcc = cv2.VideoWriter_fourcc(*'MPEG')
             out = cv2.VideoWriter(path_name, fourcc, self.framerate, (self.window_w, self.window_h))
 
-        end = False
         frame = 0
-        if stream:
-            global outputFrame, lock
-        while True:
-            if end:
+        next_tick = time.perf_counter()
+        while max_frames is None or frame < max_frames:
+            if self.scheduler is not None and not self.paused:
+                self.scheduler.sync() # skip the frames already late, not those stepped to while paused
+            try:
+                with self.timer.stage("fetch"):
+                    record = self.timeline.next()
+            except StopIteration:
+                print("Reach the end of time. Exit.")
                 break
-            
-            # temporary move mechanism
-            if x1 + w > self.window_w:
-                direction = 'l'
-            elif x1 < 0:
-                direction = 'r'
-            if direction == 'l':
-                x1 -= 5
+            self.time = record["timestamp"]
+            if stream and not (show or save) and self.hub.clients == 0:
+                # only canvas viewers, nothing to rasterize
+                layers = self.geometry(record)
             else:
-                x1 += 5
+                layers = self.render(record)
             
-            # clear frame
-            self.refresh_frame()
-            # plot vehicles
-            cv2.rectangle(self.frame, (x1, y1), (x1 + w, y1 + h), c, cv2.FILLED)
-            # add frame number
-            cv2.putText(self.frame, 'Frame # {f}'.format(f=frame), 
-                        org=(10, self.window_h - 20), fontFace=cv2.FONT_HERSHEY_DUPLEX,
-                        fontScale=1, color=(0, 0, 0), thickness=1, lineType=1)
-            if not stream:
+            if show and not stream:
                 cv2.imshow("i24 overhead compare v2", self.frame)
             
             # save
             if save:
-                out.write(self.frame.astype(np.uint8))
+                with self.timer.stage("encode"):
+                    out.write(self.frame)
             
-            # end with escape
-            k = cv2.waitKey(int(1000/self.framerate)) & 0xFF
-            if k == 27:
-                end = True
-                break
+            # encode once for all stream clients
+            if stream:
+                with self.timer.stage("encode"):
+                    self.hub.publish(self.frame)
+                    if self.vehicle_hub.clients > 0:
+                        self.publish_vehicles(record, layers)
             
             frame += 1
+            self.timer.next_frame()
             
-            # acquire lock, set output frame, and release lock
-            if stream:
-                print('Current lock: ', lock)
-                with lock:
-                    outputFrame = self.frame.copy()
+            # keys, see handle_key()
+            if show:
+                delay = self.scheduler.wait() if self.scheduler is not None else 1/self.framerate
+                running = self.handle_key(cv2.waitKey(max(1, int(delay * 1000))) & 0xFF)
+                # while paused, only a step or a scrub renders the next frame
+                waited = False
+                while running and self.paused and not self.seeked:
+                    running = self.handle_key(cv2.waitKey(50) & 0xFF)
+                    waited = True
+                if waited and self.scheduler is not None:
+                    self.scheduler.rebase() # the pause is not lag
+                self.seeked = False
+                if not running:
+                    break
+            elif stream and self.scheduler is not None:
+                time.sleep(self.scheduler.wait())
+            elif stream:
+                # no window to pace playback, hold the frame rate for the viewers
+                next_tick += 1/self.framerate
+                time.sleep(max(0, next_tick - time.perf_counter()))
         
+        self.close_sources()
+        if self.scheduler is not None:
+            print("realtime: {frames} frames, {dropped} dropped, lag {mean_lag_ms:.1f} ms mean, {max_lag_ms:.1f} ms max".format(**self.scheduler.summary()))
+        if stream:
+            self.hub.close()
+            self.vehicle_hub.close()
         if save:
             out.release()
-        cv2.destroyAllWindows()
+        if show:
+            cv2.destroyAllWindows()
         return
     
-    def generate_stream(self):
-        # grab global references to the output frame and lock variables
-    	global outputFrame, lock
-    	# loop over frames from the output stream
-    	while True:
-    		# wait until the lock is acquired
-    		with lock:
-    			# check if the output frame is available, otherwise skip
-    			# the iteration of the loop
-    			if outputFrame is None:
-    				continue
-    			# encode the frame in JPEG format
-    			(flag, encodedImage) = cv2.imencode(".jpg", outputFrame)
-    			# ensure the frame was successfully encoded
-    			if not flag:
-    				continue
-    		# yield the output frame in the byte format
-    		yield(b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + 
-    			bytearray(encodedImage) + b'\r\n')
-    
-    def setup_stream(self):
+    def open_timeline(self):
+        """
+        One frame source per collection and the timeline that merges them
+        resample: engines interpolating at the times of one clock (see playback.py), else stored documents
+        return: (sources, timeline)
+        """
+        if not self.resample:
+            sources = [FrameSource(dbr, self.t_min, self.t_max, 
+                                   chunk_size=self.chunk_size, read_ahead=self.read_ahead) for dbr in self.list_dbr]
+            return sources, MergedTimeline(sources, tolerance=self.tolerance)
+        self.clock = PlaybackClock(self.t_min, self.t_max, self.framerate, self.speed)
+        # the catalog knows the sample interval of each collection, no query needed
+        sources = [PlaybackEngine(dbr, self.clock, interval=self.catalog.sample_interval("transformed", collection),
+                                  chunk_size=self.chunk_size, read_ahead=self.read_ahead)
+                   for dbr, collection in zip(self.list_dbr, self.collections)]
+        return sources, PlaybackTimeline(sources, self.clock)
+    
+    
+    def open_metadata(self, t, active = None):
+        """
+        Metadata prefetchers of raw and reconciled from time t
+        active: ids of the vehicles active in the first window per collection, queried if None
+        """
+        active = active or [None] * (len(self.list_veh) - 1)
+        return [MetadataPrefetcher(veh, t, self.t_max, window=self.chunk_size, read_ahead=self.read_ahead,
+                                   projection={"width":1, "length":1, "fragment_ids": 1}, active=ids)
+                for veh, ids in zip(self.list_veh[1:], active)]
+    
+    
+    def keyframe_index(self):
+        """
+        Keyframe index of raw and reconciled (see keyframes.py), built on the first call
+        """
+        if self.keyframes is None:
+            self.keyframes = [KeyframeIndex(veh) for veh in self.list_veh[1:]]
+            print("keyframes: ", [index.summary() for index in self.keyframes])
+        return self.keyframes
+    
+    
+    def seek(self, t):
+        """
+        Make t (sec, clamped to [t_min, t_max]) the time of the next frame
+        The documents are fetched from t on, and when t is far from the current frame the metadata of
+        the vehicles active at t is fetched by _id from the keyframe snapshots. Nothing is replayed from t_min
+        """
+        t = min(max(t, self.t_min), self.t_max)
+        if self.clock is not None:
+            self.clock.seek(t) # the engines reopen their sources on a jump
+        else:
+            for src in self.frame_sources:
+                src.close()
+            # from the stored documents nearest to t
+            self.frame_sources = [FrameSource(dbr, t - self.tolerance, self.t_max, chunk_size=self.chunk_size, 
+                                              read_ahead=self.read_ahead) for dbr in self.list_dbr]
+            self.timeline = MergedTimeline(self.frame_sources, tolerance=self.tolerance)
+        # near the current frame, the loaded metadata and get_many() cover the vehicles
+        if abs(t - self.time) > self.chunk_size:
+            indexes = self.keyframe_index()
+            for meta in self.meta_sources:
+                meta.close()
+            self.meta_sources = self.open_metadata(t, [index.active(t, t + self.chunk_size) for index in indexes])
+        self.time = t
+        self.seeked = True
+    
+    
+    def step(self, n = 1):
+        """
+        Make the frame n frames after the current one (before if n < 0) the next frame
+        """
+        step = self.clock.step if self.clock is not None else 1 / self.framerate
+        self.seek(self.time + n * step)
+    
+    
+    def handle_key(self, k):
+        """
+        escape ends, space pauses/resumes, +/- double/halve the playback speed,
+        ,/. step one frame back/forward while paused, [/] scrub SCRUB_STEP sec
+        return: False to end playback
+        """
+        if k == 27:
+            return False
+        if k in (ord("+"), ord("="), ord("-")):
+            self.set_speed(self.speed * (0.5 if k == ord("-") else 2))
+        if k == ord(" "):
+            self.paused = not self.paused
+        if self.paused and k in (ord(","), ord(".")):
+            self.step(1 if k == ord(".") else -1)
+        if k in (ord("["), ord("]")):
+            self.seek(self.time + (SCRUB_STEP if k == ord("]") else -SCRUB_STEP))
+        return True
+    
+    
+    def set_speed(self, speed):
+        """
+        Change the playback speed of a running animation, see playback.MIN_SPEED and MAX_SPEED
+        """
+        if self.clock is None:
+            return self.speed
+        self.speed = self.clock.set_speed(speed)
+        print("speed {}x".format(self.speed))
+        return self.speed
+    
+    
+    def close_sources(self):
+        """
+        Stop the read-ahead threads of the last animation
+        """
+        for src in self.frame_sources + self.meta_sources:
+            src.close()
+    
+    def cache_stats(self):
+        """
+        Counters of the collection catalog, the vehicle registries and the metadata prefetchers
+        """
+        return [self.catalog.summary()] + [reg.summary() for reg in self.registries] + [meta.stats.summary() for meta in self.meta_sources]
+    
+    def generate_stream(self, address = None):
+        """
+        multipart JPEG parts of the latest frames for one client, at the quality its link keeps up with
+        """
+        return self.hub.subscribe(address)
+    
+    def setup_stream(self, quality = 80, adaptive = True):
+        """
+        quality: JPEG quality of the streamed frames at full resolution
+        adaptive: lower resolution, quality and frame rate per client for slow links (see streaming.LADDER)
+        """
+        self.hub = FrameHub(quality=quality, adaptive=adaptive)
+        self.vehicle_hub = VehicleFrameHub()
         self.app = Flask(__name__)
         
         @self.app.route("/")
@@ -201,8 +579,37 @@ class OverheadCompareV2():
         def video_feed():
         	# return the response generated along with the specific media
         	# type (mime type)
-        	return Response(self.generate_stream(),
+        	return Response(self.generate_stream(request.remote_addr),
         		mimetype = "multipart/x-mixed-replace; boundary=frame")
+        
+        @self.app.route("/canvas")
+        def canvas():
+            # vehicles drawn by the browser from /vehicle_feed
+            return render_template("canvas.html")
+        
+        @self.app.route("/canvas_config")
+        def canvas_config():
+            return jsonify(self.canvas_config())
+        
+        @self.app.route("/vehicle_feed")
+        def vehicle_feed():
+            return Response(self.vehicle_hub.subscribe(), mimetype = "application/octet-stream")
+        
+        @self.app.route("/stream_stats")
+        def stream_stats():
+            return jsonify({"video_feed": self.hub.stats(), "vehicle_feed": self.vehicle_hub.stats(),
+                            "playback": self.scheduler.summary() if self.scheduler is not None else None})
+        
+    def canvas_config(self):
+        """
+        Static layout of the canvas page: road range, lanes, panel names and colors (RGB)
+        """
+        return {"x_min": self.x_start, "x_max": self.x_end,
+                "lanes": self.lanes, "lane_name": self.lane_name,
+                "panels": [veh.name for veh in self.list_veh[1:]] or [self.list_veh[0].name],
+                "palette": [list(color[::-1]) for color in self.palette],
+                "gt_color": list(self.gt_color[::-1]), "stitched_color": list(self.stitched_color[::-1]),
+                "framerate": self.framerate}
 
     def start_stream(self):
         self.app.run(host="0.0.0.0",
@@ -228,7 +635,7 @@ def main(rec, gt = "groundtruth_scene_2_57", framerate = 25, x_min=-100, x_max=2
         p.setup_stream()
         
         t = threading.Thread(target=p.animate, args=(
-            False, False, True, "",))
+            False, False, True, "", False,))
         t.daemon = True
         t.start()
         
@@ -5,7 +5,6 @@ Created on Wed Jun  1 15:42:19 2022
 
 @author: teohz
 """
-from i24_database_api.db_reader import DBReader
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import matplotlib.animation as animation
@@ -14,7 +13,15 @@ import numpy as np
 import cmd
 import json
 import os
-import pymongo
+import time
+import itertools
+from backends import get_backend
+from profiling import StageTimer
+from overhead_artists import BoxLayer, box_vertices, style_arrays
+from registry import VehicleRegistry
+from catalog import Catalog
+from playback import PlaybackClock, PlaybackEngine, RealtimeScheduler, clamp_speed
+from keyframes import SCRUB_STEP
 
 class OverheadVisualizer():
     """
@@ -26,26 +33,31 @@ class OverheadVisualizer():
                  vehicle_database, vehicle_collection, 
                  timestamp_database, timestamp_collection,
                  x_start=2000, x_end=1000,
-                 framerate=25):
+                 framerate=25, speed=1.0, resample=False, realtime=False, snapshot=None, backend=None):
         """
         Initializes an Overhead Traffic VIsualizer object
         
         Parameters
         ----------
         config : object
+        snapshot : path to a directory written by snapshot.export_snapshot(), 
+            replay from it without database access. Snapshot collections hold both
+            indexes, so pass the same name as vehicle_collection and timestamp_collection
+        backend : data backend (see backends.py), overrides config and snapshot
+        speed : playback speed, data seconds per second of display (0.25 to 16), see playback.py. Requires resample
+        resample : interpolate positions at the display times. Off by default, 
+            every frame is then the next stored document
+        realtime : keep a shown visualization on the wall clock, frames already 
+            late are dropped (see playback.RealtimeScheduler). Requires resample
         """
-        self.timestamp_dbr = DBReader(host=config["host"], 
-                                      port=config["port"], 
-                                      username=config["username"], 
-                                      password=config["password"], 
-                                      database_name=timestamp_database, 
-                                      collection_name=timestamp_collection)
-        self.vehicle_dbr = DBReader(host=config["host"],
-                                 port=config["port"],
-                                 username=config["username"], 
-                                 password=config["password"], 
-                                 database_name=vehicle_database, 
-                                 collection_name=vehicle_collection)
+        if realtime and not resample:
+            raise ValueError("realtime=True requires resample=True")
+        self.backend = get_backend(config, backend, snapshot)
+        self.catalog = Catalog(self.backend)
+        self.timestamp_dbr = self.catalog.collection(timestamp_database, timestamp_collection)
+        self.vehicle_dbr = self.catalog.collection(vehicle_database, vehicle_collection)
+        self.timestamp_database = timestamp_database
+        self.timestamp_collection = timestamp_collection
         self.anim = None
         self.MODE = MODE
         if self.MODE != "RAW" and self.MODE != "RECONCILED":
@@ -54,13 +66,22 @@ class OverheadVisualizer():
         self.x_start = x_start
         self.x_end = x_end
         self.framerate = framerate
+        self.speed = clamp_speed(speed)
+        self.resample = resample
+        self.realtime = realtime
+        self.clock = None
+        self.engine = None
+        self.scheduler = None
+        self.doc_cursor = None
+        self.time = None # (sec) time of the last frame
         self.y_start = -12
         self.y_end = 11*12
         self.paused = False
         self.cursor = None
         self.vehicle_collection = vehicle_collection
+        self.timer = StageTimer() # per-frame stage timing, see benchmark.py
         
-    def visualize(self, frames=20000, save=False, verbose=False):
+    def visualize(self, frames=20000, save=False, verbose=False, render_mode="patches", blit=False, show=True):
         """
         params:
             frames (int): 
@@ -71,9 +92,22 @@ class OverheadVisualizer():
             verbose (boolean):
                 whether to print messages related to visualization
                 i.e. vehicle off the road plotted
+            render_mode (str):
+                "patches" adds one Rectangle per vehicle per frame (hover labels on pause),
+                "collection" updates one persistent PolyCollection in place
+            blit (boolean):
+                only redraw the vehicle boxes every frame. Requires render_mode="collection"
+            show (boolean):
+                if False, set up the figure and animation and return it 
+                without showing or saving (headless driving)
         """
+        if render_mode not in ("patches", "collection"):
+            raise ValueError("render_mode must be either 'patches' or 'collection'")
+        if blit and render_mode != "collection":
+            raise ValueError("blit=True requires render_mode='collection'")
         
         fig = plt.figure()
+        self.fig = fig
         ax1 = fig.add_subplot(111)
         ax1.set_aspect('equal', 'box')
         ax1.set(ylim=[self.y_start, self.y_end])
@@ -99,54 +133,87 @@ class OverheadVisualizer():
                     plt.axhline(y=i*12, linewidth=0.5, color='k')
                 else:
                     plt.axhline(y=i*12, linewidth=0.1, color='k')
+            if render_mode == "collection":
+                self.layer = BoxLayer(ax1, animated=blit)
+                self.frame_text = ax1.text(0.01, 0.95, "", transform=ax1.transAxes, animated=blit)
+                return self.layer.artist, self.frame_text
             return ax1,
         
-        def animate_reconciled(i, cursor, cache_vehicle, cache_colors):
+        def update_layer(i, positions, dimensions, colors):
+            """
+            Vectorized drawing of all vehicles of a frame into the persistent layer
+            colors: (N,3) gathered from the registry
+            """
+            self.frame_text.set_text("{} | Frame {}".format(self.vehicle_collection, i))
+            if len(colors) == 0:
+                self.layer.clear()
+                return self.layer.artist, self.frame_text
+            pos = np.asarray(positions, dtype=float)[:, :2]
+            dims = np.asarray(dimensions, dtype=float)[:, :2]
+            
+            select = (pos[:,0] <= self.x_start) & (pos[:,0] >= self.x_end)
+            verts = box_vertices(pos[select,0], pos[select,1], dims[select,0], dims[select,1])
+            face, edge, lw = style_arrays(len(verts), colors[select])
+            self.layer.update(verts, face, edge, lw)
+            
+            if verbose:
+                off_road = select & ((pos[:,1] > self.y_end) | (pos[:,1] < self.y_start))
+                for car_x_pos, car_y_pos in pos[off_road]:
+                    print("Vehicle off the road at coordinate ({}, {}) at frame={}".format(car_x_pos, car_y_pos, i))
+            return self.layer.artist, self.frame_text
+        
+        def animate_reconciled(i, registry):
             if (i % self.framerate > self.framerate):
                 return ax1,
             
-            ax1.set_title("{} | Frame {}".format(self.vehicle_collection, i))
+            if render_mode == "patches":
+                ax1.set_title("{} | Frame {}".format(self.vehicle_collection, i))
             
-            doc = cursor.next()
+            with self.timer.stage("fetch"):
+                doc = next(self.doc_cursor)
+            self.time = doc["timestamp"]
             
             # remove all car_boxes
             for box in list(ax1.patches):
                 box.set_visible(False)
                 box.remove()
             
-            # query for vehicle dimensions
-            traj_cursor = self.vehicle_dbr.collection.find({"_id": {"$in": doc["id"]} }, 
-                                                           {"width":1, "length":1, "coarse_vehicle_class": 1})
-        
-            # add vehicle dimension to cache
-            for index, traj in enumerate(traj_cursor):
-                # print("index: {} is {}".format(index, traj))
-                # { ObjectId('...') : [length, width, coarse_vehicle_class] }
+            with self.timer.stage("cache"):
+                registry.expire(doc["timestamp"] - expire_after)
+                slots, new = registry.intern(doc["id"], doc["timestamp"])
+            
+            # query for the dimensions of vehicles new to the registry
+            if new.any():
+                with self.timer.stage("fetch"):
+                    new_ids = [registry.ids[slot] for slot in slots[new]]
+                    traj_cursor = list(self.vehicle_dbr.find_ids(new_ids, {"width":1, "length":1, "coarse_vehicle_class": 1}))
                 
-                cache_vehicle[traj["_id"]] = [traj["length"], traj["width"], traj["coarse_vehicle_class"]]
+                with self.timer.stage("cache"):
+                    for traj in traj_cursor:
+                        car_length, car_width = traj["length"], traj["width"]
+                        if isinstance(car_width, list):
+                            # vehicle width and length are lists
+                            # TODO: currently just take the first item from the array
+                            car_length, car_width = car_length[0], car_width[0]
+                        registry.set(registry.slots[traj["_id"]], length=car_length, width=car_width,
+                                     vehicle_class=traj["coarse_vehicle_class"])
             
-                if traj["_id"] not in cache_colors:
-                    cache_colors[traj["_id"]] = np.random.rand(3,)
+            dims = registry.dimensions(slots)
+            colors = registry.color[slots]
+            if render_mode == "collection":
+                return update_layer(i, doc["position"], dims, colors)
             
             # plot vehicles
             for index in range(len(doc["position"])):
                 car_x_pos = doc["position"][index][0]
                 car_y_pos = doc["position"][index][1]
-                
-                car_length = cache_vehicle[doc["id"][index]][0]
-                car_width = cache_vehicle[doc["id"][index]][1]
-                
-                if isinstance(car_width, list):
-                    # vehicle width and length are lists
-                    # TODO: currently just take the first item from the array
-                    car_length = car_length[0]
-                    car_width = car_width[0]
+                car_length, car_width = dims[index]
                 
                 # print("index {} at ({},{})".format(index, car_x_pos, car_y_pos))
                 if car_x_pos <= self.x_start and car_x_pos >= self.x_end:
                     box = patches.Rectangle((car_x_pos, car_y_pos),
                                             car_length, car_width, 
-                                            color=cache_colors[doc["id"][index]],
+                                            color=colors[index],
                                             label=doc["id"][index])
                     ax1.add_patch(box)
                     if verbose:
@@ -155,24 +222,33 @@ class OverheadVisualizer():
             
             return ax1,
     
-        def animate_raw(i, cursor, cache_colors):
+        def animate_raw(i, registry):
             if (i % self.framerate > self.framerate):
                 return ax1,
             
-            ax1.set_title("{} | Frame {}".format(self.vehicle_collection, i))
+            if render_mode == "patches":
+                ax1.set_title("{} | Frame {}".format(self.vehicle_collection, i))
             
-            doc = cursor.next()
+            with self.timer.stage("fetch"):
+                doc = next(self.doc_cursor)
+            self.time = doc["timestamp"]
             
             # remove all car_boxes
             for box in list(ax1.patches):
                 box.set_visible(False)
                 box.remove()
             
+            with self.timer.stage("cache"):
+                registry.expire(doc["timestamp"] - expire_after)
+                slots, _ = registry.intern(doc["id"], doc["timestamp"])
+            colors = registry.color[slots]
+            
+            if render_mode == "collection":
+                return update_layer(i, doc["position"], doc["dimensions"], colors)
+            
             # plot vehicles
             for index in range(len(doc["id"])):
                 car_id = doc["id"][index]
-                if car_id not in cache_colors:
-                    cache_colors[car_id] = np.random.rand(3,)
                 car_x_pos = doc["position"][index][0]
                 car_y_pos = doc["position"][index][1]
                 
@@ -183,7 +259,7 @@ class OverheadVisualizer():
                 if car_x_pos <= self.x_start and car_x_pos >= self.x_end:
                     box = patches.Rectangle((car_x_pos, car_y_pos),
                                             car_length, car_width, 
-                                            color=cache_colors[car_id],
+                                            color=colors[index],
                                             label=car_id)
                     ax1.add_patch(box)
                     if verbose:
@@ -193,39 +269,142 @@ class OverheadVisualizer():
             return ax1,
         
         
-        # maintains a cache of vehicle information (width, height, class)        
-        # cache_vehicle[car_id] = [width, height, coarse_vehicle_class]
-        cache_vehicle = {}
-        cache_colors = {}
+        # vehicle information (length, width, coarse_vehicle_class, color) by interned vehicle id
+        registry = VehicleRegistry(name=self.vehicle_collection)
+        expire_after = 10 # (sec) a vehicle not seen for this long gives its slot back
         
-        cursor = self.timestamp_dbr.collection.find().sort([("timestamp", pymongo.ASCENDING)]).limit(frames)
+        self.t_min, self.t_max = self.catalog.range(self.timestamp_database, self.timestamp_collection, "timestamp")
+        self.frames = frames
+        if self.resample:
+            # one frame every speed/framerate sec of data, positions interpolated (see playback.py)
+            self.clock = PlaybackClock(self.t_min, self.t_max, self.framerate, self.speed)
+            self.engine = PlaybackEngine(self.timestamp_dbr, self.clock,
+                                         interval=self.catalog.sample_interval(self.timestamp_database, self.timestamp_collection))
+            self.doc_cursor = itertools.islice(self.engine, frames)
+            # a saved video keeps every frame
+            self.scheduler = RealtimeScheduler(self.clock) if self.realtime and not save else None
+        else:
+            self.doc_cursor = self.timestamp_dbr.get_range("timestamp", float("-inf"), float("inf"), limit=frames)
+        self.catalog.check()
         
         if self.MODE == "RAW":
             to_animate = animate_raw
-            to_args = (cursor, cache_colors,)
         else:
             to_animate = animate_reconciled
-            to_args = (cursor, cache_vehicle, cache_colors,)
+        to_args = (registry,)
+        self.registry = registry
         
-        self.anim = animation.FuncAnimation(fig, func=to_animate,
+        def timed(i, *args):
+            if self.scheduler is not None and not self.paused:
+                self.scheduler.sync() # skip the frames already late, not those stepped to while paused
+            # whatever is not fetch or cache in a frame counts as geometry
+            before = self.timer.current["fetch"] + self.timer.current["cache"]
+            start = time.perf_counter()
+            artists = to_animate(i, *args)
+            elapsed = time.perf_counter() - start
+            if self.scheduler is not None and not self.paused:
+                # fire again when the next frame is due
+                self.anim.event_source.interval = max(1, int(self.scheduler.wait() * 1000))
+            self.timer.add("geometry", elapsed - (self.timer.current["fetch"] + self.timer.current["cache"] - before))
+            return artists
+        
+        self.anim = animation.FuncAnimation(fig, func=timed,
                                             init_func=init,
                                             frames=frames,
                                             repeat=False,
                                             interval=2,
                                             fargs=to_args,
-                                            blit=False)
+                                            blit=blit)
+        self.blit = blit
+        self.init_frame = init
+        self.update_frame = lambda i: timed(i, *to_args)
+        if not show:
+            return self.anim
         
         if save:
             self.anim.save('animation.mp4', writer='ffmpeg', fps=self.framerate)
         plt.show()
+        self.close_sources()
+        print("cache {name}: {hits} hits, {misses} misses, {evictions} evictions, {size}/{capacity} entries, {bytes} bytes".format(**self.registry.summary()))
+        if self.scheduler is not None:
+            print("realtime: {frames} frames, {dropped} dropped, lag {mean_lag_ms:.1f} ms mean, {max_lag_ms:.1f} ms max".format(**self.scheduler.summary()))
         print("complete")
     
+    def set_speed(self, speed):
+        """
+        Change the playback speed of a running visualization, see playback.MIN_SPEED and MAX_SPEED
+        """
+        self.speed = self.clock.set_speed(speed) if self.clock is not None else clamp_speed(speed)
+        print("speed {}x".format(self.speed))
+        return self.speed
+    
+    def seek(self, t):
+        """
+        Make t (sec, clamped to the time range of the collection) the time of the next frame,
+        redrawn at once when paused. The documents are fetched from t on, the dimensions of
+        the vehicles new to the registry by _id as during playback
+        """
+        t = min(max(t, self.t_min), self.t_max)
+        if self.clock is not None:
+            self.clock.seek(t) # the engine reopens its source on a jump
+        else:
+            # the stored document nearest to t, not the one after it
+            self.doc_cursor = self.timestamp_dbr.get_range("timestamp", t - 0.5/self.framerate, float("inf"), limit=self.frames)
+        self.time = t
+        if self.paused:
+            self.redraw(self.update_frame(0))
+    
+    def step(self, n = 1):
+        """
+        Move n frames forward (backward if n < 0) from the current frame
+        """
+        step = self.clock.step if self.clock is not None else 1 / self.framerate
+        self.seek((self.time if self.time is not None else self.t_min) + n * step)
+    
+    def redraw(self, artists):
+        """
+        Draw a frame computed outside of the animation loop (while paused)
+        """
+        canvas = self.fig.canvas
+        if not self.blit:
+            canvas.draw_idle()
+            return
+        # animated artists are left out of a full draw
+        canvas.draw()
+        for artist in artists or []:
+            artist.axes.draw_artist(artist)
+        canvas.blit(self.fig.bbox)
+    
+    def close_sources(self):
+        """
+        Stop the read-ahead thread of the playback engine
+        """
+        if self.engine is not None:
+            self.engine.close()
+    
+    def cache_stats(self):
+        """
+        Counters of the collection catalog and of the vehicle registry of the last visualization
+        """
+        return [self.catalog.summary(), self.registry.summary()]
+    
     """
-    press spacebar to pause/resume animation
+    press spacebar to pause/resume animation, +/- to double/halve the playback speed,
+    right/left to step one frame while paused, up/down to scrub SCRUB_STEP sec, home/end to jump
     """
     def toggle_pause(self, event):
+        if event.key in ("+", "=", "-"):
+            self.set_speed(self.speed * (0.5 if event.key == "-" else 2))
+        if self.paused and event.key in ("right", "left"):
+            self.step(1 if event.key == "right" else -1)
+        if event.key in ("up", "down"):
+            self.seek((self.time if self.time is not None else self.t_min) + (SCRUB_STEP if event.key == "up" else -SCRUB_STEP))
+        if event.key in ("home", "end"):
+            self.seek(self.t_min if event.key == "home" else self.t_max - 1 / self.framerate)
         if event.key == " ":
             if self.paused:
+                if self.scheduler is not None:
+                    self.scheduler.rebase() # the pause is not lag
                 self.anim.resume()
                 print("Animation Resumed")
                 self.cursor.remove()
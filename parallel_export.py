@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 24 11:05:27 2022
+
+Parallel video export for OverheadCompare.
+[t_min, t_max) is split into time chunks on frame boundaries. Each chunk is rendered
+headlessly (Agg) in its own worker process, with its own data connection, and
+encoded to an mp4 segment. The segments are then joined with ffmpeg's concat
+demuxer (-c copy), so the final video is not re-encoded.
+
+p = OverheadCompare(config, collections = [gt, raw, rec], duration = 600)
+p.export(workers = 8)
+"""
+
+import math
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+def split_frames(n_frames, n_chunks):
+    """
+    Split frames [0, n_frames) into n_chunks contiguous ranges of (almost) equal size
+    return: [(first_frame, last_frame)), empty ranges are dropped
+    """
+    n_chunks = max(1, min(n_chunks, n_frames))
+    bounds = [round(k * n_frames / n_chunks) for k in range(n_chunks + 1)]
+    return [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+
+def _render_segment(job):
+    """
+    Worker: render frames [first, last) of the export into one mp4 segment
+    job: dictionary built by export_video()
+    return: (index, segment path, number of frames, elapsed sec)
+    """
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+    import matplotlib.animation as animation
+    import matplotlib.pyplot as plt
+    from overhead_compare import OverheadCompare
+
+    start = time.perf_counter()
+    # a fresh visualizer, hence a fresh data connection, in every worker
+    p = OverheadCompare(job["config"], collections=job["collections"], framerate=job["framerate"],
+                        x_min=job["x_min"], x_max=job["x_max"], offset=None, duration=None,
+                        chunk_size=job["chunk_size"], read_ahead=job["read_ahead"], tolerance=job["tolerance"],
+                        speed=job["speed"], resample=job["resample"],
+                        snapshot=job["snapshot"], backend=job["backend"])
+    # frame k shows data time t_min + k * speed / framerate
+    step = job["speed"] / job["framerate"]
+    p.t_min = job["t_min"] + job["first"] * step
+    p.t_max = job["t_min"] + job["last"] * step
+    p.animate(render_mode=job["render_mode"], show=False)
+
+    writer = animation.FFMpegWriter(fps=job["framerate"])
+    p.init_frame()
+    try:
+        with writer.saving(p.fig, job["path"], dpi=p.fig.dpi):
+            for frame in range(job["first"], job["last"]):
+                p.update_frame(frame)
+                writer.grab_frame()
+    finally:
+        p.close_sources()
+        plt.close(p.fig)
+    return job["index"], job["path"], job["last"] - job["first"], time.perf_counter() - start
+
+
+def concat_segments(paths, file_name, tmp_dir):
+    """
+    Join mp4 segments of identical encoding into file_name without re-encoding
+    """
+    import matplotlib
+    ffmpeg = matplotlib.rcParams["animation.ffmpeg_path"]
+    list_path = os.path.join(tmp_dir, "segments.txt")
+    with open(list_path, "w") as f:
+        for path in paths:
+            f.write("file '{}'\n".format(os.path.abspath(path)))
+    subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+                    "-c", "copy", "-movflags", "+faststart", file_name], check=True)
+
+
+def export_video(vis, file_name, workers = None, chunk_duration = None, render_mode = "collection", keep_segments = False):
+    """
+    Render the time range of an OverheadCompare to file_name with a pool of worker processes
+    vis: OverheadCompare, supplies the data source and plotting parameters
+    workers: number of processes, all cores by default
+    chunk_duration: (sec) length of a segment, by default the range is split into 2 segments per worker
+    render_mode: "collection" or "patches", see OverheadCompare.animate
+    keep_segments: do not delete the temporary segment directory
+    return: file_name
+    """
+    workers = workers or os.cpu_count() or 1
+    n_frames = vis.frame_count() # same frame count as animate(save=True)
+    if chunk_duration:
+        n_chunks = math.ceil(n_frames / (chunk_duration * vis.framerate))
+    else:
+        n_chunks = 2 * workers
+    chunks = split_frames(n_frames, n_chunks)
+    if not chunks:
+        raise ValueError("nothing to export, the time range is shorter than one second")
+
+    tmp_dir = tempfile.mkdtemp(prefix="segments_", dir=os.path.dirname(os.path.abspath(file_name)))
+    jobs = [{"index": k, "first": first, "last": last,
+             "path": os.path.join(tmp_dir, "segment_{:04d}.mp4".format(k)),
+             "t_min": vis.t_min, "framerate": vis.framerate,
+             "config": vis.config, "collections": vis.collections,
+             "snapshot": vis.snapshot, "backend": vis.backend_arg, # an explicit backend must be picklable
+             "x_min": vis.x_start, "x_max": vis.x_end,
+             "chunk_size": vis.chunk_size, "read_ahead": vis.read_ahead, "tolerance": vis.tolerance,
+             "speed": vis.speed, "resample": vis.resample,
+             "render_mode": render_mode} for k, (first, last) in enumerate(chunks)]
+
+    start = time.perf_counter()
+    paths = [None] * len(jobs)
+    # spawn: workers must not inherit database clients or reader threads of this process
+    ctx = multiprocessing.get_context("spawn")
+    try:
+        with ctx.Pool(processes=min(workers, len(jobs))) as pool:
+            for index, path, frames, elapsed in pool.imap_unordered(_render_segment, jobs):
+                paths[index] = path
+                print("segment {}/{}: {} frames in {:.1f} sec ({:.1f} fps)".format(
+                    index+1, len(jobs), frames, elapsed, frames/elapsed))
+        concat_segments(paths, file_name, tmp_dir)
+    finally:
+        if not keep_segments:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    elapsed = time.perf_counter() - start
+    print("exported {} frames in {:.1f} sec ({:.1f} fps) with {} workers".format(
+        n_frames, elapsed, n_frames/elapsed, min(workers, len(jobs))))
+    return file_name
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Nov  3 09:26:41 2022
+
+Resampling playback: frames at display times instead of one stored document per frame.
+The display clock advances by speed/framerate seconds of data per frame, whatever the
+sample rate of the time-indexed collection. PlaybackEngine keeps the last two samples of
+every vehicle in arrays indexed by slot and interpolates the positions of all vehicles
+at the display time at once. Frames are shaped like time-indexed documents
+{"timestamp", "id", "position", "dimensions"}, so the renderers draw them unchanged.
+
+When a display frame spans more than SPARSE_STEPS stored documents (fast forward), the
+engine stops reading every document and only fetches the ones around each display time
+(frame_source.SampledFrameSource).
+
+RealtimeScheduler keeps a live playback on the wall clock: display times that are already
+late when their frame would start are skipped instead of rendered late.
+
+clock = PlaybackClock(t_min, t_max, framerate = 25, speed = 4)
+timeline = PlaybackTimeline([PlaybackEngine(dbr, clock) for dbr in list_dbr], clock)
+record = timeline.next() # {"timestamp", "docs"} as from MergedTimeline
+"""
+
+import time
+import numpy as np
+from frame_source import FrameSource, SampledFrameSource
+from registry import id_list
+
+MIN_SPEED = 0.25
+MAX_SPEED = 16
+SPARSE_STEPS = 3 # stored intervals per display frame from which only the bracketing documents are fetched
+EPS = 1e-4 # (sec) timestamps closer than this are the same time
+
+
+def clamp_speed(speed):
+    return min(MAX_SPEED, max(MIN_SPEED, float(speed)))
+
+
+class PlaybackClock():
+    """
+    Display times of a playback
+    t_min/t_max: (sec) data time range, [t_min, t_max)
+    framerate: (FPS) display frames per second
+    speed: data seconds per display second, clamped to [MIN_SPEED, MAX_SPEED]
+    """
+    def __init__(self, t_min, t_max, framerate = 25, speed = 1.0):
+        self.t_min = t_min
+        self.t_max = t_max
+        self.framerate = framerate
+        self.speed = clamp_speed(speed)
+        self.origin = t_min # time of frame k=0 since the last speed change
+        self.k = 0
+        self.t = None # time of the last frame
+        self.generation = 0 # incremented by every seek and speed change
+
+    @property
+    def step(self):
+        """
+        (sec) data time between two display frames
+        """
+        return self.speed / self.framerate
+
+    def set_speed(self, speed):
+        """
+        Change the speed from the next frame on
+        """
+        if self.t is not None:
+            self.origin, self.k = self.t, 1
+        self.speed = clamp_speed(speed)
+        self.generation += 1
+        return self.speed
+
+    def seek(self, t):
+        """
+        Make t the time of the next frame
+        """
+        self.origin, self.k = min(max(t, self.t_min), self.t_max), 0
+        self.t = None
+        self.generation += 1
+
+    def skip(self, n):
+        """
+        Drop the next n display times
+        """
+        self.k += n
+
+    @property
+    def next_time(self):
+        """
+        (sec) time of the next frame
+        """
+        return self.origin + self.k * self.step
+
+    def frame_count(self, speed = None):
+        """
+        Number of display frames from t_min to t_max at speed, the current speed by default
+        """
+        return int((self.t_max - self.t_min) / (speed or self.speed) * self.framerate)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # multiples of the step from the origin, no accumulated rounding
+        t = self.next_time
+        if t >= self.t_max - EPS:
+            raise StopIteration
+        self.k += 1
+        self.t = t
+        return t
+
+    next = __next__
+
+
+
+class PlaybackEngine():
+    """
+    Interpolated frames of one time-indexed collection
+    dbr: collection backend of the time-indexed collection
+    clock: PlaybackClock, its speed selects dense or sparse fetching
+    interval: (sec) time between stored documents, estimated from the first documents if None
+    chunk_size, read_ahead: see FrameSource
+
+    Arrays indexed by slot: t_a, t_b (sec) and p_a, p_b (x, y) are the two last samples of
+    each vehicle, dims its (length, width, height). A vehicle is drawn at time t if t_b == t,
+    or at the interpolation of its samples if t_a <= t < t_b and they are at most 1.5 intervals apart.
+    """
+    def __init__(self, dbr, clock, interval = None, chunk_size = 10, read_ahead = 3, capacity = 1024):
+        self.dbr = dbr
+        self.clock = clock
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        self.interval = interval or self._estimate_interval()
+        self.slots = {} # id -> slot
+        self.ids = [] # slot -> id
+        self.free = []
+        self._allocate(capacity)
+        self.source = None
+        self.sparse = None
+        self.step = None # display step of the open source
+        self.last = float("-inf") # timestamp of the last ingested document
+        self.t = None # time of the last frame
+        self.has_dims = True
+        self.exhausted = False
+        # counters
+        self.frames = 0
+        self.documents = 0 # stored documents ingested
+        self.reopened = 0
+
+
+    def _estimate_interval(self):
+        docs = list(self.dbr.get_range("timestamp", self.clock.t_min, float("inf"), limit=3))
+        gaps = np.diff([doc["timestamp"] for doc in docs])
+        gaps = gaps[gaps > 0]
+        return float(np.median(gaps)) if len(gaps) else 1 / self.clock.framerate
+
+
+    def _allocate(self, capacity):
+        old = len(self.ids)
+        def grow(array, fill):
+            out = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            out[:old] = array[:old]
+            return out
+        if old == 0:
+            self.t_a = np.full(capacity, -np.inf)
+            self.t_b = np.full(capacity, -np.inf)
+            self.p_a = np.zeros((capacity, 2))
+            self.p_b = np.zeros((capacity, 2))
+            self.dims = np.full((capacity, 3), np.nan)
+            self.live = np.zeros(capacity, dtype=bool)
+        else:
+            self.t_a = grow(self.t_a, -np.inf)
+            self.t_b = grow(self.t_b, -np.inf)
+            self.p_a = grow(self.p_a, 0)
+            self.p_b = grow(self.p_b, 0)
+            self.dims = grow(self.dims, np.nan)
+            self.live = grow(self.live, False)
+        self.capacity = capacity
+
+
+    def _slot(self, veh_id):
+        slot = self.slots.get(veh_id)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = len(self.ids)
+                if slot >= self.capacity:
+                    self._allocate(2 * self.capacity)
+                self.ids.append(None)
+            self.slots[veh_id] = slot
+            self.ids[slot] = veh_id
+            self.live[slot] = True
+        return slot
+
+
+    def _reset(self):
+        for slot in self.slots.values():
+            self.live[slot] = False
+            self.t_a[slot] = self.t_b[slot] = -np.inf
+            self.ids[slot] = None
+            self.free.append(slot)
+        self.slots.clear()
+        self.last = float("-inf")
+
+
+    def _open(self, t):
+        """
+        (Re)start fetching at time t, densely or around the display times only
+        """
+        if self.source is not None:
+            self.source.close()
+            self.reopened += 1
+            self._reset()
+        self.step = self.clock.step
+        self.sparse = self.step > SPARSE_STEPS * self.interval
+        # the document after the last frame is needed for interpolation
+        t_end = self.clock.t_max + 2 * self.interval
+        if self.sparse:
+            self.source = SampledFrameSource(self.dbr, t, t_end, self.step, 1.01 * self.interval,
+                                             read_ahead=self.read_ahead)
+        else:
+            # from the document at or before t
+            self.source = FrameSource(self.dbr, t - self.interval, t_end,
+                                      chunk_size=self.chunk_size, read_ahead=self.read_ahead)
+        self.exhausted = False
+
+
+    def _ingest(self, doc):
+        ids = id_list(doc["id"])
+        slots = np.fromiter((self._slot(veh_id) for veh_id in ids), dtype=np.int64, count=len(ids))
+        self.t_a[slots] = self.t_b[slots]
+        self.p_a[slots] = self.p_b[slots]
+        self.t_b[slots] = doc["timestamp"]
+        if len(slots):
+            self.p_b[slots] = np.asarray(doc["position"], dtype=float)[:, :2]
+            if "dimensions" in doc:
+                dims = np.asarray(doc["dimensions"], dtype=float).reshape(len(slots), -1)[:, :3]
+                self.dims[slots, :dims.shape[1]] = dims
+            else:
+                self.has_dims = False
+        self.last = doc["timestamp"]
+        self.documents += 1
+
+
+    def _expire(self, t):
+        # vehicles whose last sample is well behind t give their slots back
+        n = len(self.ids)
+        old = np.flatnonzero(self.live[:n] & (self.t_b[:n] < t - 2 * self.interval - 1))
+        for slot in old:
+            del self.slots[self.ids[slot]]
+            self.ids[slot] = None
+            self.free.append(int(slot))
+        self.live[old] = False
+        self.t_a[old] = self.t_b[old] = -np.inf
+
+
+    def frame(self, t):
+        """
+        Time-indexed document of the vehicles at time t, positions interpolated
+        return: {"_id": frame number, "timestamp": t, "id": [ids], "position": (N,2), "dimensions": (N,3)},
+                dimensions only if the stored documents have them
+        """
+        jumped = self.t is not None and (t < self.t - EPS or t > self.t + self.chunk_size + self.step)
+        if self.source is None or jumped or self.clock.step != self.step:
+            sparse = self.clock.step > SPARSE_STEPS * self.interval
+            # a dense source survives a speed change, a sparse one is on the grid of the old speed
+            if self.source is None or jumped or sparse or self.sparse:
+                self._open(t)
+            self.step = self.clock.step
+        while not self.exhausted and self.last <= t + EPS:
+            try:
+                self._ingest(next(self.source))
+            except StopIteration:
+                self.exhausted = True
+        self.t = t
+        self.frames += 1
+        self._expire(t)
+
+        n = len(self.ids)
+        t_a, t_b = self.t_a[:n], self.t_b[:n]
+        exact = np.abs(t_b - t) <= EPS
+        with np.errstate(invalid="ignore"): # free slots: -inf - -inf
+            between = (t_a <= t + EPS) & (t < t_b - EPS) & (t_b - t_a <= 1.5 * self.interval)
+        slots = np.flatnonzero(self.live[:n] & (exact | between))
+        w = np.zeros(len(slots))
+        inside = between[slots] & ~exact[slots]
+        span = t_b[slots][inside] - t_a[slots][inside]
+        w[inside] = (t_b[slots][inside] - t) / np.where(span > 0, span, 1)
+        positions = (1 - w)[:, None] * self.p_b[slots] + w[:, None] * self.p_a[slots]
+        doc = {"_id": self.frames - 1, "timestamp": t, "id": [self.ids[slot] for slot in slots], "position": positions}
+        if self.has_dims:
+            doc["dimensions"] = self.dims[slots]
+        return doc
+
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Frame at the next time of the clock, for an engine used as a document cursor on its own
+        """
+        return self.frame(next(self.clock))
+
+    next = __next__
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+
+
+    def summary(self):
+        return {"name": getattr(self.dbr, "name", ""), "frames": self.frames, "documents": self.documents,
+                "documents_per_frame": self.documents / self.frames if self.frames else 0.0,
+                "sparse": bool(self.sparse), "reopened": self.reopened, "vehicles": len(self.slots)}
+
+
+
+class PlaybackTimeline():
+    """
+    Frames of several engines at the times of one clock, like MergedTimeline
+    Each iteration yields {"timestamp": t, "docs": [doc or None per engine]}, None where an engine has no vehicle
+    """
+    def __init__(self, engines, clock):
+        self.engines = list(engines)
+        self.clock = clock
+        self.frames = 0
+        self.missing = [0] * len(self.engines)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t = next(self.clock)
+        docs = []
+        for i, engine in enumerate(self.engines):
+            doc = engine.frame(t)
+            if not doc["id"]:
+                doc = None
+                self.missing[i] += 1
+            docs.append(doc)
+        self.frames += 1
+        return {"timestamp": t, "docs": docs}
+
+    next = __next__
+
+    def set_speed(self, speed):
+        return self.clock.set_speed(speed)
+
+    def close(self):
+        for engine in self.engines:
+            engine.close()
+
+    def summary(self):
+        return [engine.summary() for engine in self.engines]
+
+
+
+class RealtimeScheduler():
+    """
+    Wall-clock pacing of a PlaybackClock
+    The next frame of the clock is due (t - t0)/speed seconds after t0 was due. sync(), called
+    before fetching a frame, drops the display times that are more than max_lag late, so that
+    playback catches up with the wall clock instead of drifting behind it. A seek or a speed
+    change of the clock restarts the pacing from its next frame, so does rebase() (after a pause).
+    clock: PlaybackClock
+    max_lag: (sec) lateness tolerated before frames are dropped, one frame by default
+    """
+    def __init__(self, clock, max_lag = None):
+        self.clock = clock
+        self.max_lag = max_lag if max_lag is not None else 1 / clock.framerate
+        self.generation = None # of the clock at the last rebase
+        self.t0 = self.wall0 = None
+        # counters
+        self.frames = 0
+        self.dropped = 0
+        self.lag = 0.0 # (sec) lateness of the last frame, negative if early
+        self.total_lag = 0.0
+        self.worst_lag = 0.0
+
+    def rebase(self):
+        """
+        Make the next frame of the clock due now
+        """
+        self.generation = self.clock.generation
+        self.t0 = self.clock.next_time
+        self.wall0 = time.perf_counter()
+
+    def due(self, t):
+        """
+        Wall-clock time (perf_counter) at which the frame of data time t is due
+        """
+        return self.wall0 + (t - self.t0) / self.clock.speed
+
+    def sync(self):
+        """
+        Skip the display times already late, before the next frame is fetched
+        return: number of frames dropped
+        """
+        if self.generation != self.clock.generation:
+            self.rebase()
+        late = time.perf_counter() - self.due(self.clock.next_time)
+        dropped = 0
+        if late > self.max_lag:
+            # the last display time due by now
+            dropped = int(late * self.clock.framerate)
+            self.clock.skip(dropped)
+            late -= dropped / self.clock.framerate
+        self.lag = late
+        self.frames += 1
+        self.dropped += dropped
+        self.total_lag += max(late, 0)
+        self.worst_lag = max(self.worst_lag, late)
+        return dropped
+
+    def wait(self):
+        """
+        (sec) time left until the next frame of the clock is due, 0 if late
+        """
+        if self.wall0 is None:
+            return 1 / self.clock.framerate
+        return max(0.0, self.due(self.clock.next_time) - time.perf_counter())
+
+    def summary(self):
+        return {"frames": self.frames, "dropped": self.dropped, "lag_ms": self.lag * 1000,
+                "mean_lag_ms": self.total_lag / self.frames * 1000 if self.frames else 0.0,
+                "max_lag_ms": self.worst_lag * 1000}
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 21 09:48:10 2022
+
+Light-weight per-stage timing for the renderers.
+Every renderer owns a StageTimer (self.timer) and wraps the parts of a frame in
+    with self.timer.stage("fetch"):
+        ...
+Stages used across the visualizers: fetch, cache, geometry, draw, encode.
+"""
+
+import time
+import resource
+import sys
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class StageTimer():
+    """
+    Collects one duration per stage per frame
+    Call next_frame() once per frame; stages entered several times in a frame are summed.
+    """
+    def __init__(self):
+        self.samples = defaultdict(list) # stage -> [sec per frame]
+        self.current = defaultdict(float)
+        self.frames = 0
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[name] += time.perf_counter() - start
+
+    def add(self, name, elapsed):
+        self.current[name] += elapsed
+
+    def next_frame(self):
+        """
+        Close the current frame. Stages not entered in this frame count as 0
+        Does nothing if no stage was entered since the last call
+        """
+        if not self.current:
+            return
+        for name in set(self.samples) | set(self.current):
+            self.samples[name].append(self.current.get(name, 0.0))
+        for name in self.current:
+            if len(self.samples[name]) < self.frames + 1: # first time seen: pad earlier frames
+                self.samples[name][:0] = [0.0] * (self.frames + 1 - len(self.samples[name]))
+        self.current.clear()
+        self.frames += 1
+
+    def reset(self):
+        self.samples.clear()
+        self.current.clear()
+        self.frames = 0
+
+    def summary(self):
+        """
+        {stage: {"mean_ms", "p50_ms", "p95_ms", "max_ms"}} over the closed frames
+        """
+        out = {}
+        for name, values in self.samples.items():
+            v = np.asarray(values) * 1000
+            out[name] = {"mean_ms": float(v.mean()),
+                         "p50_ms": float(np.percentile(v, 50)),
+                         "p95_ms": float(np.percentile(v, 95)),
+                         "max_ms": float(v.max())}
+        return out
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
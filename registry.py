@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 27 10:20:14 2022
+
+Array-backed vehicle metadata shared by the visualizers.
+Every vehicle id (ObjectId, or vehicle index of a snapshot) is interned to a dense
+integer slot. Length, width, class, stitched flag, color and the last time the
+vehicle was seen are kept in parallel NumPy arrays indexed by slot, so the
+metadata of all vehicles of a frame is one fancy-indexing gather:
+
+    slots, new = registry.intern(doc["id"], t)
+    length, width = registry.length[slots], registry.width[slots]
+
+Slots of vehicles that have not been seen for a while are released by expire()
+and reused for new vehicles. The arrays grow on demand; reserve() sizes them from
+the number of active vehicles up front. registry.summary() reports the cache counters.
+"""
+
+import sys
+import numpy as np
+from cache import CacheStats
+
+
+def id_list(ids):
+    """
+    Vehicle ids of a document as a list (snapshot documents hold arrays)
+    """
+    return ids.tolist() if isinstance(ids, np.ndarray) else list(ids)
+
+
+class VehicleRegistry():
+    """
+    Interned vehicle ids with metadata in parallel arrays
+    capacity: initial number of slots, doubled when full
+    seed: seed of the random vehicle colors
+    name: name in the cache counters
+
+    Arrays (indexed by slot):
+        length, width: (ft) NaN until set
+        vehicle_class: coarse_vehicle_class, -1 until set
+        stitched: trajectory made of more than one fragment
+        color: random RGB in [0,1)
+        palette: random non-negative integer, to pick a color from a fixed palette
+        last_seen: (sec) time of the last intern() or set by the caller, for expire()
+    """
+
+    def __init__(self, capacity = 1024, seed = None, name = ""):
+        self.rng = np.random.default_rng(seed)
+        self.stats = CacheStats(name) # lookups of known ids are hits, registrations are loads
+        self.slots = {} # id -> slot
+        self.ids = [] # slot -> id, None for free slots
+        self.free = [] # released slots, reused first
+        self._allocate(capacity)
+
+
+    def _allocate(self, capacity):
+        old = len(self.ids)
+        def grow(array, fill):
+            out = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            out[:old] = array[:old]
+            return out
+        if old == 0:
+            self.length = np.full(capacity, np.nan, dtype=np.float32)
+            self.width = np.full(capacity, np.nan, dtype=np.float32)
+            self.vehicle_class = np.full(capacity, -1, dtype=np.int8)
+            self.stitched = np.zeros(capacity, dtype=bool)
+            self.color = np.zeros((capacity, 3), dtype=np.float32)
+            self.palette = np.zeros(capacity, dtype=np.int32)
+            self.last_seen = np.full(capacity, -np.inf)
+        else:
+            self.length = grow(self.length, np.nan)
+            self.width = grow(self.width, np.nan)
+            self.vehicle_class = grow(self.vehicle_class, -1)
+            self.stitched = grow(self.stitched, False)
+            self.color = grow(self.color, 0)
+            self.palette = grow(self.palette, 0)
+            self.last_seen = grow(self.last_seen, -np.inf)
+        self.capacity = capacity
+
+
+    def __len__(self):
+        return len(self.slots)
+
+
+    def __contains__(self, veh_id):
+        return veh_id in self.slots
+
+
+    def lookup(self, ids):
+        """
+        Slots of ids, -1 for unknown ids
+        """
+        get = self.slots.get
+        slots = np.fromiter((get(veh_id, -1) for veh_id in id_list(ids)), dtype=np.int64)
+        misses = int(np.count_nonzero(slots < 0))
+        self.stats.misses += misses
+        self.stats.hits += len(slots) - misses
+        return slots
+
+
+    def intern(self, ids, t = None):
+        """
+        Slots of ids, registering the unknown ones with a random color
+        t: if given, the ids are marked as seen at time t (scalar or one value per id)
+        return: (N,) slots, (N,) mask of the ids registered by this call
+        """
+        ids = id_list(ids)
+        slots = self.lookup(ids)
+        new = slots < 0
+        if new.any():
+            for k in np.flatnonzero(new):
+                veh_id = ids[k]
+                slot = self.slots.get(veh_id)
+                if slot is None:
+                    slot = self._take()
+                    self.slots[veh_id] = slot
+                    self.ids[slot] = veh_id
+                else: # repeated id in this call, registered once
+                    new[k] = False
+                slots[k] = slot
+            fresh = slots[new]
+            self.stats.loads += len(fresh)
+            self.length[fresh] = np.nan
+            self.width[fresh] = np.nan
+            self.vehicle_class[fresh] = -1
+            self.stitched[fresh] = False
+            self.color[fresh] = self.rng.random((len(fresh), 3))
+            self.palette[fresh] = self.rng.integers(0, 2**16, len(fresh))
+        if t is not None:
+            self.last_seen[slots] = t
+        return slots, new
+
+
+    def reserve(self, n):
+        """
+        Make room for n vehicles without growing again, see cache.size_for()
+        """
+        if n > self.capacity:
+            self._allocate(n)
+
+
+    def _take(self):
+        if self.free:
+            return self.free.pop()
+        slot = len(self.ids)
+        if slot >= self.capacity:
+            self._allocate(2 * self.capacity)
+        self.ids.append(None)
+        return slot
+
+
+    def set(self, slots, length = None, width = None, vehicle_class = None, stitched = None, last_seen = None):
+        """
+        Write metadata of slots, arguments left None are unchanged
+        """
+        if length is not None:
+            self.length[slots] = length
+        if width is not None:
+            self.width[slots] = width
+        if vehicle_class is not None:
+            self.vehicle_class[slots] = vehicle_class
+        if stitched is not None:
+            self.stitched[slots] = stitched
+        if last_seen is not None:
+            self.last_seen[slots] = last_seen
+
+
+    def dimensions(self, slots, fallback = None):
+        """
+        (N,2) length and width of slots
+        fallback: (N,>=2) dimensions used where the registry has none (e.g. from the time-indexed document)
+        """
+        dims = np.column_stack([self.length[slots], self.width[slots]]).astype(float)
+        if fallback is not None:
+            missing = (slots < 0) | np.isnan(dims[:, 0])
+            if missing.any():
+                dims[missing] = np.asarray(fallback, dtype=float).reshape(len(dims), -1)[missing, :2]
+        return dims
+
+
+    def release(self, slots):
+        """
+        Forget the vehicles of slots and make the slots available again
+        """
+        for slot in np.unique(slots):
+            veh_id = self.ids[slot]
+            if veh_id is None:
+                continue
+            del self.slots[veh_id]
+            self.ids[slot] = None
+            self.free.append(int(slot))
+            self.stats.evictions += 1
+        self.last_seen[slots] = -np.inf
+
+
+    def expire(self, before):
+        """
+        Release the vehicles last seen before time before
+        return: number of released vehicles
+        """
+        n = len(self.ids)
+        old = np.flatnonzero(self.last_seen[:n] < before)
+        old = [slot for slot in old if self.ids[slot] is not None]
+        if old:
+            self.release(np.array(old))
+        return len(old)
+
+
+    def summary(self):
+        """
+        Cache counters, bytes are the arrays plus the id tables
+        """
+        arrays = (self.length, self.width, self.vehicle_class, self.stitched, self.color, self.palette, self.last_seen)
+        self.stats.size = len(self.slots)
+        self.stats.capacity = self.capacity
+        self.stats.bytes = (sum(a.nbytes for a in arrays) + sys.getsizeof(self.slots) + sys.getsizeof(self.ids)
+                            + sys.getsizeof(self.free) + sum(sys.getsizeof(veh_id) for veh_id in self.slots))
+        return self.stats.summary()
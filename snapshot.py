@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 18 10:41:27 2022
+
+Columnar on-disk snapshots of a comparison session for offline replay.
+
+export_snapshot() dumps a time window of the time-indexed ("transformed") and
+vehicle-indexed ("trajectories"/"reconciled") collections into one directory per collection:
+
+    <path>/meta.json                    time window and collection names
+    <path>/<collection>/
+        timestamps.npy      (F,)    float64   frame timestamps, ascending
+        offsets.npy         (F+1,)  int64     frame k owns rows offsets[k]:offsets[k+1]
+        positions.npy       (M,2)   float32   x, y per vehicle per frame
+        dimensions.npy      (M,3)   float32   length, width, height per vehicle per frame (NaN if not stored)
+        vehicle_index.npy   (M,)    int32     row in the vehicle table
+        vehicle_ids.npy     (V,)    S12       ObjectId bytes of each vehicle
+        first_timestamp.npy, last_timestamp.npy     (V,) float64
+        length.npy, width.npy                       (V,) float32
+        coarse_vehicle_class.npy, n_fragments.npy, n_merged.npy   (V,) int32
+        traj_offsets.npy    (V+1,)  int64     vehicle v owns trajectory samples traj_offsets[v]:traj_offsets[v+1]
+        traj_timestamp.npy, traj_x.npy, traj_y.npy  (S,) float64/float32/float32
+
+Snapshot(path) is a read-only data backend (see backends.py): Snapshot(path).collection(database, name)
+memory-maps the arrays and serves frames as zero-copy slices.
+Vehicles are identified by their dense integer index in the snapshot instead of the ObjectId.
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from bson.objectid import ObjectId
+from backends import Backend, CollectionBackend, get_backend
+
+
+TIME_FIELDS = ["timestamps", "offsets", "positions", "dimensions", "vehicle_index"]
+VEHICLE_FIELDS = ["vehicle_ids", "first_timestamp", "last_timestamp", "length", "width",
+                  "coarse_vehicle_class", "n_fragments", "n_merged",
+                  "traj_offsets", "traj_timestamp", "traj_x", "traj_y"]
+
+
+def _first(value, default = np.nan):
+    """
+    Scalar of a field that may be stored as a list (e.g. reconciled length/width)
+    """
+    if value is None:
+        return default
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return value[0] if len(value) else default
+    return value
+
+
+def _class_code(value):
+    try:
+        return int(_first(value, -1))
+    except (TypeError, ValueError):
+        return -1
+
+
+def export_collection(dbr, veh, path, t_min, t_max, chunk_size = 10):
+    """
+    Write the columnar file set of one collection
+    dbr: CollectionBackend of the time-indexed collection
+    veh: CollectionBackend of the vehicle-indexed collection
+    path: output directory for this collection
+    t_min/t_max: (sec) time window, [t_min, t_max)
+    chunk_size: (sec) time-indexed data fetched per query
+    """
+    os.makedirs(path, exist_ok=True)
+
+    # vehicle-indexed documents active in the window define the vehicle table
+    veh_cursor = veh.find_active(t_min, t_max,
+                                 {"first_timestamp":1, "last_timestamp":1, "length":1, "width":1, "coarse_vehicle_class":1,
+                                  "fragment_ids":1, "merged_ids":1, "timestamp":1, "x_position":1, "y_position":1})
+    veh_idx = {} # ObjectId -> dense index
+    cols = {name: [] for name in ["vehicle_ids", "first_timestamp", "last_timestamp", "length", "width",
+                                  "coarse_vehicle_class", "n_fragments", "n_merged"]}
+    traj_len = [0]
+    traj_t, traj_x, traj_y = [], [], []
+
+    def add_vehicle(_id, doc = None):
+        doc = doc or {}
+        veh_idx[_id] = len(cols["vehicle_ids"])
+        cols["vehicle_ids"].append(ObjectId(_id).binary if ObjectId.is_valid(_id) else str(_id).encode()[:12])
+        cols["first_timestamp"].append(doc.get("first_timestamp", np.nan))
+        cols["last_timestamp"].append(doc.get("last_timestamp", np.nan))
+        cols["length"].append(_first(doc.get("length")))
+        cols["width"].append(_first(doc.get("width")))
+        cols["coarse_vehicle_class"].append(_class_code(doc.get("coarse_vehicle_class")))
+        cols["n_fragments"].append(len(doc.get("fragment_ids", [])))
+        cols["n_merged"].append(len(doc.get("merged_ids", [])))
+        t = doc.get("timestamp", [])
+        traj_t.append(np.asarray(t, dtype=np.float64))
+        traj_x.append(np.asarray(doc.get("x_position", []), dtype=np.float32))
+        traj_y.append(np.asarray(doc.get("y_position", []), dtype=np.float32))
+        traj_len.append(len(t))
+
+    for doc in veh_cursor:
+        add_vehicle(doc["_id"], doc)
+
+    # time-indexed documents, pulled in sorted chunks
+    timestamps, counts = [], []
+    positions, dimensions, vehicle_index = [], [], []
+    start = t_min
+    while start < t_max:
+        end = min(start + chunk_size, t_max)
+        for doc in dbr.get_range("timestamp", start, end):
+            ids = doc["id"]
+            for _id in ids:
+                if _id not in veh_idx: # fragment only present in the time-indexed collection
+                    add_vehicle(_id)
+            timestamps.append(doc["timestamp"])
+            counts.append(len(ids))
+            vehicle_index.append(np.fromiter((veh_idx[_id] for _id in ids), dtype=np.int32, count=len(ids)))
+            pos = np.asarray(doc["position"], dtype=np.float32).reshape(len(ids), -1)
+            positions.append(pos[:, :2])
+            dim = np.full((len(ids), 3), np.nan, dtype=np.float32)
+            if "dimensions" in doc and len(ids):
+                d = np.asarray(doc["dimensions"], dtype=np.float32).reshape(len(ids), -1)[:, :3]
+                dim[:, :d.shape[1]] = d
+            dimensions.append(dim)
+        start = end
+
+    offsets = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    arrays = {
+        "timestamps": np.asarray(timestamps, dtype=np.float64),
+        "offsets": offsets,
+        "positions": np.concatenate(positions) if positions else np.empty((0,2), dtype=np.float32),
+        "dimensions": np.concatenate(dimensions) if dimensions else np.empty((0,3), dtype=np.float32),
+        "vehicle_index": np.concatenate(vehicle_index) if vehicle_index else np.empty(0, dtype=np.int32),
+        "vehicle_ids": np.array(cols["vehicle_ids"], dtype="S12"),
+        "first_timestamp": np.asarray(cols["first_timestamp"], dtype=np.float64),
+        "last_timestamp": np.asarray(cols["last_timestamp"], dtype=np.float64),
+        "length": np.asarray(cols["length"], dtype=np.float32),
+        "width": np.asarray(cols["width"], dtype=np.float32),
+        "coarse_vehicle_class": np.asarray(cols["coarse_vehicle_class"], dtype=np.int32),
+        "n_fragments": np.asarray(cols["n_fragments"], dtype=np.int32),
+        "n_merged": np.asarray(cols["n_merged"], dtype=np.int32),
+        "traj_offsets": np.cumsum(traj_len, dtype=np.int64),
+        "traj_timestamp": np.concatenate(traj_t) if traj_t else np.empty(0),
+        "traj_x": np.concatenate(traj_x) if traj_x else np.empty(0, dtype=np.float32),
+        "traj_y": np.concatenate(traj_y) if traj_y else np.empty(0, dtype=np.float32),
+        }
+    write_collection(path, arrays)
+    return len(timestamps), len(cols["vehicle_ids"])
+
+
+def write_collection(path, arrays):
+    """
+    Save the columns of one collection, arrays holds every name in TIME_FIELDS + VEHICLE_FIELDS
+    """
+    os.makedirs(path, exist_ok=True)
+    for name in TIME_FIELDS + VEHICLE_FIELDS:
+        np.save(os.path.join(path, name + ".npy"), arrays[name])
+
+
+def write_meta(path, t_min, t_max, collections, databases):
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"t_min": t_min, "t_max": t_max, "collections": list(collections),
+                   "databases": list(databases)}, f, indent=2)
+
+
+def export_snapshot(config, collections, path, offset = 0, duration = None, chunk_size = 10, backend = None):
+    """
+    Dump a time window of a comparison session to a snapshot directory
+    config: dictionary for database access
+    collections: [gt, raw, rec] as for OverheadCompare
+    path: output directory
+    offset/duration: (sec) time window relative to the common time range of all collections
+    backend: data backend to export from (see backends.py), MongoDB with config by default
+    """
+    backend = get_backend(config, backend)
+    list_db = ["trajectories", "trajectories", "reconciled"] # gt, raw, rec
+    list_dbr = [backend.collection("transformed", c) for c in collections]
+    list_veh = [backend.collection(list_db[i], c) for i,c in enumerate(collections)]
+
+    t_min = max([dbr.get_min("timestamp") for dbr in list_dbr])
+    t_max = min([dbr.get_max("timestamp") for dbr in list_dbr])
+    if offset:
+        t_min += offset
+    if duration:
+        t_max = min(t_max, t_min + duration)
+
+    os.makedirs(path, exist_ok=True)
+    for i, collection in enumerate(collections):
+        n_frames, n_veh = export_collection(list_dbr[i], list_veh[i], os.path.join(path, collection),
+                                            t_min, t_max, chunk_size=chunk_size)
+        print("Exported {}: {} frames, {} vehicles".format(collection, n_frames, n_veh))
+
+    write_meta(path, t_min, t_max, collections, list_db[:len(collections)])
+
+
+
+class SnapshotCollection(CollectionBackend):
+    """
+    Memory-mapped, read-only view of one exported collection
+    Serves both the time-indexed and the vehicle-indexed reads; frames are returned
+    as dictionaries shaped like time-indexed documents whose arrays are zero-copy slices.
+    """
+
+    def __init__(self, path, name = None, stats = None):
+        super().__init__(name or os.path.basename(os.path.normpath(path)), stats)
+        self.path = path
+        for field in TIME_FIELDS + VEHICLE_FIELDS:
+            setattr(self, field, np.load(os.path.join(path, field + ".npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def frame(self, k):
+        """
+        Time-indexed document of frame k. "id" holds vehicle indices into this snapshot,
+        "_id" is the frame number
+        """
+        lo, hi = self.offsets[k], self.offsets[k+1]
+        return {"_id": k,
+                "timestamp": float(self.timestamps[k]),
+                "id": self.vehicle_index[lo:hi],
+                "position": self.positions[lo:hi],
+                "dimensions": self.dimensions[lo:hi]}
+
+    def frame_range(self, start, end):
+        """
+        Frame numbers with start <= timestamp < end
+        """
+        return (int(np.searchsorted(self.timestamps, start, side="left")),
+                int(np.searchsorted(self.timestamps, end, side="left")))
+
+    def _get_range(self, index_name, start, end, limit):
+        if index_name != "timestamp":
+            raise ValueError("snapshot frames are only indexed by timestamp")
+        lo, hi = self.frame_range(start, end)
+        if limit:
+            hi = min(hi, lo + limit)
+        return (self.frame(k) for k in range(lo, hi))
+
+    def _find_one(self, index_name, value):
+        if index_name != "timestamp":
+            raise ValueError("snapshot frames are only indexed by timestamp")
+        k = int(np.searchsorted(self.timestamps, value))
+        if k < len(self.timestamps) and self.timestamps[k] == value:
+            return self.frame(k)
+        return None
+
+    def _field(self, field):
+        if field == "timestamp":
+            return self.timestamps
+        if field in ("first_timestamp", "last_timestamp"):
+            return getattr(self, field)
+        if field in ("starting_x", "ending_x"):
+            return self.traj_x
+        raise ValueError("field {} is not stored in snapshots".format(field))
+
+    def _get_min(self, field):
+        values = self._field(field)
+        return float(np.nanmin(values)) if len(values) else None
+
+    def _get_max(self, field):
+        values = self._field(field)
+        return float(np.nanmax(values)) if len(values) else None
+
+    def vehicle(self, v):
+        """
+        Vehicle-indexed document of vehicle index v
+        """
+        lo, hi = self.traj_offsets[v], self.traj_offsets[v+1]
+        return {"_id": int(v),
+                "first_timestamp": float(self.first_timestamp[v]),
+                "last_timestamp": float(self.last_timestamp[v]),
+                "length": float(self.length[v]),
+                "width": float(self.width[v]),
+                "coarse_vehicle_class": int(self.coarse_vehicle_class[v]),
+                "fragment_ids": [None] * int(self.n_fragments[v]),
+                "merged_ids": [None] * int(self.n_merged[v]),
+                "timestamp": self.traj_timestamp[lo:hi],
+                "x_position": self.traj_x[lo:hi],
+                "y_position": self.traj_y[lo:hi]}
+
+    def _count(self):
+        return len(self.timestamps)
+
+    def _find_ids(self, ids, projection):
+        # vehicle indices of this snapshot, projection is ignored
+        return (self.vehicle(int(v)) for v in ids)
+
+    def _find_active(self, t_min, t_max, projection):
+        active = np.flatnonzero((self.first_timestamp <= t_max) & (self.last_timestamp >= t_min))
+        return (self.vehicle(int(v)) for v in active)
+
+    def _find_starting(self, t_start, t_end, projection):
+        starting = np.flatnonzero((self.first_timestamp >= t_start) & (self.first_timestamp < t_end))
+        starting = starting[np.argsort(-self.last_timestamp[starting], kind="stable")]
+        return (self.vehicle(int(v)) for v in starting)
+
+    def _get_columns(self, fields):
+        # time-indexed fields are in frame order, vehicle-indexed ones are sorted here
+        columns = {"timestamp": self.timestamps, "_id": np.arange(len(self.first_timestamp)),
+                   "first_timestamp": self.first_timestamp, "last_timestamp": self.last_timestamp}
+        for field in fields:
+            if field not in columns:
+                raise ValueError("field {} is not stored in snapshots".format(field))
+        if fields[0] == "timestamp":
+            return {field: columns[field] for field in fields}
+        order = np.argsort(columns[fields[0]], kind="stable")
+        return {field: columns[field][order] for field in fields}
+
+    def _change_token(self):
+        # snapshots are written once, a new export replaces the arrays
+        return [len(self.timestamps), os.path.getmtime(os.path.join(self.path, "timestamps.npy"))]
+
+    def object_id(self, v):
+        """
+        Original ObjectId of vehicle index v
+        """
+        return ObjectId(bytes(self.vehicle_ids[v]))
+
+
+
+class Snapshot(Backend):
+    """
+    Read-only backend for a snapshot directory written by export_snapshot()
+    Each collection directory holds both the time-indexed and the vehicle-indexed data,
+    so the database name is ignored.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.t_min = self.meta["t_min"]
+        self.t_max = self.meta["t_max"]
+        self.collections = self.meta["collections"]
+        self._cache = {}
+
+    def collection(self, database, name):
+        if name not in self.collections:
+            raise ValueError("collection {} is not in snapshot {}".format(name, self.path))
+        if name not in self._cache:
+            self._cache[name] = SnapshotCollection(os.path.join(self.path, name), name, self.stats)
+        return self._cache[name]
+
+    def list_collection_names(self, database):
+        return list(self.collections)
+
+    def catalog_key(self):
+        return "snapshot://" + os.path.abspath(self.path)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a comparison session to a columnar snapshot for offline replay")
+    parser.add_argument("rec", help="reconciled collection name, raw collection is derived from it")
+    parser.add_argument("out", help="output directory")
+    parser.add_argument("--gt", default="groundtruth_scene_2_57")
+    parser.add_argument("--config", default=os.path.join(os.environ.get("USER_CONFIG_DIRECTORY", "."), "db_param.json"))
+    parser.add_argument("--offset", type=float, default=0, help="(sec) from the start of the common time range")
+    parser.add_argument("--duration", type=float, default=None, help="(sec)")
+    parser.add_argument("--chunk-size", type=float, default=10, help="(sec) time-indexed data per query")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        db_param = json.load(f)
+    raw = args.rec.split("__")[0]
+    export_snapshot(db_param, [args.gt, raw, args.rec], args.out,
+                    offset=args.offset, duration=args.duration, chunk_size=args.chunk_size)
+
+
+if __name__=="__main__":
+    main()
@@ -12,8 +12,7 @@ TODOs
 - if transformed collection is not available, plot time-space instead
 """
 
-from i24_database_api.db_reader import DBReader
-from i24_database_api import transform
+from backends import get_backend
 # from i24_configparse import parse_cfg
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
@@ -21,43 +20,67 @@ import numpy as np
 import os
 import matplotlib.animation as animation
 import matplotlib.ticker as mticker
+from matplotlib.collections import LineCollection
 from datetime import datetime
 from i24_logger.log_writer import logger, catch_critical
 import queue
+import heapq
+import itertools
 import mplcursors
-from collections import OrderedDict
 import json
 import sys
+from time import perf_counter
+from profiling import StageTimer
+from registry import VehicleRegistry
+from cache import LRUCache, size_for
+from lod import LODStats, decimate, pixels_per_unit
+from transform import transform_collection
+from catalog import Catalog
+from playback import PlaybackClock, PlaybackEngine, clamp_speed
+from keyframes import KeyframeIndex, SCRUB_STEP
 
- 
-class LRUCache:
+
+def lane_runs(trajs, lanes):
     """
-    A least-recently-used cache with integer capacity
-    To roll out of the cache for vehicle color and dimensions
-    get(): return the key-value in cache if exists, otherwise return -1
-    put(): (no update) 
+    Split trajectories into per-lane polylines, all trajectories of a query at once
+    The points of all trajectories are concatenated, lanes are found with one digitize
+    and runs with one diff of the lane index (a run also ends where a trajectory ends)
+    trajs: vehicle-indexed documents with timestamp, x_position and y_position
+    lanes: lane boundaries, see Plotter.lanes
+    return: {_id: [(lane index, timestamp (N,), x_position (N,))]}, one entry per lane visited,
+            separate runs in the same lane are joined with NaN so that they are not connected
     """
-    def __init__(self, capacity: int):
-        self.cache = OrderedDict()
-        self.capacity = capacity
- 
-    def get(self, key: int) -> int:
-        if key not in self.cache:
-            return -1
+    out = {traj["_id"]: [] for traj in trajs}
+    counts = np.array([len(traj["timestamp"]) for traj in trajs], dtype=int)
+    if counts.sum() == 0:
+        return out
+    t = np.concatenate([np.asarray(traj["timestamp"], dtype=float) for traj in trajs])
+    x = np.concatenate([np.asarray(traj["x_position"], dtype=float) for traj in trajs])
+    y = np.concatenate([np.asarray(traj["y_position"], dtype=float) for traj in trajs])
+    lane = np.digitize(y, lanes) - 1
+    
+    ends = np.cumsum(counts)
+    starts = np.union1d(np.flatnonzero(np.diff(lane)) + 1, (ends - counts)[counts > 0])
+    stops = np.append(starts[1:], len(t))
+    owners = np.searchsorted(ends, starts, side="right")
+    
+    runs = {} # (trajectory, lane) -> [(start, stop)] in order of first visit
+    for start, stop, owner in zip(starts.tolist(), stops.tolist(), owners.tolist()):
+        runs.setdefault((owner, int(lane[start])), []).append((start, stop))
+    for (owner, idx), pieces in runs.items():
+        if len(pieces) == 1:
+            start, stop = pieces[0]
+            seg_t, seg_x = t[start:stop], x[start:stop]
         else:
-            self.cache.move_to_end(key)
-            return self.cache[key]
+            sel = np.concatenate([np.append(np.arange(start, stop), -1) for start, stop in pieces])[:-1]
+            gap = sel < 0
+            seg_t, seg_x = t[sel], x[sel]
+            seg_t[gap] = np.nan
+            seg_x[gap] = np.nan
+        out[trajs[owner]["_id"]].append((idx, seg_t, seg_x))
+    return out
+
  
-    def put(self, key: int, value: int) -> None:
-        if key not in self.cache: # do not update with new value
-            self.cache[key] = value
-        self.cache.move_to_end(key)
-        if len(self.cache) > self.capacity:
-            self.cache.popitem(last = False)
-            
-            
-            
-            
 class Plotter():
     """
     Create a time-space diagram for a specified time-space window
@@ -73,7 +96,8 @@ class Plotter():
     def __init__(self, config, 
                  vehicle_database = None, vehicle_collection = None, 
                  timestamp_database = None, timestamp_collection = None,
-                 window_size = 10, framerate = 25, x_min = 1000, x_max = 2000, duration = 60, transform_data=False):
+                 window_size = 10, framerate = 25, x_min = 1000, x_max = 2000, duration = 60, transform_data=False,
+                 speed = 1.0, resample = False, snapshot = None, backend = None):
         """
         Initializes a Plotter object
         
@@ -88,31 +112,39 @@ class Plotter():
         framerate: (FPS) rate to query timestamps and to advance the animation
         x_min/x_max: (feet) roadway range for overhead view
         duration: (sec) duration for animation
+        speed: playback speed, data seconds per second of display (0.25 to 16), see playback.py
+        resample: interpolate the overhead view at the display times. Off by default, every frame is then the next stored document
+        snapshot: path to a directory written by snapshot.export_snapshot(), replay from it without database access
+        backend: data backend (see backends.py), overrides config and snapshot
         """
+        self.backend = get_backend(config, backend, snapshot)
+        self.catalog = Catalog(self.backend) # no round trip for known collections
         
         # Check plotting mode: time-space / overhead / both
         if timestamp_database and timestamp_collection:
             self.overhead_view = True
-            self.dbr_t = DBReader(config, host = config["host"], username = config["username"], password = config["password"], port = config["port"], database_name = timestamp_database, collection_name=timestamp_collection)
             if transform_data:
                 print("Transform to time-indexed collection first")
-                transform(host=config["host"], 
-                          port=config["port"], 
-                          username="i24-data", 
-                          password=config["password"], 
-                          read_database_name=vehicle_database, 
-                          read_collection_name=timestamp_collection)
+                transform_collection(self.backend, vehicle_database, timestamp_collection, framerate=framerate or 25)
+                self.catalog.invalidate("transformed", timestamp_collection)
+            self.dbr_t = self.catalog.collection(timestamp_database, timestamp_collection)
+            self.sample_interval = self.catalog.sample_interval(timestamp_database, timestamp_collection) if resample else None
                     
         else:
             self.overhead_view = False
         if vehicle_database and vehicle_collection:
             self.timespace_view = True
-            self.dbr = DBReader(config, host = config["host"], username = config["username"], password = config["password"], port = config["port"], database_name = vehicle_database, collection_name=vehicle_collection)
-            t_min = self.dbr.get_min("first_timestamp")
+            self.dbr = self.catalog.collection(vehicle_database, vehicle_collection)
+            t_min = self.catalog.range(vehicle_database, vehicle_collection, "first_timestamp")[0]
             if duration: t_max = t_min+duration 
-            else: t_max = self.dbr.get_max("last_timestamp")
-            if x_min is None: x_min = min(self.dbr.get_min("starting_x"), self.dbr.get_min("ending_x"),self.dbr.get_max("starting_x"), self.dbr.get_max("ending_x"))
-            if x_max is None: x_max = max(self.dbr.get_max("starting_x"), self.dbr.get_max("ending_x"),self.dbr.get_min("starting_x"), self.dbr.get_min("ending_x"))
+            else: t_max = self.catalog.range(vehicle_database, vehicle_collection, "last_timestamp")[1]
+            if x_min is None or x_max is None:
+                # either direction: starting_x may be larger than ending_x
+                x_range = self.catalog.range(vehicle_database, vehicle_collection, "starting_x") + \
+                          self.catalog.range(vehicle_database, vehicle_collection, "ending_x")
+                if x_min is None: x_min = min(x_range)
+                if x_max is None: x_max = max(x_range)
+            self.catalog.check()
         else:
             self.timespace_view = False # current time-space view is required
         
@@ -135,6 +167,13 @@ class Plotter():
         self.anim = None
         self.window_size = window_size
         self.framerate = framerate if framerate else 25
+        self.speed = clamp_speed(speed)
+        self.resample = resample
+        self.clock = None
+        self.time_cursor = None
+        self.keyframes = None # built on the first seek
+        self.seek_to = None # (sec) applied by the next frame
+        self.paused = False
         
         self.lanes = [i*12 for i in range(-1,12)]   
         self.lane_name = [ "EBRS", "EB4", "EB3", "EB2", "EB1", "EBLS", "WBLS", "WB1", "WB2", "WB3", "WB4", "WBRS"]
@@ -144,24 +183,42 @@ class Plotter():
         self.vl_queue = queue.Queue() # for updating vertical lines
         self.annot_queue = queue.Queue()
         self.cursor = None
+        self.timer = StageTimer() # per-frame stage timing, see benchmark.py
         
 
     
         
     @catch_critical(errors = (Exception))
-    def animate(self, save = False):
+    def animate(self, save = False, show = True):
         """
         Advance time window by delta second, update left and right pointer, and cache
+        show: if False, set up the figure and animation and return it without showing or saving (headless driving)
         """     
         # set figures: two rows. Top: east, bottom: west. 4 lanes in each direction
         if self.overhead_view and self.timespace_view:
             fig, axs = plt.subplots(3,6,figsize=(34,8))
         elif self.timespace_view:
             fig, axs = plt.subplots(2,6,figsize=(30,8))
+        self.fig = fig
         
-        # TODO: make size parameters
-        cache_vehicle = LRUCache(200)
-        cache_colors = LRUCache(200)
+        # vehicle dimensions and colors by interned vehicle id, released once out of the time window
+        registry = VehicleRegistry(name=self.dbr.name)
+        self.registry = registry
+        # time-space lines by the last timestamp they show: (last timestamp, line key, lane index)
+        expiry = []
+        keys = itertools.count()
+        self.expiry = expiry
+        # one LineCollection per lane axis, its lines by key: key -> ((N,2) points, color, (M,2) drawn points)
+        lane_lines = [{} for _ in self.lane_idx]
+        self.lane_lines = lane_lines
+        # level of detail: lines are decimated to the pixel columns of their lane axis, see lod.py
+        self.lod = LODStats()
+        lod_scale = [0.0 for _ in self.lane_idx] # pixels per sec used for the drawn points
+        # HH:MM:SS by integer timestamp, formatted once per second shown on the time axes
+        time_labels = LRUCache(64, loader=lambda t: datetime.utcfromtimestamp(t).strftime('%H:%M:%S'), name="time ticks")
+        time_formatter = mticker.FuncFormatter(lambda t, pos: time_labels.get(int(t)))
+        # per-lane polylines by trajectory id, see lane_runs()
+        self.lane_cache = LRUCache(size_for(0), name="lane runs")
         
         
         # OVERHEAD VIEW SETUP
@@ -179,9 +236,15 @@ class Plotter():
                 # ax1.set(xlim=new_xlim)
                 self.x_start = new_xlim[0]
                 self.x_end = new_xlim[1]
+                update_lod()
             ax_o.callbacks.connect('xlim_changed', on_xlims_change)
        
-            self.time_cursor = self.dbr_t.collection.find().sort([("timestamp", 1)]).limit(0) # no limit
+            if self.resample:
+                # one frame every speed/framerate sec of data, positions interpolated (see playback.py)
+                self.clock = PlaybackClock(self.t_min, self.t_max, self.framerate, self.speed)
+                self.time_cursor = PlaybackEngine(self.dbr_t, self.clock, interval=self.sample_interval)
+            else:
+                self.time_cursor = self.dbr_t.get_range("timestamp", float("-inf"), float("inf")) # no limit
             plt.gcf().autofmt_xdate()
         
         # TIME-SPACE VIEW SETUP
@@ -197,10 +260,38 @@ class Plotter():
             if i in [5,6]: # left
                 ax.set_ylabel("Distance in feet")
                 ax.yaxis.set_visible(True)
-            # TODO: labels don't show
-            # labels = ax.get_xticks()
-            # labels = [datetime.utcfromtimestamp(int(t)).strftime('%H:%M:%S') for t in labels]
-            # ax.set_xticklabels(labels)
+            # one time tick per axis, labelled by the cached formatter
+            ax.xaxis.set_major_locator(mticker.MaxNLocator(1))
+            ax.xaxis.set_major_formatter(time_formatter)
+        lane_axes = [axs[self.lane_ax[i][0], self.lane_ax[i][1]] for i in self.lane_idx]
+        self.lane_collections = [ax.add_collection(LineCollection([]), autolim=False) for ax in lane_axes]
+        
+        def drawn_points(idx, points):
+            keep = decimate(points[:,0], points[:,1], lod_scale[idx], origin=self.t_min)
+            self.lod.add(len(points), len(keep))
+            return points[keep]
+        
+        def redraw_lane(idx):
+            lines = lane_lines[idx].values()
+            self.lane_collections[idx].set_segments([drawn for _, _, drawn in lines])
+            self.lane_collections[idx].set_color([color for _, color, _ in lines])
+        
+        def update_lod(*args):
+            """
+            Decimate the lines of the lanes whose axis scale changed by more than 10% again (zoom, resize)
+            """
+            for idx, ax in enumerate(lane_axes):
+                scale = pixels_per_unit(ax)
+                if abs(scale - lod_scale[idx]) <= 0.1 * lod_scale[idx]:
+                    continue
+                lod_scale[idx] = scale
+                for key, (points, color, _) in lane_lines[idx].items():
+                    lane_lines[idx][key] = (points, color, drawn_points(idx, points))
+                redraw_lane(idx)
+        update_lod()
+        for ax in lane_axes:
+            ax.callbacks.connect('xlim_changed', update_lod)
+        fig.canvas.mpl_connect('resize_event', update_lod)
                     
         
         
@@ -225,14 +316,39 @@ class Plotter():
             delta : increment in time (sec)
                 DESCRIPTION.
             """
+            frame_start = perf_counter()
+            fetched = cached = 0 # (sec) spent in queries and caches, the rest is geometry
+            changed = set() # lanes whose collection has to be rebuilt
+            traj_data = []
+            if self.seek_to is not None:
+                # restart the window at the seek time with the trajectories active in it, nothing is replayed
+                t, self.seek_to = self.seek_to, None
+                for idx, lines in enumerate(lane_lines):
+                    lines.clear()
+                    changed.add(idx)
+                del expiry[:]
+                self.left = t - self.window_size/2
+                self.right = self.old_right = t + self.window_size/2
+                start = perf_counter()
+                ids = self.keyframe_index().active(self.left, self.right)
+                traj_data = list(self.dbr.find_ids(ids)) if ids else []
+                if self.overhead_view and self.clock is not None:
+                    self.clock.seek(t) # the engine reopens its source on a jump
+                elif self.overhead_view:
+                    self.time_cursor = self.dbr_t.get_range("timestamp", t - 0.5/self.framerate, float("inf"))
+                fetched += perf_counter() - start
+            
             # Stop criteria
             if (self.left + self.right)/2 >= self.t_max:
                 print("Reach the end of time. Exit.")
+                self.anim.event_source.stop() # until a seek
                 raise StopIteration
             
             if self.overhead_view:
                 # --------------- OVERHEAD VIEW ---------------------
-                doc = self.time_cursor.next()
+                start = perf_counter()
+                doc = next(self.time_cursor)
+                fetched += perf_counter() - start
                 curr_time = doc["timestamp"]
                 time_text = datetime.utcfromtimestamp(int(curr_time)).strftime('%m/%d/%Y, %H:%M:%S')
                 ax_o.set_title(time_text)
@@ -247,35 +363,45 @@ class Plotter():
                 while not self.annot_queue.empty():
                     self.annot_queue.get(block=False).remove()
                     
-                # Add vehicle ids in cache_colors             
-                for veh_id in doc['id']:
-                    cache_colors.put(veh_id, np.random.rand(3,))
+                # register new vehicle ids with a random color
+                start = perf_counter()
+                slots, new = registry.intern(doc['id'], curr_time)
                     
-                # query for vehicle dimensions if not in doc
-                if "dimensions" not in doc:
-                    traj_cursor = self.dbr.collection.find({"_id": {"$in": doc["id"]} }, 
-                                                                    {"width":1, "length":1, "coarse_vehicle_class": 1})
-                    # add vehicle dimension to cache
-                    for index, traj in enumerate(traj_cursor):
-                        # print("index: {} is {}".format(index, traj))
-                        # { ObjectId('...') : [length, width, coarse_vehicle_class] }
-                        
-                        cache_vehicle.put(traj["_id"], [traj["length"], traj["width"], traj["coarse_vehicle_class"]])
+                # query for vehicle dimensions if not in doc. Slots interned by the time-space
+                # lines are not new but have no dimensions yet, fill every slot still without them
+                missing = np.isnan(registry.length[slots]) | np.isnan(registry.width[slots])
+                if not missing.any():
+                    pass
+                elif "dimensions" not in doc:
+                    missing_ids = [registry.ids[slot] for slot in np.unique(slots[missing])]
+                    traj_cursor = self.dbr.find_ids(missing_ids, {"width":1, "length":1, "coarse_vehicle_class": 1})
+                    # add vehicle dimension to the registry
+                    for traj in traj_cursor:
+                        registry.set(registry.slots[traj["_id"]], length=traj["length"], width=traj["width"],
+                                     vehicle_class=traj["coarse_vehicle_class"])
                 else:
-                    for index, veh_id in enumerate(doc['id']):
-                        cache_vehicle.put(veh_id, doc['dimensions'][index])
+                    dims = np.asarray(doc['dimensions'], dtype=float)[missing]
+                    registry.set(slots[missing], length=dims[:,0], width=dims[:,1])
+                dims = registry.dimensions(slots)
+                colors = registry.color[slots]
+                cached += perf_counter() - start
                 
             
                 # plot vehicles
+                skipped = 0
                 for index in range(len(doc["position"])):
                     car_x_pos = doc["position"][index][0]
                     car_y_pos = doc["position"][index][1]
     
-                    car_length, car_width, _ = cache_vehicle.get(doc["id"][index])
+                    car_length, car_width = dims[index]
+                    # a box with a NaN corner is silently not drawn, skip it and say so
+                    if not np.isfinite([car_x_pos, car_y_pos, car_length, car_width]).all():
+                        skipped += 1
+                        continue
 
                     box = patches.Rectangle((car_x_pos, car_y_pos),
                                             car_length, car_width, 
-                                            color=cache_colors.get(doc["id"][index]),
+                                            color=colors[index],
                                             # color = np.array([str_to_float(str(doc["id"])[i*8:i*8+8]) for i in range(3)]),
                                             label=doc["id"][index])
                     ax_o.add_patch(box)   
@@ -283,6 +409,8 @@ class Plotter():
                     annot = ax_o.annotate(doc['_id'], xy=(car_x_pos,car_y_pos))
                     annot.set_visible(False)
                     self.annot_queue.put(annot)
+                if skipped:
+                    print("{} vehicles at {:.2f} s have no finite box and are not drawn".format(skipped, curr_time))
                 
                 
             # --------------- TIME-SPACE VIS ---------------------
@@ -294,21 +422,12 @@ class Plotter():
                 if self.overhead_view:
                     vl = ax.axvline(x=curr_time, c='k', linewidth='0.5', linestyle='--')
                     self.vl_queue.put(vl)
-                    
-                # TODO: labels don't show?
-                # labels = ax.get_xticks()
-                # labels = [datetime.utcfromtimestamp(int(t)).strftime('%H:%M:%S') for t in labels]
-                # ax.set_xticklabels(labels)
-                ax.xaxis.set_major_locator(mticker.MaxNLocator(1))
-                ticks_loc = ax.get_xticks().tolist()
-                ax.xaxis.set_major_locator(mticker.FixedLocator(ticks_loc))
-                labels = [datetime.utcfromtimestamp(int(t)).strftime('%H:%M:%S') for t in ticks_loc]
-                ax.set_xticklabels(labels)
                         
                 
             # re-query for those whose first_timestamp is in the incremented time window
-            traj_data = self.dbr.read_query(query_filter= { "first_timestamp" : {"$gte" : self.old_right, "$lt" : self.right}},
-                                            query_sort = [("last_timestamp", "DSC")])
+            start = perf_counter()
+            traj_data += list(self.dbr.find_starting(self.old_right, self.right))
+            fetched += perf_counter() - start
             
             # roll time window forward
             if self.overhead_view:
@@ -317,55 +436,65 @@ class Plotter():
                 self.right = doc['timestamp'] + self.window_size/2
             else:
                 self.old_right = self.right
-                self.right += 1/framerate
+                self.right += self.speed/self.framerate
                 self.left = self.right - self.window_size
             
             # remove trajectories whose last_timestamp is below left
-            # lines are ordered by DESCENDING last_timestamp
-            axs_flatten = [ax for row in axs[:2] for ax in row]
-            for ax in axs_flatten: # first row
-                for line in ax.get_lines():
-                    if line.get_xdata()[-1] < self.left:
-                        line.remove()
+            # only the lines that left the window are popped, the rest of the heap is not visited
+            while expiry and expiry[0][0] < self.left:
+                _, key, idx = heapq.heappop(expiry)
+                del lane_lines[idx][key]
+                changed.add(idx)
+            registry.expire(self.left)
                  
             
             # add trajectory lines, assign them to the corresponding lanes
+            self.lane_cache.resize(size_for(len(registry) + len(traj_data)))
+            new_trajs = [traj for traj in traj_data if traj["_id"] not in self.lane_cache]
+            for traj_id, segments in lane_runs(new_trajs, self.lanes).items():
+                self.lane_cache.put(traj_id, segments)
             for traj in traj_data:
-            # select sub-document for each lane
-                lane_idx = np.digitize(traj["y_position"], self.lanes)-1 # should be between 6-11
-                for idx in np.unique(lane_idx):
-                    select = lane_idx == idx # select only lane i
-                    time = np.array(traj["timestamp"])[select]
-                    x = np.array(traj["x_position"])[select]
-                    try:
-                        # if traj["_id"] not in cache_colors:
-                        #     cache_colors[traj["_id"]] = np.random.rand(3,)
-                        cache_colors.put(traj["_id"], np.random.rand(3,))
-                        # color = np.array([str_to_float(str(traj["_id"])[i*8:i*8+8]) for i in range(3)]),
-                        pos = self.lane_ax[idx]
-                        line, = axs[pos[0], pos[1]].plot(time, x, c=cache_colors.get(traj["_id"]))
-                           
-                    except Exception as e:
-                        print(e)
-                        # print("lane idx {} is out of bound for EB".format(idx))
-                        pass
+                # color per trajectory, kept until its last timestamp leaves the window
+                slot = registry.intern([traj["_id"]], traj["timestamp"][-1])[0][0]
+                for idx, time, x in self.lane_cache.get(traj["_id"]):
+                    if not 0 <= idx < len(self.lane_ax): # off the road
+                        continue
+                    # color = np.array([str_to_float(str(traj["_id"])[i*8:i*8+8]) for i in range(3)]),
+                    key = next(keys)
+                    points = np.column_stack([time, x])
+                    lane_lines[idx][key] = (points, registry.color[slot], drawn_points(idx, points))
+                    heapq.heappush(expiry, (time[-1], key, idx))
+                    changed.add(idx)
+            
+            # replace the segments and colors of the lanes that changed, the collections stay on the axes
+            for idx in changed:
+                redraw_lane(idx)
+            
+            self.timer.add("fetch", fetched)
+            self.timer.add("cache", cached)
+            self.timer.add("geometry", perf_counter() - frame_start - fetched - cached)
             return axs
         
         
         frame_text = None
         self.anim = animation.FuncAnimation(fig, func=update_cache,
                                             init_func= init,
-                                            frames=int(self.t_max-self.t_min)*self.framerate,
+                                            # shown: until the data ends, whatever the speed changes
+                                            frames=None if show and not save else int((self.t_max-self.t_min)/self.speed*self.framerate),
                                             repeat=False,
                                             interval=1/self.framerate * 1000, # in ms
                                             fargs=( frame_text), # specify time increment in sec to update query
-                                            blit=False)
+                                            blit=False,
+                                            cache_frame_data = False)
         self.paused = False
         fig.canvas.mpl_connect('key_press_event', self.toggle_pause)
-
+        self.init_frame = init
+        self.update_frame = update_cache
+        if not show:
+            return self.anim
         
         if save:
-            file_name = "anim_" + self.dbr.collection._Collection__name
+            file_name = "anim_" + self.dbr.name
             if self.timespace_view:
                 file_name += "_timespace"
             if self.overhead_view:
@@ -375,16 +504,173 @@ class Plotter():
         else:
             fig.tight_layout()
             plt.show()
+        print("cache {name}: {hits} hits, {misses} misses, {evictions} evictions, {size}/{capacity} entries, {bytes} bytes".format(**self.registry.summary()))
+        print("time-space vertices: {vertices} queried, {drawn} drawn ({reduction:.1f}x fewer)".format(**self.lod.summary()))
+        self.close_sources()
         print("complete")
         
+    
+    def set_speed(self, speed):
+        """
+        Change the playback speed of a running animation, see playback.MIN_SPEED and MAX_SPEED
+        """
+        self.speed = self.clock.set_speed(speed) if self.clock is not None else clamp_speed(speed)
+        print("speed {}x".format(self.speed))
+        return self.speed
+    
+    
+    def keyframe_index(self):
+        """
+        Keyframe index of the trajectories (see keyframes.py), built on the first call
+        """
+        if self.keyframes is None:
+            self.keyframes = KeyframeIndex(self.dbr)
+            print("keyframes: ", self.keyframes.summary())
+        return self.keyframes
+    
+    
+    def seek(self, t):
+        """
+        Center the time window on t (sec, clamped to [t_min, t_max]) from the next frame on,
+        redrawn at once when paused. The lines are reloaded from the trajectories active in the window
+        """
+        self.seek_to = min(max(t, self.t_min), self.t_max)
+        if self.paused:
+            self.update_frame(None)
+            self.fig.canvas.draw_idle()
+        elif self.anim is not None:
+            self.anim.event_source.start() # stopped at the end of the data
+    
+    
+    def step(self, n = 1):
+        """
+        Move n frames forward (backward if n < 0) from the current frame
+        """
+        self.seek((self.left + self.right)/2 + n * self.speed/self.framerate)
+    
+    
+    def close_sources(self):
+        """
+        Stop the read-ahead thread of the overhead view
+        """
+        if hasattr(self.time_cursor, "close"):
+            self.time_cursor.close()
+    
+    
+    def cache_stats(self):
+        """
+        Counters of the collection catalog and of the vehicle registry of the last animation
+        """
+        return [self.catalog.summary(), self.registry.summary()]
+    
+    
+    def density(self, file_name = None, time_res = 1.0, x_res = 10.0, chunk = 60, speed = False, dpi = 200):
+        """
+        Static time-space rendering of the whole range [t_min, t_max], for runs too long to animate
+        Trajectories are streamed chunk by chunk (each one once, by first_timestamp) and their
+        points binned into one (time, x) accumulation grid per lane, so memory is bounded by
+        the grids and one chunk of trajectories. One image is written per direction, the lanes
+        laid out like the time-space panels of animate()
+        file_name: prefix of the images, "density_<collection>" by default
+        time_res, x_res: (sec, feet) size of a grid cell
+        chunk: (sec) span of first_timestamp fetched per query
+        speed: color cells by the mean speed of the points in them instead of the point density
+        return: {"EB": path, "WB": path}
+        """
+        start = perf_counter()
+        file_name = file_name or "density_" + self.dbr.name
+        x_lo, x_hi = sorted([self.x_start, self.x_end])
+        n_lanes = len(self.lane_idx)
+        n_t = max(1, int(np.ceil((self.t_max - self.t_min) / time_res)))
+        n_x = max(1, int(np.ceil((x_hi - x_lo) / x_res)))
+        counts = np.zeros((n_lanes, n_t, n_x), dtype=np.float32)
+        speeds = np.zeros((n_lanes, n_t, n_x), dtype=np.float32) if speed else None
+        
+        points = 0
+        projection = {"first_timestamp": 1, "timestamp": 1, "x_position": 1, "y_position": 1}
+        def batches():
+            # trajectories that started before t_min are still on the road at t_min
+            yield [traj for traj in self.dbr.find_active(self.t_min, self.t_min, projection) 
+                   if traj["first_timestamp"] < self.t_min]
+            t = self.t_min
+            while t < self.t_max:
+                yield list(self.dbr.find_starting(t, min(t + chunk, self.t_max), projection))
+                t += chunk
+        
+        for trajs in batches():
+            trajs = [traj for traj in trajs if len(traj["timestamp"]) > 0]
+            if not trajs:
+                continue
+            sizes = np.array([len(traj["timestamp"]) for traj in trajs])
+            ts = np.concatenate([np.asarray(traj["timestamp"], dtype=float) for traj in trajs])
+            xs = np.concatenate([np.asarray(traj["x_position"], dtype=float) for traj in trajs])
+            ys = np.concatenate([np.asarray(traj["y_position"], dtype=float) for traj in trajs])
+            points += len(ts)
+            
+            lane = np.digitize(ys, self.lanes) - 1
+            ti = np.floor((ts - self.t_min) / time_res).astype(np.int64)
+            xi = np.floor((xs - x_lo) / x_res).astype(np.int64)
+            keep = (lane >= 0) & (lane < n_lanes) & (ti >= 0) & (ti < n_t) & (xi >= 0) & (xi < n_x)
+            cells, inverse, hits = np.unique((lane[keep] * n_t + ti[keep]) * n_x + xi[keep], 
+                                             return_inverse=True, return_counts=True)
+            counts.reshape(-1)[cells] += hits
+            if speed:
+                # (mph) from consecutive points of the same trajectory, the first point takes the second's speed
+                v = np.full(len(ts), np.nan)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    v[1:] = np.abs(np.diff(xs) / np.diff(ts)) * 3600 / 5280
+                first = np.cumsum(sizes) - sizes
+                v[first] = np.where(sizes > 1, v[np.minimum(first + 1, len(v) - 1)], np.nan)
+                v = np.nan_to_num(v[keep], nan=0.0, posinf=0.0)
+                speeds.reshape(-1)[cells] += np.bincount(inverse.reshape(-1), weights=v, minlength=len(cells))
+        
+        if speed:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                image = np.ma.masked_where(counts == 0, speeds / counts)
+            kwargs = {"cmap": "RdYlGn", "vmin": 0, "vmax": 80}
+        else:
+            image = np.ma.masked_where(counts == 0, np.log1p(counts))
+            kwargs = {"cmap": "viridis", "vmin": 0, "vmax": max(1, float(image.max() or 1))}
+        
+        paths = {}
+        time_labels = mticker.FuncFormatter(lambda t, pos: datetime.utcfromtimestamp(int(t)).strftime('%H:%M:%S'))
+        extent = [self.t_min, self.t_min + n_t * time_res, x_lo, x_lo + n_x * x_res]
+        for direction, row in (("WB", 0), ("EB", 1)):
+            fig, axs = plt.subplots(1, 6, figsize=(36, 6), sharey=True)
+            for i in self.lane_idx:
+                if self.lane_ax[i][0] != row:
+                    continue
+                ax = axs[self.lane_ax[i][1]]
+                im = ax.imshow(image[i].T, origin="lower", extent=extent, aspect="auto", 
+                               interpolation="nearest", **kwargs)
+                ax.set_title(self.lane_name[i])
+                ax.set_xlabel("Time")
+                ax.xaxis.set_major_locator(mticker.MaxNLocator(4))
+                ax.xaxis.set_major_formatter(time_labels)
+            axs[0].set_ylabel("Distance in feet")
+            fig.colorbar(im, ax=list(axs), label="mean speed (mph)" if speed else "log(1 + points per cell)")
+            paths[direction] = "{}_{}.png".format(file_name, direction)
+            fig.savefig(paths[direction], dpi=dpi)
+            plt.close(fig)
+        print("{} points binned in {:.1f} sec: {}".format(points, perf_counter() - start, ", ".join(paths.values())))
+        return paths
 
 
     
     def toggle_pause(self, event):
         """
-        press spacebar to pause/resume animation
+        press spacebar to pause/resume animation, +/- to double/halve the playback speed,
+        right/left to step one frame while paused, up/down to scrub SCRUB_STEP sec, home/end to jump
         """
         printed = set()
+        if event.key in ("+", "=", "-"):
+            self.set_speed(self.speed * (0.5 if event.key == "-" else 2))
+        if self.paused and event.key in ("right", "left"):
+            self.step(1 if event.key == "right" else -1)
+        if event.key in ("up", "down"):
+            self.seek((self.left + self.right)/2 + (SCRUB_STEP if event.key == "up" else -SCRUB_STEP))
+        if event.key in ("home", "end"):
+            self.seek(self.t_min if event.key == "home" else self.t_max - 1/self.framerate)
         if event.key == " ":
             if self.paused:
                 self.anim.resume()
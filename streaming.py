@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 25 14:12:40 2022
+
+Broadcast hubs between the renderer thread and the Flask stream clients.
+The renderer publishes every frame once; it is encoded once (only if someone
+is watching) and tagged with a sequence number. Each client waits on a condition
+for a newer sequence number and always takes the latest frame, so a slow client
+skips frames instead of queueing them.
+
+FrameHub: JPEG frames for the MJPEG /video_feed, at a quality adapted to each client
+VehicleFrameHub: packed float32 vehicle boxes for the canvas page (/vehicle_feed)
+"""
+
+import json
+import struct
+import threading
+import time
+import cv2
+import numpy as np
+
+
+class BroadcastHub():
+    """
+    Latest-value broadcaster with sequence numbers
+    timeout: (sec) how often waiting clients wake up to check whether the hub was closed
+    """
+
+    def __init__(self, timeout = 1.0):
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.seq = 0 # sequence number of the latest frame
+        self.latest = None # encoded latest frame, None if it was not encoded
+        self.closed = False
+
+        # counters
+        self.clients = 0
+        self.published = 0
+        self.encoded = 0
+        self.sent = 0
+        self.skipped = 0
+
+
+    def _publish(self, payload):
+        with self.cond:
+            self.seq += 1
+            self.published += 1
+            self.latest = payload # None while nobody watches, so a new client never gets a stale frame
+            if payload is not None:
+                self.encoded += 1
+                self.cond.notify_all()
+
+
+    def wait(self, last_seq):
+        """
+        Block until a frame newer than last_seq is available
+        return: (seq, payload), or (last_seq, None) on timeout or when closed
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: (self.latest is not None and self.seq > last_seq) or self.closed, self.timeout)
+            if self.closed or self.latest is None or self.seq <= last_seq:
+                return last_seq, None
+            return self.seq, self.latest
+
+
+    def frames(self):
+        """
+        Generator of (seq, payload) of the latest frames for one client, ends when the hub is closed
+        """
+        with self.cond:
+            self.clients += 1
+        seq = 0
+        try:
+            while not self.closed:
+                new_seq, payload = self.wait(seq)
+                if payload is None:
+                    continue
+                with self.cond:
+                    if seq:
+                        self.skipped += new_seq - seq - 1
+                    self.sent += 1
+                seq = new_seq
+                yield seq, payload
+        finally:
+            with self.cond:
+                self.clients -= 1
+
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+    def stats(self):
+        return {"clients": self.clients, "seq": self.seq, "published": self.published,
+                "encoded": self.encoded, "sent": self.sent, "skipped": self.skipped}
+
+
+
+# quality ladder of the MJPEG stream, best first: (scale, JPEG quality, send every n-th frame)
+LADDER = [(1.0, 80, 1),
+          (1.0, 60, 1),
+          (0.75, 60, 1),
+          (0.5, 60, 1),
+          (0.5, 50, 2),
+          (0.5, 40, 4)]
+
+
+class StreamClient():
+    """
+    Delivery statistics and quality level of one /video_feed client
+    The time a part takes to be written to the socket is measured around the yield
+    of the generator, it grows as soon as the link cannot keep up. Socket buffers hide
+    a slow link for a while, so frames missed while writing are tracked as well
+    """
+    ALPHA = 0.2 # weight of the newest sample in the moving averages
+
+    def __init__(self, number, address = None, level = 0):
+        self.number = number
+        self.address = address
+        self.level = level
+        self.connected = time.time()
+        self.sent = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.send_time = 0.0 # (sec) moving average per part
+        self.rate = 0.0 # (bytes/sec) delivered, moving average
+        self.interval = None # (sec) moving average between parts
+        self.missed = 0.0 # frames missed per part, moving average
+        self.last_sent = None
+        self.good = 0 # consecutive parts sent well within budget
+
+    def record(self, size, elapsed, missed = 0):
+        now = time.perf_counter()
+        self.missed = (1-self.ALPHA) * self.missed + self.ALPHA * missed
+        if self.last_sent is not None:
+            gap = now - self.last_sent
+            self.interval = gap if self.interval is None else (1-self.ALPHA) * self.interval + self.ALPHA * gap
+            if gap > 0:
+                self.rate = (1-self.ALPHA) * self.rate + self.ALPHA * size / gap
+        self.last_sent = now
+        self.sent += 1
+        self.bytes += size
+        self.send_time = (1-self.ALPHA) * self.send_time + self.ALPHA * elapsed
+
+    def stats(self, ladder = LADDER):
+        scale, quality, skip = ladder[self.level]
+        return {"client": self.number, "address": self.address, "level": self.level,
+                "scale": scale, "quality": quality, "skip": skip,
+                "fps": 1/self.interval if self.interval else 0.0,
+                "kbps": self.rate * 8 / 1000, "send_ms": self.send_time * 1000, "missed": self.missed,
+                "sent": self.sent, "skipped": self.skipped, "bytes": self.bytes,
+                "connected_s": time.time() - self.connected}
+
+
+
+class FrameHub(BroadcastHub):
+    """
+    Encode-once, fan-out JPEG broadcaster with a per-client quality ladder
+    Every frame is encoded once per ladder level in use (see LADDER), and every client
+    is moved along the ladder according to how fast its parts are delivered
+    quality: JPEG quality of the top level
+    adaptive: if False, every client stays at the top level
+    """
+
+    def __init__(self, quality = 80, timeout = 1.0, adaptive = True):
+        super().__init__(timeout)
+        self.ladder = [(1.0, quality, 1)] + LADDER[1:]
+        self.adaptive = adaptive
+        self.wanted = [0] * len(self.ladder) # clients per level
+        self.viewers = {} # number -> StreamClient
+        self.numbers = 0
+        self.frame_interval = None # (sec) moving average between published frames
+        self.last_published = None
+
+
+    def publish(self, frame):
+        """
+        Called by the renderer with every new frame (uint8 BGR image)
+        The frame is encoded here, before the clients are woken up, so the
+        renderer may reuse its buffer as soon as this returns
+        """
+        now = time.perf_counter()
+        if self.last_published is not None:
+            gap = now - self.last_published
+            self.frame_interval = gap if self.frame_interval is None else 0.8 * self.frame_interval + 0.2 * gap
+        self.last_published = now
+        
+        variants = {}
+        for level, (scale, quality, skip) in enumerate(self.ladder):
+            if self.wanted[level] == 0:
+                continue
+            image = frame if scale == 1 else cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            flag, buf = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if flag:
+                variants[level] = buf.tobytes()
+        self._publish(variants or None)
+
+
+    def set_level(self, client, level):
+        with self.cond:
+            self.wanted[client.level] -= 1
+            self.wanted[level] += 1
+            client.level = level
+            client.good = 0
+
+
+    def adapt(self, client):
+        """
+        Step down the ladder when sending a part takes most of the time until the next
+        part is due or frames are missed, step back up after a couple of seconds of fast delivery
+        """
+        if not self.adaptive or not self.frame_interval:
+            return
+        budget = self.frame_interval * self.ladder[client.level][2]
+        if (client.send_time > 0.8 * budget or client.missed > 0.5) and client.level < len(self.ladder) - 1:
+            self.set_level(client, client.level + 1)
+            # give the new level a fresh start
+            client.send_time = 0.5 * budget
+            client.missed = 0.0
+        elif client.send_time < 0.3 * budget and client.missed < 0.1 and client.level > 0:
+            client.good += 1
+            if client.good * budget > 2.0:
+                self.set_level(client, client.level - 1)
+        else:
+            client.good = 0
+
+
+    def subscribe(self, address = None):
+        """
+        Generator of multipart/x-mixed-replace parts for one client
+        address: remote address shown in stats()
+        """
+        with self.cond:
+            self.numbers += 1
+            client = StreamClient(self.numbers, address)
+            self.viewers[client.number] = client
+            self.wanted[client.level] += 1
+            self.clients += 1
+        seq = 0
+        seen = 0 # latest sequence number looked at, may lack this client's level
+        try:
+            while not self.closed:
+                skip = self.ladder[client.level][2]
+                new_seq, variants = self.wait(max(seq + skip - 1, seen))
+                if variants is None:
+                    continue
+                seen = new_seq
+                if client.level not in variants: # level changed after this frame was encoded
+                    continue
+                missed = max(0, new_seq - seq - skip) if seq else 0
+                with self.cond:
+                    client.skipped += missed
+                    self.skipped += missed
+                    self.sent += 1
+                seq = new_seq
+                part = (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' +
+                        variants[client.level] + b'\r\n')
+                start = time.perf_counter()
+                yield part
+                client.record(len(part), time.perf_counter() - start, missed)
+                self.adapt(client)
+        finally:
+            with self.cond:
+                self.clients -= 1
+                self.wanted[client.level] -= 1
+                del self.viewers[client.number]
+
+
+    def stats(self):
+        out = super().stats()
+        out["fps"] = 1/self.frame_interval if self.frame_interval else 0.0
+        out["viewers"] = [client.stats(self.ladder) for client in list(self.viewers.values())]
+        return out
+
+
+
+class VehicleFrameHub(BroadcastHub):
+    """
+    Fan-out of compact binary vehicle frames, rendered by the browser (templates/canvas.html)
+    Every vehicle gets a global index the first time it is published. A client receives
+    the table entries [index, layer, style, label] of the vehicles it has not seen yet
+    along with each frame, and the boxes themselves as float32 (x, y, length, width, index).
+    Vehicles not published for expire_after seconds of data leave the table (they get a new
+    index if they come back), and a new client receives the entries of the live vehicles only
+
+    Message layout (little endian):
+        uint32 number of bytes that follow
+        uint32 header length, header JSON padded to a multiple of 4 bytes
+            {"seq", "timestamp", "counts": [boxes per layer], "vehicles": [new table entries]}
+        float32 (counts[0] + counts[1] + ...) x 5 boxes, layer by layer
+    """
+
+    def __init__(self, timeout = 1.0, expire_after = 2.0):
+        super().__init__(timeout)
+        self.expire_after = expire_after
+        self.index = {} # (layer, vehicle id) -> global index, live vehicles only
+        self.table = {} # index -> [index, layer, style, label], in index order
+        self.keys = {} # index -> (layer, vehicle id)
+        self.seen = {} # index -> timestamp of the last frame that showed the vehicle
+        self.next_index = 0
+        self.expired = 0
+
+
+    def indices(self, layer, ids, styles):
+        """
+        Global indices of vehicles of a layer, registering the new ones
+        ids: vehicle ids, styles: (N,) style per vehicle (palette index, -1 stitched)
+        """
+        out = np.empty(len(ids), dtype=np.float32)
+        for k, veh_id in enumerate(ids):
+            idx = self.index.get((layer, veh_id))
+            if idx is None:
+                idx = self.next_index
+                self.next_index += 1
+                self.index[(layer, veh_id)] = idx
+                self.keys[idx] = (layer, veh_id)
+                # added before the frame that uses it is published, clients read the table under the condition
+                with self.cond:
+                    self.table[idx] = [idx, layer, int(styles[k]), str(veh_id)]
+            out[k] = idx
+        return out
+
+
+    def publish(self, timestamp, layers):
+        """
+        layers: [(boxes (N,4) x/y/length/width, indices (N,)) or None] per layer, layer 0 is GT
+        """
+        for layer in layers:
+            if layer is not None:
+                for idx in layer[1].astype(int).tolist():
+                    self.seen[idx] = timestamp
+        self._expire(timestamp)
+        payload = None
+        if self.clients > 0:
+            counts = []
+            data = []
+            for layer in layers:
+                if layer is None:
+                    counts.append(0)
+                    continue
+                boxes, idx = layer
+                counts.append(len(idx))
+                data.append(np.column_stack([boxes, idx]).astype("<f4").tobytes())
+            payload = (timestamp, counts, self.next_index, b"".join(data))
+        self._publish(payload)
+
+
+    def _expire(self, timestamp):
+        # either way, a seek moves the data time away from the vehicles shown before
+        old = [idx for idx, t in self.seen.items() if abs(timestamp - t) > self.expire_after]
+        if not old:
+            return
+        with self.cond:
+            for idx in old:
+                del self.index[self.keys.pop(idx)]
+                del self.table[idx]
+                del self.seen[idx]
+        self.expired += len(old)
+
+
+    def subscribe(self):
+        """
+        Generator of length-prefixed binary messages for one client
+        """
+        known = None # indices below this were sent to this client, None before the first message
+        for seq, (timestamp, counts, table_len, data) in self.frames():
+            with self.cond:
+                if known is None: # the live vehicles only
+                    vehicles = [entry for idx, entry in self.table.items() if idx < table_len]
+                else:
+                    vehicles = [self.table[idx] for idx in range(known, table_len) if idx in self.table]
+            known = table_len
+            header = json.dumps({"seq": seq, "timestamp": timestamp, "counts": counts, "vehicles": vehicles}).encode()
+            header += b" " * (-len(header) % 4)
+            yield struct.pack("<II", 4 + len(header) + len(data), len(header)) + header + data
+
+
+    def stats(self):
+        out = super().stats()
+        out["vehicles"] = len(self.table)
+        out["expired"] = self.expired
+        return out
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 20 11:05:43 2022
+
+Synthetic I-24 traffic for load-testing the visualizers.
+
+TrafficSimulator runs a vectorized car-following model (IDM) on the 12-lane layout
+used by the visualizers (lanes EBRS...WBRS, 12 ft each, eastbound below y=60) and
+produces a SyntheticScene with three variants of the same traffic:
+    gt:  clean trajectories, one per vehicle
+    raw: noisy, fragmented trajectories with dropped samples (tracking output)
+    rec: smoothed trajectories stitched from the raw fragments (fragment_ids)
+Each variant is available as vehicle-indexed trajectory documents
+(first_timestamp, last_timestamp, timestamp, x_position, y_position, length, width, fragment_ids, ...)
+and the matching time-indexed documents (timestamp, id, position, dimensions),
+in memory (LocalBackend), in MongoDB or as a columnar snapshot.
+
+Size is set by density (veh/mile/lane) and road length, or directly with vehicles_per_frame.
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from bson.objectid import ObjectId
+
+
+LANES = [i*12 for i in range(-1,12)]
+TRAVEL_LANES = [1, 2, 3, 4, 7, 8, 9, 10] # no shoulders
+FEET_PER_MILE = 5280
+
+# vehicle classes: (coarse_vehicle_class, length mean/std, width mean/std, height)
+CAR = (1, 15.5, 1.5, 6.2, 0.3, 5.0)
+TRUCK = (5, 65.0, 8.0, 8.5, 0.2, 13.0)
+
+
+def object_ids(prefix, n):
+    """
+    n deterministic ObjectIds, distinct across prefixes
+    """
+    return [ObjectId("{:08x}{:016x}".format(prefix, i)) for i in range(n)]
+
+
+def split_points(keys):
+    """
+    Start offsets of the runs of equal values in a sorted key array, plus the end
+    """
+    if len(keys) == 0:
+        return np.zeros(1, dtype=np.int64)
+    return np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1, [len(keys)]))
+
+
+
+class SyntheticCollection():
+    """
+    One variant of the synthetic traffic, stored sample-wise
+    step, ids, x, y, length, width, height: (S,) arrays, one row per vehicle per sampled frame, ordered by step
+    oids: ObjectId of each dense id
+    attrs: per-id fields copied into the trajectory documents (arrays or lists indexed by id)
+    """
+
+    def __init__(self, step, ids, x, y, length, width, height, oids, attrs, scalar_dims = True):
+        self.step = step
+        self.ids = ids
+        self.x = x
+        self.y = y
+        self.length = length
+        self.width = width
+        self.height = height
+        self.oids = oids
+        self.attrs = attrs
+        self.scalar_dims = scalar_dims # reconciled/GT store one length/width per trajectory, raw one per sample
+
+    def time_documents(self, timestamps):
+        """
+        Time-indexed documents, ascending timestamp
+        """
+        bounds = split_points(self.step)
+        oids = self.oids
+        for k in range(len(bounds)-1):
+            lo, hi = bounds[k], bounds[k+1]
+            yield {"timestamp": float(timestamps[self.step[lo]]),
+                   "id": [oids[i] for i in self.ids[lo:hi]],
+                   "position": np.stack([self.x[lo:hi], self.y[lo:hi]], axis=1).tolist(),
+                   "dimensions": np.stack([self.length[lo:hi], self.width[lo:hi], self.height[lo:hi]], axis=1).tolist()}
+
+    def trajectory_documents(self, timestamps):
+        """
+        Vehicle-indexed documents, ascending first_timestamp
+        """
+        order = np.lexsort((self.step, self.ids))
+        ids = self.ids[order]
+        bounds = split_points(ids)
+        runs = [(bounds[k], bounds[k+1]) for k in range(len(bounds)-1)]
+        runs.sort(key=lambda r: self.step[order[r[0]]])
+        for lo, hi in runs:
+            sel = order[lo:hi]
+            i = ids[lo]
+            t = timestamps[self.step[sel]]
+            x = self.x[sel]
+            doc = {"_id": self.oids[i],
+                   "first_timestamp": float(t[0]),
+                   "last_timestamp": float(t[-1]),
+                   "starting_x": float(x[0]),
+                   "ending_x": float(x[-1]),
+                   "timestamp": t.tolist(),
+                   "x_position": x.tolist(),
+                   "y_position": self.y[sel].tolist()}
+            if self.scalar_dims:
+                doc["length"] = float(self.length[sel[0]])
+                doc["width"] = float(self.width[sel[0]])
+                doc["height"] = float(self.height[sel[0]])
+            else:
+                doc["length"] = self.length[sel].tolist()
+                doc["width"] = self.width[sel].tolist()
+                doc["height"] = self.height[sel].tolist()
+            for field, values in self.attrs.items():
+                value = values[i]
+                doc[field] = value.item() if isinstance(value, np.generic) else value
+            yield doc
+
+    def snapshot_arrays(self, timestamps):
+        """
+        Columns in the snapshot.py layout. Vehicle indices are the dense ids
+        """
+        n_veh = len(self.oids)
+        bounds = split_points(self.step)
+        order = np.lexsort((self.step, self.ids))
+        veh_bounds = np.searchsorted(self.ids[order], np.arange(n_veh+1))
+        first = np.full(n_veh, np.nan)
+        last = np.full(n_veh, np.nan)
+        has = veh_bounds[1:] > veh_bounds[:-1]
+        first[has] = timestamps[self.step[order[veh_bounds[:-1][has]]]]
+        last[has] = timestamps[self.step[order[veh_bounds[1:][has]-1]]]
+        length = np.zeros(n_veh, dtype=np.float32)
+        width = np.zeros(n_veh, dtype=np.float32)
+        length[self.ids] = self.length # any sample of the vehicle
+        width[self.ids] = self.width
+        fragments = self.attrs.get("fragment_ids")
+        cls = self.attrs.get("coarse_vehicle_class")
+        return {
+            "timestamps": timestamps[self.step[bounds[:-1]]] if len(self.step) else np.empty(0),
+            "offsets": bounds.astype(np.int64),
+            "positions": np.stack([self.x, self.y], axis=1).astype(np.float32),
+            "dimensions": np.stack([self.length, self.width, self.height], axis=1).astype(np.float32),
+            "vehicle_index": self.ids.astype(np.int32),
+            "vehicle_ids": np.array([oid.binary for oid in self.oids], dtype="S12"),
+            "first_timestamp": first,
+            "last_timestamp": last,
+            "length": length,
+            "width": width,
+            "coarse_vehicle_class": np.asarray(cls, dtype=np.int32) if cls is not None else np.full(n_veh, -1, dtype=np.int32),
+            "n_fragments": np.array([len(f) for f in fragments], dtype=np.int32) if fragments is not None else np.zeros(n_veh, dtype=np.int32),
+            "n_merged": np.zeros(n_veh, dtype=np.int32),
+            "traj_offsets": veh_bounds.astype(np.int64),
+            "traj_timestamp": timestamps[self.step[order]],
+            "traj_x": self.x[order].astype(np.float32),
+            "traj_y": self.y[order].astype(np.float32),
+            }
+
+
+
+class SyntheticScene():
+    """
+    GT, raw and reconciled variants of one simulated traffic scene
+    """
+    DATABASES = ["trajectories", "trajectories", "reconciled"] # gt, raw, rec
+
+    def __init__(self, timestamps, gt, raw, rec):
+        self.timestamps = timestamps
+        self.variants = [gt, raw, rec]
+        self.gt, self.raw, self.rec = gt, raw, rec
+
+    def write_documents(self, insert_many, names, batch_size = 1000):
+        """
+        Write trajectory and time-indexed documents of the three variants
+        insert_many: callable(database, collection, docs), e.g. LocalBackend.insert_many
+        names: [gt, raw, rec] collection names
+        """
+        for variant, database, name in zip(self.variants, self.DATABASES, names):
+            for db, docs in ((database, variant.trajectory_documents(self.timestamps)),
+                             ("transformed", variant.time_documents(self.timestamps))):
+                batch = []
+                for doc in docs:
+                    batch.append(doc)
+                    if len(batch) >= batch_size:
+                        insert_many(db, name, batch)
+                        batch = []
+                if batch:
+                    insert_many(db, name, batch)
+
+    def to_backend(self, names, backend = None):
+        """
+        Load the scene into a LocalBackend (a new one by default)
+        """
+        from backends import LocalBackend
+        backend = backend if backend is not None else LocalBackend()
+        self.write_documents(backend.insert_many, names)
+        return backend
+
+    def write_snapshot(self, path, names):
+        """
+        Write the scene as a columnar snapshot (see snapshot.py), without building documents
+        """
+        from snapshot import write_collection, write_meta
+        for variant, name in zip(self.variants, names):
+            write_collection(os.path.join(path, name), variant.snapshot_arrays(self.timestamps))
+        write_meta(path, float(self.timestamps[0]), float(self.timestamps[-1]), names, self.DATABASES)
+
+
+
+class TrafficSimulator():
+    """
+    Vectorized Intelligent Driver Model on the I-24 lane layout
+    density: (veh/mile/lane) target density, sets the initial spacing and the inflow
+    duration: (sec) recorded duration
+    framerate: (FPS) simulation step and sample rate of the documents
+    x_min/x_max: (feet) simulated road section. Eastbound travels +x, westbound -x
+    vehicles_per_frame: if given, x_max is set so that about this many vehicles are on the road
+    lanes: lane indices (into LANES) with traffic
+    truck_fraction: share of trucks
+    speed/speed_std: (ft/s) desired speed distribution
+    noise: (ft) position noise of the raw variant, the reconciled variant gets a tenth of it
+    fragment_rate: (per vehicle per minute) rate of raw track breaks
+    drop_rate: fraction of raw samples missing
+    warmup: (sec) simulated before recording, so the road is in equilibrium at t0
+    t0: (sec) timestamp of the first frame
+    """
+
+    def __init__(self, density = 60, duration = 60, framerate = 25, x_min = 0, x_max = 2000,
+                 vehicles_per_frame = None, lanes = TRAVEL_LANES, truck_fraction = 0.1,
+                 speed = 100, speed_std = 8, noise = 1.0, fragment_rate = 2.0, drop_rate = 0.02,
+                 warmup = 10, t0 = 1656000000.0, seed = 0):
+        self.density = density
+        self.duration = duration
+        self.framerate = framerate
+        self.lanes = np.asarray(lanes)
+        if vehicles_per_frame:
+            x_max = x_min + vehicles_per_frame / (density * len(self.lanes)) * FEET_PER_MILE
+        self.x_min = x_min
+        self.x_max = x_max
+        self.road_length = x_max - x_min
+        self.truck_fraction = truck_fraction
+        self.speed = speed
+        self.speed_std = speed_std
+        self.noise = noise
+        self.fragment_rate = fragment_rate
+        self.drop_rate = drop_rate
+        self.warmup = warmup
+        self.t0 = t0
+        self.rng = np.random.default_rng(seed)
+
+        # IDM parameters (ft, s)
+        self.headway = 1.4
+        self.min_gap = 6.0
+        self.max_acc = 3.0
+        self.comf_dec = 5.0
+
+        self.n_spawned = 0
+
+
+    def _spawn(self, lanes):
+        """
+        Draw attributes for new vehicles in the given lanes, return their ids
+        """
+        n = len(lanes)
+        start = self.n_spawned
+        truck = self.rng.random(n) < self.truck_fraction
+        spec = np.where(truck[:, None], np.asarray(TRUCK, dtype=float), np.asarray(CAR, dtype=float))
+        self.veh_class.append(spec[:, 0].astype(int))
+        self.veh_length.append(np.maximum(8, self.rng.normal(spec[:, 1], spec[:, 2])))
+        self.veh_width.append(np.maximum(4, self.rng.normal(spec[:, 3], spec[:, 4])))
+        self.veh_height.append(spec[:, 5])
+        self.veh_lane.append(np.asarray(lanes))
+        v0 = self.rng.normal(self.speed, self.speed_std, n)
+        v0[truck] *= 0.85
+        self.veh_speed.append(np.maximum(30, v0))
+        self.veh_offset.append(self.rng.normal(0, 0.5, n))
+        self.n_spawned = start + n
+        return np.arange(start, start + n)
+
+
+    def run(self):
+        """
+        Simulate and return a SyntheticScene
+        """
+        dt = 1 / self.framerate
+        spacing = FEET_PER_MILE / self.density
+        
+        # static attributes of every vehicle ever spawned
+        self.n_spawned = 0
+        self.veh_length = []
+        self.veh_width = []
+        self.veh_height = []
+        self.veh_class = []
+        self.veh_lane = []
+        self.veh_speed = []
+        self.veh_offset = []
+
+        # initial fill at the target density
+        per_lane = int(self.road_length // spacing) + 1
+        lanes0 = np.repeat(self.lanes, per_lane)
+        ids = self._spawn(lanes0)
+        s = np.tile(np.arange(per_lane) * spacing, len(self.lanes)) + self.rng.uniform(0, 0.2*spacing, len(ids))
+        v = np.full(len(ids), 0.8 * self.speed)
+
+        length = np.concatenate(self.veh_length)
+        v0 = np.concatenate(self.veh_speed)
+        lane = np.concatenate(self.veh_lane)
+
+        n_warm = int(self.warmup * self.framerate)
+        n_steps = int(self.duration * self.framerate)
+        rec_step, rec_ids, rec_s = [], [], []
+        for step in range(-n_warm, n_steps):
+            ids, s, v = self._step(ids, s, v, lane, length, v0, dt)
+
+            # inflow: one vehicle per lane when the entrance is free
+            rear = np.full(len(LANES), np.inf)
+            np.minimum.at(rear, lane[ids], s)
+            free = self.lanes[rear[self.lanes] >= spacing]
+            if len(free):
+                new = self._spawn(free)
+                length = np.concatenate((length, self.veh_length[-1]))
+                v0 = np.concatenate((v0, self.veh_speed[-1]))
+                lane = np.concatenate((lane, self.veh_lane[-1]))
+                ids = np.concatenate((ids, new))
+                s = np.concatenate((s, np.zeros(len(new))))
+                v = np.concatenate((v, np.minimum(v0[new], 0.8 * self.speed)))
+
+            # outflow
+            keep = s < self.road_length + length[ids]
+            ids, s, v = ids[keep], s[keep], v[keep]
+
+            if step >= 0:
+                on_road = s <= self.road_length
+                rec_step.append(np.full(int(on_road.sum()), step, dtype=np.int32))
+                rec_ids.append(ids[on_road].astype(np.int32))
+                rec_s.append(s[on_road].astype(np.float32))
+
+        step = np.concatenate(rec_step)
+        ids = np.concatenate(rec_ids)
+        s = np.concatenate(rec_s)
+        timestamps = np.round(self.t0 + np.arange(n_steps) / self.framerate, 4)
+        return self._scene(timestamps, step, ids, s)
+
+
+    def _step(self, ids, s, v, lane, length, v0, dt):
+        """
+        One IDM step for all vehicles on the road
+        """
+        n = len(ids)
+        order = np.lexsort((s, lane[ids]))
+        s_o, v_o, lane_o = s[order], v[order], lane[ids][order]
+        gap_o = np.full(n, np.inf)
+        dv_o = np.zeros(n)
+        same = lane_o[1:] == lane_o[:-1] # leader is the next vehicle in the same lane
+        gap_o[:-1] = np.where(same, s_o[1:] - s_o[:-1] - length[ids][order][1:], np.inf)
+        dv_o[:-1] = np.where(same, v_o[:-1] - v_o[1:], 0)
+        gap = np.empty(n); dv = np.empty(n)
+        gap[order] = np.maximum(gap_o, 0.1)
+        dv[order] = dv_o
+
+        s_star = self.min_gap + v * self.headway + v * dv / (2 * np.sqrt(self.max_acc * self.comf_dec))
+        acc = self.max_acc * (1 - (v / v0[ids])**4 - (np.maximum(s_star, 0) / gap)**2)
+        v = np.maximum(v + acc * dt, 0)
+        return ids, s + v * dt, v
+
+
+    def _scene(self, timestamps, step, ids, s):
+        """
+        Build the GT, raw and reconciled variants from the recorded samples
+        """
+        n_veh = self.n_spawned
+        lane = np.concatenate(self.veh_lane)
+        length = np.concatenate(self.veh_length).astype(np.float32)
+        width = np.concatenate(self.veh_width).astype(np.float32)
+        height = np.concatenate(self.veh_height).astype(np.float32)
+        cls = np.concatenate(self.veh_class)
+        offset = np.concatenate(self.veh_offset)
+
+        # keep only vehicles that appear in the recording, with dense ids
+        seen, ids = np.unique(ids, return_inverse=True)
+        ids = ids.astype(np.int32)
+        lane, length, width, height, cls, offset = lane[seen], length[seen], width[seen], height[seen], cls[seen], offset[seen]
+        n_veh = len(seen)
+
+        east = lane[ids] < 6
+        x = np.where(east, self.x_min + s, self.x_max - s).astype(np.float32)
+        y = (np.asarray(LANES)[lane[ids]] + 6 + offset[ids]).astype(np.float32)
+
+        gt_oids = object_ids(1, n_veh)
+        gt = SyntheticCollection(step, ids, x, y, length[ids], width[ids], height[ids], gt_oids,
+                                 {"coarse_vehicle_class": cls, "direction": np.where(lane < 6, 1, -1),
+                                  "fragment_ids": [[oid] for oid in gt_oids]})
+
+        # raw: break tracks into fragments, drop samples and add noise
+        n = len(step)
+        order = np.lexsort((step, ids))
+        brk = self.rng.random(n) < self.fragment_rate / (60 * self.framerate)
+        first = np.ones(n, dtype=bool)
+        first[1:] = ids[order][1:] != ids[order][:-1]
+        brk[first] = True # every vehicle starts a fragment
+        frag_sorted = np.cumsum(brk) - 1
+        frag = np.empty(n, dtype=np.int64)
+        frag[order] = frag_sorted
+        keep = self.rng.random(n) >= self.drop_rate
+        frag_keep, frag = np.unique(frag[keep], return_inverse=True)
+        frag_owner = np.empty(len(frag_keep), dtype=np.int64) # vehicle of each raw fragment
+        frag_owner[frag] = ids[keep]
+        raw_oids = object_ids(2, len(frag_keep))
+        m = int(keep.sum())
+        raw = SyntheticCollection(step[keep], frag.astype(np.int32),
+                                  x[keep] + self.rng.normal(0, self.noise, m).astype(np.float32),
+                                  y[keep] + self.rng.normal(0, self.noise/4, m).astype(np.float32),
+                                  length[ids[keep]] * (1 + self.rng.normal(0, 0.05, m)).astype(np.float32),
+                                  width[ids[keep]] * (1 + self.rng.normal(0, 0.05, m)).astype(np.float32),
+                                  height[ids[keep]], raw_oids,
+                                  {"coarse_vehicle_class": cls[frag_owner], "direction": np.where(lane[frag_owner] < 6, 1, -1)},
+                                  scalar_dims=False)
+
+        # reconciled: one stitched trajectory per vehicle listing its raw fragments
+        fragment_ids = [[] for _ in range(n_veh)]
+        for f, owner in enumerate(frag_owner):
+            fragment_ids[owner].append(raw_oids[f])
+        rec = SyntheticCollection(step, ids,
+                                  x + self.rng.normal(0, self.noise/10, n).astype(np.float32),
+                                  y + self.rng.normal(0, self.noise/40, n).astype(np.float32),
+                                  length[ids], width[ids], height[ids], object_ids(3, n_veh),
+                                  {"coarse_vehicle_class": cls, "direction": np.where(lane < 6, 1, -1),
+                                   "fragment_ids": fragment_ids, "merged_ids": [[] for _ in range(n_veh)]})
+        return SyntheticScene(timestamps, gt, raw, rec)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic GT/raw/reconciled I-24 traffic")
+    parser.add_argument("--name", default="synthetic", help="collections are groundtruth_<name>, <name>--RAW and <name>--RAW__reconciled")
+    parser.add_argument("--density", type=float, default=60, help="(veh/mile/lane)")
+    parser.add_argument("--vehicles-per-frame", type=int, default=None)
+    parser.add_argument("--duration", type=float, default=60, help="(sec)")
+    parser.add_argument("--framerate", type=int, default=25)
+    parser.add_argument("--noise", type=float, default=1.0, help="(ft) raw position noise")
+    parser.add_argument("--fragment-rate", type=float, default=2.0, help="raw track breaks per vehicle per minute")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--snapshot", default=None, help="write a columnar snapshot to this directory")
+    parser.add_argument("--json", default=None, help="write LocalBackend JSON files to this directory")
+    parser.add_argument("--mongo", default=None, help="path to a database config, insert the documents into MongoDB")
+    args = parser.parse_args()
+
+    sim = TrafficSimulator(density=args.density, duration=args.duration, framerate=args.framerate,
+                           vehicles_per_frame=args.vehicles_per_frame, noise=args.noise,
+                           fragment_rate=args.fragment_rate, seed=args.seed)
+    scene = sim.run()
+    names = ["groundtruth_" + args.name, args.name + "--RAW", args.name + "--RAW__reconciled"]
+    print("Simulated {} frames, {:.0f} vehicles per frame on average".format(
+        len(scene.timestamps), len(scene.gt.step) / len(scene.timestamps)))
+
+    if args.snapshot:
+        scene.write_snapshot(args.snapshot, names)
+    if args.json:
+        scene.to_backend(names).save(args.json)
+    if args.mongo:
+        from i24_database_api import DBClient
+        with open(args.mongo) as f:
+            config = json.load(f)
+        clients = {}
+        def insert_many(db, name, docs):
+            if (db, name) not in clients:
+                clients[(db, name)] = DBClient(**config, database_name=db, collection_name=name)
+            clients[(db, name)].collection.insert_many(docs)
+        scene.write_documents(insert_many, names)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Nov  1 09:41:08 2022
+
+Local vehicle-to-time transform, instead of blocking on DBClient.transform().
+Trajectories (vehicle-indexed) are resampled onto a common time grid (multiples of
+1/framerate) and grouped into time-indexed documents {"timestamp", "id", "position", "dimensions"}.
+[first_timestamp, last_timestamp] is split into time shards. The main process reads the
+trajectories active in each shard and a pool of worker processes resamples them. Each
+finished shard is written to a cache directory right away, keyed by source collection and
+content version (document count and timestamp range), so an interrupted transform resumes
+and a finished one is never redone. Every shard is inserted into database "transformed"
+of the backend as soon as it is cached (or found in the cache), into a temporary collection
+<name>.partial renamed to <name> once every shard is in, so a collection is only listed when
+it is complete. A marker file per shard records the shards already inserted: a resumed
+insert skips them, and starts the temporary collection over if a shard was cut off midway.
+
+transform_collection(backend, "reconciled", rec, framerate = 25)
+python transform.py reconciled <collection> --framerate 25 --workers 8
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "i24_transform")
+PROJECTION = {"timestamp": 1, "x_position": 1, "y_position": 1, "length": 1, "width": 1, "height": 1,
+              "first_timestamp": 1, "last_timestamp": 1}
+
+
+def first_item(value, default = 0.0):
+    """
+    Scalar of a dimension that may be stored per sample (raw) or per vehicle (reconciled)
+    """
+    if value is None:
+        return default
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return float(value[0]) if len(value) else default
+    return float(value)
+
+
+def resample_shard(job):
+    """
+    Worker: resample the trajectories of one shard onto the grid points in [k_start, k_end)
+    job: {"index", "k_start", "k_end", "framerate", "trajs": [(timestamp, x, y)]}
+    return: (index, frame grid indices (F,), offsets (F+1,), vehicle index (P,), positions (P,2))
+            vehicle index refers to the order of job["trajs"]
+    """
+    rate = job["framerate"]
+    ks, vehs, xs, ys = [], [], [], []
+    for v, (t, x, y) in enumerate(job["trajs"]):
+        t = np.asarray(t, dtype=float)
+        if len(t) == 0:
+            continue
+        lo = max(job["k_start"], int(np.ceil(t[0] * rate - 1e-6)))
+        hi = min(job["k_end"], int(np.floor(t[-1] * rate + 1e-6)) + 1)
+        if hi <= lo:
+            continue
+        k = np.arange(lo, hi)
+        grid = k / rate
+        ks.append(k)
+        vehs.append(np.full(len(k), v, dtype=np.int32))
+        xs.append(np.interp(grid, t, np.asarray(x, dtype=float)))
+        ys.append(np.interp(grid, t, np.asarray(y, dtype=float)))
+    if not ks:
+        return job["index"], np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64), \
+               np.empty(0, dtype=np.int32), np.empty((0, 2))
+    k = np.concatenate(ks)
+    order = np.argsort(k, kind="stable")
+    k = k[order]
+    frames, starts = np.unique(k, return_index=True)
+    offsets = np.append(starts, len(k))
+    positions = np.column_stack([np.concatenate(xs)[order], np.concatenate(ys)[order]])
+    return job["index"], frames, offsets, np.concatenate(vehs)[order], positions
+
+
+def source_version(veh, framerate):
+    """
+    Content version of a vehicle-indexed collection: changes when documents are added or the time range changes
+    """
+    key = {"count": veh.count(),
+           "first": veh.get_min("first_timestamp"), "last": veh.get_max("last_timestamp"),
+           "framerate": framerate}
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def _encode_ids(ids):
+    """
+    Vehicle ids as a string array, with the type needed to restore them
+    """
+    kind = type(ids[0]).__name__ if ids else "str"
+    return np.array([str(i) for i in ids]), kind
+
+
+def _decode_ids(ids, kind):
+    if kind == "ObjectId":
+        from bson.objectid import ObjectId
+        return [ObjectId(i) for i in ids]
+    if kind.startswith("int"):
+        return [int(i) for i in ids]
+    return [str(i) for i in ids]
+
+
+def shard_documents(path):
+    """
+    Time-indexed documents of one cached shard
+    """
+    with np.load(path, allow_pickle=False) as data:
+        ids = _decode_ids(data["ids"].tolist(), str(data["id_kind"]))
+        dims = data["dimensions"].tolist()
+        vehicle = data["vehicle"]
+        positions = data["positions"].tolist()
+        offsets = data["offsets"]
+        docs = []
+        for f, t in enumerate(data["timestamps"].tolist()):
+            sel = range(offsets[f], offsets[f+1])
+            docs.append({"timestamp": t,
+                         "id": [ids[vehicle[p]] for p in sel],
+                         "position": [positions[p] for p in sel],
+                         "dimensions": [dims[vehicle[p]] for p in sel]})
+        return docs
+
+
+def transform_collection(backend, database, name, framerate = 25, workers = None, shard = 60,
+                         cache_dir = None, insert = True):
+    """
+    Write the time-indexed version of collection database/name to database "transformed" of backend
+    backend: see backends.py, must support insert_many("transformed", ...) if insert
+    framerate: (FPS) of the time grid
+    workers: number of processes, all cores by default, 1 resamples in this process
+    shard: (sec) time span resampled per job
+    cache_dir: directory of the transform cache, CACHE_DIR by default
+    insert: if False, only fill the cache
+    return: cache directory of the collection
+    """
+    start = time.perf_counter()
+    veh = backend.collection(database, name)
+    version = source_version(veh, framerate)
+    path = os.path.join(cache_dir or CACHE_DIR, "{}.{}.{}".format(database, name, version))
+    os.makedirs(path, exist_ok=True)
+    t_min = veh.get_min("first_timestamp")
+    t_max = veh.get_max("last_timestamp")
+    if t_min is None or t_max is None:
+        raise ValueError("collection {}.{} has no samples to transform".format(database, name))
+
+    # shards on grid boundaries: [k_start, k_end) in units of 1/framerate
+    k_min = int(np.ceil(t_min * framerate - 1e-6))
+    k_max = int(np.floor(t_max * framerate + 1e-6)) + 1
+    step = max(1, int(round(shard * framerate)))
+    bounds = [(k, min(k + step, k_max)) for k in range(k_min, k_max, step)]
+    shard_path = lambda index: os.path.join(path, "shard_{:05d}.npz".format(index))
+    todo = [index for index in range(len(bounds)) if not os.path.exists(shard_path(index))]
+    partial = name + ".partial"
+    marker = lambda index, state: os.path.join(path, "shard_{:05d}.{}".format(index, state))
+
+    def clear_markers():
+        for file in os.listdir(path):
+            if file.endswith((".inserting", ".inserted")):
+                os.remove(os.path.join(path, file))
+
+    if insert:
+        # the markers describe the temporary collection, they are void without it or after a cut off shard
+        cut = any(file.endswith(".inserting") for file in os.listdir(path))
+        if cut or partial not in backend.list_collection_names("transformed"):
+            clear_markers()
+            backend.drop_collection("transformed", partial)
+
+    def jobs():
+        # read in this process, one shard at a time, the pool only sees arrays
+        for index in todo:
+            k_start, k_end = bounds[index]
+            docs = list(veh.find_active(k_start / framerate, (k_end - 1) / framerate, PROJECTION))
+            yield {"index": index, "k_start": k_start, "k_end": k_end, "framerate": framerate,
+                   "trajs": [(d["timestamp"], d["x_position"], d["y_position"]) for d in docs],
+                   "ids": [d["_id"] for d in docs],
+                   "dimensions": [[first_item(d.get("length")), first_item(d.get("width")), first_item(d.get("height"))]
+                                  for d in docs]}
+
+    def save(job, result):
+        index, frames, offsets, vehicle, positions = result
+        ids, kind = _encode_ids(job["ids"])
+        tmp = shard_path(index) + ".tmp.npz"
+        np.savez(tmp, timestamps=frames / framerate, offsets=offsets, vehicle=vehicle, positions=positions,
+                 ids=ids, id_kind=np.array(kind), dimensions=np.array(job["dimensions"], dtype=float).reshape(-1, 3))
+        os.replace(tmp, shard_path(index)) # complete shards only
+        insert_shard(index)
+
+    def insert_shard(index):
+        if not insert or os.path.exists(marker(index, "inserted")):
+            return
+        open(marker(index, "inserting"), "w").close()
+        docs = shard_documents(shard_path(index))
+        if docs:
+            backend.insert_many("transformed", partial, docs)
+        os.replace(marker(index, "inserting"), marker(index, "inserted"))
+
+    if todo:
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(todo) == 1:
+            for job in jobs():
+                save(job, resample_shard(job))
+        else:
+            workers = min(workers, len(todo))
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(processes=workers) as pool:
+                # at most 2 shards per worker in flight, so memory stays bounded
+                pending = [] # (job, async result) in submission order
+                for job in jobs():
+                    # ids and dimensions stay here, the workers get the samples only
+                    samples = {k: v for k, v in job.items() if k not in ("ids", "dimensions")}
+                    pending.append((job, pool.apply_async(resample_shard, (samples,))))
+                    if len(pending) >= 2 * workers:
+                        done, result = pending.pop(0)
+                        save(done, result.get())
+                for done, result in pending:
+                    save(done, result.get())
+        print("transformed {} shards of {}.{} in {:.1f} sec".format(len(todo), database, name, time.perf_counter() - start))
+
+    if insert:
+        # shards cached by an earlier run
+        for index in range(len(bounds)):
+            insert_shard(index)
+        # nothing inserted if every shard is empty, there would be no collection to read
+        empty = partial not in backend.list_collection_names("transformed")
+        if not empty:
+            backend.rename_collection("transformed", partial, name)
+        clear_markers()
+        if empty:
+            raise ValueError("collection {}.{} has no samples to transform".format(database, name))
+    return path
+
+
+def clear_cache(cache_dir = None):
+    shutil.rmtree(cache_dir or CACHE_DIR, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transform a vehicle-indexed collection into time-indexed documents")
+    parser.add_argument("database", help="database of the vehicle-indexed collection (trajectories, reconciled)")
+    parser.add_argument("collection")
+    parser.add_argument("--config", default=os.path.join(os.environ.get("USER_CONFIG_DIRECTORY", "."), "db_param.json"))
+    parser.add_argument("--framerate", type=int, default=25)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--shard", type=float, default=60, help="(sec) time span per job")
+    parser.add_argument("--cache-dir", default=None)
+    args = parser.parse_args()
+
+    from backends import MongoBackend
+    with open(args.config) as f:
+        backend = MongoBackend(json.load(f))
+    transform_collection(backend, args.database, args.collection, framerate=args.framerate,
+                         workers=args.workers, shard=args.shard, cache_dir=args.cache_dir)
+
+
+if __name__=="__main__":
+    main()